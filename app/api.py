@@ -1,14 +1,77 @@
 import json
+import threading
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from timeit import default_timer
 
-from flask import Flask, Response, request
+from flask import Flask, Response, current_app, g, request
 from flask_restful import Api, Resource
-from mongoengine import DoesNotExist
+from mongoengine import DoesNotExist, ValidationError
 from bson import ObjectId
 
-from datastore import Game, Player
+from cache import LRUCache
+from config import app_config
+from datastore import Player
+from profiling import RequestProfiler
+from events import ALL_GAMES, Event, EventHub, sse_message
+from export import export_lines, gzip_chunks
+from metrics import REGISTRY, REQUESTS, REQUEST_MONGO_BYTES, \
+    REQUEST_MONGO_OPERATIONS, REQUEST_SECONDS, start_counting, stop_counting
+from repository import Conflict, create_repository
+from rules import InvalidRoll, RuleError
+from stats import ALL_TIME, LEADERBOARD_SIZE
 
-app = Flask(__name__)
-api = Api(app)
+# held while a worker connects its storage backend
+CONNECT_LOCK = threading.Lock()
+
+# representations of a game, fields can only be selected from the full one
+GAME_VIEWS = ('full', 'totals', 'array')
+
+# fields of the full game representation that can be selected
+SELECTABLE_FIELDS = ('id', 'active', 'date_started', 'players',
+                     'players.player_id', 'players.name', 'players.active',
+                     'players.scoresheet', 'players.scoresheet.frame_results',
+                     'players.scoresheet.frame_scores',
+                     'players.scoresheet.total')
+
+# JSON responses smaller than this are not worth compressing
+GZIP_MIN_BYTES = 512
+
+# compact separators, the C encoder is kept as nothing is indented
+JSON_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+
+def games():
+    """
+    Storage backend of app handling request, connected on first use so
+    each worker process connects after it is forked
+    :return: GameRepository
+    """
+    config = current_app.config
+    if config['REPOSITORY'] is None:
+        with CONNECT_LOCK:
+            if config['REPOSITORY'] is None:
+                config['REPOSITORY'] = create_repository(
+                    config['STORAGE'], config['MONGO_DB'],
+                    config['PACK_ROLLS'], config['READ_PREFERENCE'],
+                    config['MAX_STALENESS'], **config['MONGO_SETTINGS'])
+    return config['REPOSITORY']
+
+
+def responses():
+    """
+    Rendered response cache of app handling request
+    :return: LRUCache
+    """
+    return current_app.config['RESPONSE_CACHE']
+
+
+def hub():
+    """
+    Game update hub of app handling request
+    :return: EventHub
+    """
+    return current_app.config['EVENT_HUB']
 
 
 ################################
@@ -25,44 +88,92 @@ class HomeRoute(Resource):
         message = "------------------ Start bowling! ------------------\n\n" + \
                   "How to use api:\n\n" + \
                   "GET '/' \t\t\t\t\t=> Status and usage\n" + \
-                  "GET '/games' \t\t\t\t=> List of all games\n" + \
+                  "GET '/games' \t\t\t\t=> List of games, paginated\n" + \
                   "POST '/games \t\t\t\t=> Create a new game\n" + \
+                  "POST '/games/bulk' \t\t\t=> Create many games\n" + \
+                  "GET '/games/export' \t\t\t=> Every game, NDJSON\n" + \
+                  "GET '/games/events' \t\t\t=> Stream all game updates\n" + \
                   "GET '/games/{game_id}' \t\t=> " \
                   "Retrieve specific game info\n" + \
+                  "GET '/games/{game_id}/events' \t=> Stream a game\n" + \
                   "PUT '/games/{game_id}' \t\t=> Send a bowl\n" + \
-                  "DELETE '/games/{game_id}' \t=> Inactivate game or player"
+                  "POST '/games/{game_id}/rolls' \t=> Send many bowls\n" + \
+                  "DELETE '/games/{game_id}' \t=> " \
+                  "Inactivate game or player\n" + \
+                  "GET '/stats?name={name}' \t\t=> Player statistics\n" + \
+                  "GET '/leaderboard' \t\t\t=> Top games, date for a day\n" + \
+                  "GET '/metrics' \t\t\t=> Prometheus metrics"
         return Response(message, status=200)
 
 
 class GamesRoute(Resource):
 
+    # number of games returned per page unless limit given
+    PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 500
+
     def get(self):
         """
-        GET method for querying all games
-        :return: List of all games in database
+        GET method for querying games a page at a time, oldest first.  Query
+        string accepts limit, after (token from X-Next-Page header), active,
+        started_after/started_before (YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS) and
+        player (name of a player in the game)
+        :return: List of games in database matching filters
         """
         all_games = []
 
+        # parse paging and filter arguments
+        try:
+            limit = int(request.args.get('limit', self.PAGE_SIZE))
+        except ValueError:
+            return bad_request("Limit not a valid integer")
+        if not (0 < limit <= self.MAX_PAGE_SIZE):
+            return bad_request("Limit must be integer between 1 - " +
+                               str(self.MAX_PAGE_SIZE))
+
+        filters = {}
+        try:
+            if 'after' in request.args:
+                filters['after'] = decode_cursor(request.args['after'])
+            if 'active' in request.args:
+                filters['active'] = parse_bool(request.args['active'])
+            if 'started_after' in request.args:
+                filters['started_after'] = \
+                    parse_date(request.args['started_after'])
+            if 'started_before' in request.args:
+                filters['started_before'] = \
+                    parse_date(request.args['started_before'])
+            if 'player' in request.args:
+                filters['player'] = request.args['player']
+        except ValueError as exception:
+            return bad_request(exception)
+
         # grab essential info about each game
         try:
-            for game in Game.games:
-                players = []
+            # one extra to detect a following page
+            last_id, more = None, False
+            for game in games().list_games(limit + 1, **filters):
+                if len(all_games) == limit:
+                    more = True
+                    break
 
                 # build each game's information map
-                game_info = {
+                summary = {
                     "game_id": str(game.id),
-                    "active": game.active
+                    "active": game.active,
+                    "players": [player.name for player in game.players],
+                    "totals": [player.total for player in game.players]
                 }
+                all_games.append(summary)
+                last_id = game.id
 
-                # get each player's name
-                for player in game.players:
-                    players.append(player.name)
-                game_info["players"] = players
+            # point to next page if more games remain
+            headers = {}
+            if more:
+                headers['X-Next-Page'] = encode_cursor(last_id)
 
-                all_games.append(game_info)
-
-            # return list of all games
-            return all_games
+            # return page of games
+            return all_games, 200, headers
 
         # any processing errors notify user
         except Exception as exception:
@@ -75,19 +186,13 @@ class GamesRoute(Resource):
         """
         # try to parse the json request
         try:
-            new_players = json.loads(request.data)
-
-            if not (0 < len(new_players) < 5):
-                return bad_request("Invalid number of players")
-
-            # build each new player
-            players = []
-            for num, name in enumerate(new_players):
-                players.append(Player(player_id=(num + 1), name=name))
+            players = new_players(json.loads(request.data))
+        except (ValueError, ValidationError) as exception:
+            return bad_request(exception)
 
+        try:
             # build a new game
-            game = Game(players=players)
-            new_game = game.save()
+            new_game = games().create_game(players)
             game_id = str(new_game.id)
 
             # return newly created game ID to user
@@ -103,43 +208,140 @@ class GamesRoute(Resource):
             return server_issue(exception, "POST AllGames")
 
 
+class BulkGamesRoute(Resource):
+
+    # most games created at once
+    MAX_GAMES = 100
+
+    def post(self):
+        """
+        POST method for creating many games at once from a JSON list of
+        player lists, each list is created or reported on separately
+        :return: game id or error for each game in order
+        """
+        # try to parse the json request
+        try:
+            player_lists = json.loads(request.data)
+        except ValueError:
+            return bad_request("Games must be a JSON list of player lists")
+        if type(player_lists) != list or \
+                not (0 < len(player_lists) <= self.MAX_GAMES):
+            return bad_request("Games must be a list of 1 - " +
+                               str(self.MAX_GAMES) + " player lists")
+
+        # check each game, None marks games to create
+        results, valid = [], []
+        for names in player_lists:
+            try:
+                valid.append(new_players(names))
+                results.append(None)
+            except (ValueError, ValidationError) as exception:
+                results.append({"error": str(exception)})
+
+        try:
+            # create valid games with one write, games or write errors
+            # come back in order
+            created = iter(games().create_games(valid) if valid else [])
+            count = 0
+            for num, result in enumerate(results):
+                if result is None:
+                    game = next(created)
+                    if isinstance(game, basestring):
+                        results[num] = {"error": game}
+                    else:
+                        results[num] = {"gameID": str(game.id)}
+                        count += 1
+
+            # return new game IDs and errors to user
+            message = {
+                "games": results,
+                "message": str(count) + " new games created."
+            }
+            return Response(json.dumps(message),
+                            status=201 if count else 400,
+                            mimetype='application/json')
+
+        # any processing errors notify user
+        except Exception as exception:
+            return server_issue(exception, "POST BulkGames")
+
+
+class ExportRoute(Resource):
+
+    def get(self):
+        """
+        GET endpoint streaming games oldest first as one JSON line each,
+        with rolls and scoresheets, gzipped if user accepts it.  The
+        following query string options are supported:
+            after: only games after this game id, to resume an export
+            since: only games started at or after this date
+        :return: NDJSON response
+        """
+        try:
+            after = request.args.get('after')
+            if after is not None:
+                after = parse_game_id(after)
+            since = request.args.get('since')
+            if since is not None:
+                since = parse_date(since)
+        except ValueError as exception:
+            return bad_request(exception)
+
+        chunks = export_lines(games().export_games(after, since))
+        headers = {'Vary': 'Accept-Encoding'}
+        if accepts_gzip():
+            chunks = gzip_chunks(chunks)
+            headers['Content-Encoding'] = 'gzip'
+        return Response(chunks, status=200, mimetype='application/x-ndjson',
+                        headers=headers)
+
+
 class GameRoute(Resource):
 
     def get(self, game_id):
         """
-        GET method for retrieving a single game's info
+        GET method for retrieving a single game's info, answers 304 if the
+        game's revision matches the If-None-Match ETag.  Query string
+        accepts view (full, totals or array) and fields (comma separated
+        dotted names of full view fields)
         :param game_id: id to query db on
-        :return: full game information
+        :return: game information in the view asked for
         """
         try:
-            # check if id valid and query for it
-            check = self.__query_game_id(game_id)
-            if type(check) != Game:
-                return check
-            else:
-                game = check
-
-            # build game info object
-            game_info = {
-                "id": str(game.id),
-                "active": game.active,
-                "date_started": str(game.date_started)
-            }
+            view, fields = parse_view(request.args)
+        except ValueError as exception:
+            return bad_request(exception)
 
-            # build player info and scoresheet
-            all_players = []
-            for player in game.players:
-                player_info = {
-                    "player_id": player.player_id,
-                    "name": player.name,
-                    "active": player.active,
-                    "scoresheet": Player.calc_score_sheet(player.raw_scores)
-                }
-                all_players.append(player_info)
-            game_info["players"] = all_players
+        try:
+            # check if valid object id
+            if len(game_id) != 24:
+                return bad_request("Invalid game id")
+            game_id = ObjectId(game_id)
+
+            # user saw a later revision than a lagging secondary has, such
+            # as their own write, so read from primary
+            revision = games().revision(game_id)
+            latest = seen_revision() > revision
+            if latest:
+                revision = games().revision(game_id, latest)
+
+            # only revision is read if user already has this version, weak
+            # tags match too as a revision only tells content apart
+            if request.if_none_match.contains_weak(str(revision)):
+                return not_modified(revision)
+
+            # render game unless this revision was rendered already
+            key = rendered_key(game_id, revision, view, fields)
+            body = responses().get(key)
+            if body is None:
+                game = games().get_game(game_id, latest)
+                key = rendered_key(game_id, game.revision, view, fields)
+                revision, body = game.revision, render_game(game, view, fields)
+            return game_response(revision, body, key)
 
-            # return game info to user
-            return game_info
+        # if query throws non-existent error then inform user
+        except DoesNotExist:
+            return not_found("Game ID can not be found")
 
         # any processing errors notify user
         except Exception as exception:
@@ -149,171 +351,633 @@ class GameRoute(Resource):
         """
         PUT endpoint for sending a new bowling roll
         :param game_id: game to update with a score
-        :return: GET endpoint
+        :return: updated game information
         """
+        # validate roll value
         try:
-            # check if game good
-            check = self.__query_game_id(game_id)
-            if type(check) != Game:
-                return check
-            else:
-                game = check
-
-            # check if game active
-            if not game.active:
-                return bad_request("Game is no longer active")
-
-            # validate roll value
             score = int(request.data)
-            if not (0 <= score <= 10):
-                return bad_request("Roll must be integer between 0 - 10")
+        except ValueError:
+            return bad_request("Roll must be integer between 0 - 10")
 
-            # assign roll to next valid player
-            max_scores_len = 22
-            for player in game.players:
+        try:
+            # check if valid object id
+            if len(game_id) != 24:
+                return bad_request("Invalid game id")
 
-                # if player is inactive then skip
-                if not player.active:
-                    continue
+            # apply roll atomically and return updated game to user
+            game = games().push_roll(ObjectId(game_id), score)
+            return updated_response(game)
 
-                # check if player's next roll (players are sorted)
-                if len(player.raw_scores) < max_scores_len:
-                    max_scores_len = len(player.raw_scores)
-                    player_id = player.player_id
-                    scores = player.raw_scores
+        # if query throws non-existent error then inform user
+        except DoesNotExist:
+            return not_found("Game ID can not be found")
 
-                if len(player.raw_scores) % 2 == 1:
-                    break
+        # roll breaks the rules of the game
+        except RuleError as exception:
+            return bad_request(exception)
 
-            # check if second roll too high
-            if len(scores) < 19 and len(scores) % 2 == 1 and scores[-1] + score > 10:
-                return bad_request("Second roll is too high")
+        # game kept changing while trying to update
+        except Conflict as exception:
+            return conflict(exception)
 
-            # if roll is a 10 then add 0 too unless end frame
-            if score == 10 and len(scores) < 18:
-                scores += [score, 0]
-            else:
-                scores.append(score)
+        # let user know of any internal error
+        except Exception as exception:
+            return server_issue(exception, "PUT Games")
+
+    def delete(self, game_id):
+        """
+        DELETE endpoint for ending a game early, or a player's game if body
+        holds their player id
+        :param game_id: game to inactivate
+        :return: updated game information
+        """
+        # parse player id to an int, no player inactivates game
+        player_id = None
+        if request.data is not None and len(request.data) > 0:
+            try:
+                player_id = int(request.data)
+            except ValueError:
+                return bad_request("Player ID not a valid integer")
+
+        try:
+            # check if valid object id
+            if len(game_id) != 24:
+                return bad_request("Invalid game id")
 
-            # update raw scores for player
-            game.players[player_id - 1].raw_scores = scores
+            # inactivate atomically and return game info to user
+            game = games().deactivate(ObjectId(game_id), player_id)
+            return updated_response(game)
 
-            # check if player still active
-            player_active = len(scores) < 20 \
-                or (sum(scores[18:]) > 10 and len(scores) < 21)
-            if not player_active:
-                game.players[player_id - 1].active = False
+        # if query throws non-existent error then inform user
+        except DoesNotExist:
+            return not_found("Game ID can not be found")
 
-            # check if game still active
-            if len(game.players) == player_id and not player_active:
-                game.active = False
+        # game or player already inactive
+        except RuleError as exception:
+            return bad_request(exception)
 
-            # save updates and return updates to user
-            game.save()
-            return self.get(game_id)
+        # game kept changing while trying to update
+        except Conflict as exception:
+            return conflict(exception)
 
         # let user know of any internal error
         except Exception as exception:
-            return server_issue(exception, "PUT Games")
+            return server_issue(exception, "DELETE Games")
 
-    def delete(self, game_id):
+
+class RollsRoute(Resource):
+
+    # most rolls accepted at once, a full game of four players
+    MAX_ROLLS = 4 * 21
+
+    def post(self, game_id):
         """
-        DELETE endpoint for ending a game early
-        :param game_id:
-        :return:
+        POST endpoint for sending many rolls at once, in order, with a JSON
+        list of integers.  Rolls are all applied or, if one is invalid, none
+        :param game_id: game to update with scores
+        :return: updated game information
         """
-        game_active = False
-
+        # parse list of rolls
         try:
-            # check if id valid and query for it
-            check = self.__query_game_id(game_id)
-            if type(check) != Game:
-                return check
-            else:
-                game = check
-
-            # if game already inactive return bad request
-            if not game.active:
-                return bad_request("Game already inactive")
-
-            # if not trying to inactive player inactivate game
-            if request.data is None or len(request.data) < 1:
-                game.update(active=False)
-                return self.get(game_id)
-
-            # parse player id to an int
-            player_id = int(request.data)
-
-            # check if valid player id
-            if not (0 < player_id < len(game.players) + 1):
-                return bad_request("Player ID outside integer range")
-
-            # inactive player matching id unless already inactive
-            for player in game.players:
-                player_active = player.active
-
-                # if player id matches and active then update
-                if player.player_id == player_id and player_active:
-                    player_active = False
-                    game.players[player_id - 1].active = player_active
-
-                # if player id matches then player already inactive
-                elif player.player_id == player_id:
-                    return bad_request("Player already inactive")
-
-                # check if any active players remain
-                if player_active:
-                    game_active = True
-
-            # update game status too
-            game.active = game_active
-
-            # save updates and return game info to user
-            game.save()
-            return self.get(game_id)
-
-        # error parsing player id to an int
+            scores = json.loads(request.data)
         except ValueError:
-            return bad_request("Player ID not a valid integer")
+            return bad_request("Rolls must be a JSON list of integers")
+        if type(scores) != list or not (0 < len(scores) <= self.MAX_ROLLS):
+            return bad_request("Rolls must be a list of 1 - " +
+                               str(self.MAX_ROLLS) + " integers")
+
+        try:
+            # check if valid object id
+            if len(game_id) != 24:
+                return bad_request("Invalid game id")
+
+            # apply rolls with one write and return updated game to user
+            game = games().push_rolls(ObjectId(game_id), scores)
+            return updated_response(game)
+
+        # if query throws non-existent error then inform user
+        except DoesNotExist:
+            return not_found("Game ID can not be found")
+
+        # let user know which roll broke the rules, none were applied
+        except InvalidRoll as exception:
+            message = {
+                "index": exception.index,
+                "message": str(exception)
+            }
+            return Response(json.dumps(message), status=400,
+                            mimetype='application/json')
+
+        # game kept changing while trying to update
+        except Conflict as exception:
+            return conflict(exception)
 
         # let user know of any internal error
         except Exception as exception:
-            return server_issue(exception, "DELETE Games")
+            return server_issue(exception, "POST Rolls")
+
+
+class GameEventsRoute(Resource):
 
-    def __query_game_id(self, game_id):
+    def get(self, game_id):
         """
-        Method that checks if game id is valid and queries for it
-        :param game_id:
-        :return:
+        GET endpoint streaming a game's updates as server-sent events, the
+        current game is sent first and the stream ends once the game does
+        :param game_id: game to follow
+        :return: event stream response
         """
         try:
             # check if valid object id
             if len(game_id) != 24:
                 return bad_request("Invalid game id")
+            game_id = ObjectId(game_id)
 
-            # try to query for game id and convert to python object
-            game = Game.games.get(id=ObjectId(game_id))
-            return game
+            # subscribe before reading latest game so no update is missed
+            subscription = hub().subscribe(str(game_id))
+            try:
+                game = games().get_game(game_id, latest=True)
+            except Exception:
+                hub().unsubscribe(subscription)
+                raise
+            return event_stream(subscription, game_event(game))
 
         # if query throws non-existent error then inform user
         except DoesNotExist:
             return not_found("Game ID can not be found")
 
+        # any processing errors notify user
+        except Exception as exception:
+            return server_issue(exception, "GET Game Events")
+
+
+class AllEventsRoute(Resource):
+
+    def get(self):
+        """
+        GET endpoint streaming every game's updates as server-sent events,
+        including the update ending each game
+        :return: event stream response
+        """
+        return event_stream(hub().subscribe(ALL_GAMES))
+
+
+class StatsRoute(Resource):
+
+    def get(self):
+        """
+        GET method for a player's statistics over their ended games, name
+        given in query string
+        :return: games, average, high game, strike and spare rates
+        """
+        name = request.args.get('name')
+        if not name:
+            return bad_request("Player name required")
+
+        try:
+            stats = games().stats.player(name)
+            if stats is None:
+                return not_found("No games found for player")
+            return stats
+
+        # any processing errors notify user
+        except Exception as exception:
+            return server_issue(exception, "GET Stats")
+
+
+class LeaderboardRoute(Resource):
+
+    def get(self):
+        """
+        GET method for highest complete games of all time, or of the day
+        given as date (YYYY-MM-DD) in query string
+        :return: list of top games, highest first
+        """
+        day = request.args.get('date', ALL_TIME)
+        if day != ALL_TIME:
+            try:
+                day = parse_date(day).strftime('%Y-%m-%d')
+            except ValueError as exception:
+                return bad_request(exception)
+        try:
+            limit = int(request.args.get('limit', LEADERBOARD_SIZE))
+        except ValueError:
+            return bad_request("Limit not a valid integer")
+        if not (0 < limit <= LEADERBOARD_SIZE):
+            return bad_request("Limit must be integer between 1 - " +
+                               str(LEADERBOARD_SIZE))
+
+        try:
+            return games().stats.leaderboard(day)[:limit]
+
+        # any processing errors notify user
+        except Exception as exception:
+            return server_issue(exception, "GET Leaderboard")
+
+
+class MetricsRoute(Resource):
+
+    def get(self):
+        """
+        GET endpoint for scraping this process's metrics
+        :return: Prometheus text format metrics
+        """
+        return Response(REGISTRY.render(), status=200,
+                        mimetype='text/plain; version=0.0.4')
+
 
 ################################
-# Add endpoints to API
+# Response helpers
 ################################
 
-api.add_resource(HomeRoute, '/')
-api.add_resource(GamesRoute, '/games')
-api.add_resource(GameRoute, '/games/<game_id>')
+def new_players(names):
+    """
+    Builds players for a new game from their names, 1 - 4 players
+
+    :param names: list of player names
+    :return: list of Player objects
+    """
+    if type(names) != list or not (0 < len(names) < 5):
+        raise ValueError("Invalid number of players")
+
+    # build each new player
+    players = []
+    for num, name in enumerate(names):
+        player = Player(player_id=(num + 1), name=name)
+        player.validate()
+        players.append(player)
+    return players
+
+
+def game_info(game):
+    """
+    Builds the full game information returned to user
+
+    :param game: GameView
+    :return: game info map
+    """
+    # build game info object
+    info = {
+        "id": str(game.id),
+        "active": game.active,
+        "date_started": str(game.date_started)
+    }
+
+    # build player info and scoresheet
+    all_players = []
+    for player in game.players:
+        player_info = {
+            "player_id": player.player_id,
+            "name": player.name,
+            "active": player.active,
+            "scoresheet": player.score_sheet()
+        }
+        all_players.append(player_info)
+    info["players"] = all_players
+
+    return info
+
+
+def game_totals(game):
+    """
+    Builds the totals only game information shown on lane displays
+
+    :param game: GameView
+    :return: game totals map
+    """
+    return {
+        "id": str(game.id),
+        "active": game.active,
+        "players": [player.name for player in game.players],
+        "totals": [player.score_sheet()["total"] for player in game.players]
+    }
+
+
+def game_array(game):
+    """
+    Builds game information as nested lists, values in the order of the
+    full view: id, active, date_started and players, each player being
+    player_id, name, active, frame_results, frame_scores and total
+
+    :param game: GameView
+    :return: game info list
+    """
+    all_players = []
+    for player in game.players:
+        sheet = player.score_sheet()
+        all_players.append([player.player_id, player.name, player.active,
+                            sheet["frame_results"], sheet["frame_scores"],
+                            sheet["total"]])
+    return [str(game.id), game.active, str(game.date_started), all_players]
+
+
+def select_fields(value, fields):
+    """
+    Keeps selected fields of game information, a list keeps them from each
+    of its maps
+
+    :param value: map or list of maps
+    :param fields: list of dotted field names
+    :return: map or list of maps with only selected fields
+    """
+    if type(value) == list:
+        return [select_fields(item, fields) for item in value]
+
+    # None marks a field kept whole
+    nested = {}
+    for field in fields:
+        name, _, rest = field.partition('.')
+        if not rest:
+            nested[name] = None
+        elif nested.get(name, ()) is not None:
+            nested.setdefault(name, []).append(rest)
+    return dict((name, value[name] if rest is None
+                 else select_fields(value[name], rest))
+                for name, rest in nested.items())
+
+
+def rendered_key(game_id, revision, view='full', fields=None):
+    """
+    :return: response cache key of a game revision rendered in a view
+    """
+    return game_id, revision, view, fields
+
+
+def render_game(game, view='full', fields=None):
+    """
+    Renders game information to JSON, kept in the response cache so the
+    same revision is only rendered once per view
+
+    :param game: GameView
+    :param view: full, totals or array
+    :param fields: tuple of full view fields selected, None for all
+    :return: JSON string
+    """
+    key = rendered_key(game.id, game.revision, view, fields)
+    body = responses().get(key)
+    if body is None:
+        if view == 'totals':
+            info = game_totals(game)
+        elif view == 'array':
+            info = game_array(game)
+        else:
+            info = game_info(game)
+            if fields:
+                info = select_fields(info, fields)
+        body = JSON_ENCODER.encode(info)
+        responses().put(key, body)
+    return body
+
+
+def game_response(revision, body, key=None):
+    """
+    Response with rendered game information tagged with its revision
+
+    :param revision: game revision
+    :param body: rendered JSON string
+    :param key: response cache key of body
+    :return: 200 response
+    """
+    response = json_response(body, key=key)
+    # weak as views, fields and gzip of a revision all share its tag
+    response.set_etag(str(revision), weak=True)
+    return response
+
+
+def json_response(body, status=200, headers=None, key=None):
+    """
+    JSON response, gzipped if user accepts it and body is big enough to be
+    worth compressing
+
+    :param body: rendered JSON string
+    :param status: status code
+    :param headers: map of extra headers
+    :param key: response cache key of body, compressed body is cached too
+    :return: response
+    """
+    headers = dict(headers or {}, Vary='Accept-Encoding')
+    if len(body) >= GZIP_MIN_BYTES and accepts_gzip():
+        compressed = responses().get(key + ('gzip',)) if key else None
+        if compressed is None:
+            compressed = ''.join(gzip_chunks([body]))
+            if key:
+                responses().put(key + ('gzip',), compressed)
+        body = compressed
+        headers['Content-Encoding'] = 'gzip'
+    return Response(body, status=status, mimetype='application/json',
+                    headers=headers)
+
+
+def output_json(data, code, headers=None):
+    """
+    Renders data returned by resources with the compact encoder
+
+    :param data: value to encode
+    :param code: status code
+    :param headers: map of extra headers
+    :return: response
+    """
+    return json_response(JSON_ENCODER.encode(data), code, headers)
+
+
+def updated_response(game):
+    """
+    Renders a changed game once, publishing it to event stream subscribers
+    and returning it to user
+
+    :param game: updated GameView
+    :return: 200 response
+    """
+    event = game_event(game)
+    hub().publish(event)
+    return game_response(event.revision, event.body,
+                         rendered_key(game.id, game.revision))
+
+
+def game_event(game):
+    """
+    :param game: GameView
+    :return: Event holding rendered game
+    """
+    return Event(str(game.id), game.revision, game.active, render_game(game))
+
+
+def event_stream(subscription, first=None):
+    """
+    Streams updates from a subscription as server-sent events until the
+    user disconnects, the subscriber is dropped for falling behind or a
+    followed game ends
+
+    :param subscription: Subscription to stream
+    :param first: Event sent before any updates
+    :return: event stream response
+    """
+    events = hub()
+    follows_game = subscription.topic != ALL_GAMES
+
+    def stream():
+        try:
+            # open the stream straight away, updates may be a while
+            yield ": connected\n\n"
+
+            revision = -1
+            if first is not None:
+                revision = first.revision
+                yield sse_message(first)
+                if follows_game and not first.active:
+                    return
+
+            while True:
+                event = subscription.get()
+                if event is None:
+                    if subscription.dropped:
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+
+                # skip updates already included in first event
+                if follows_game and event.revision <= revision:
+                    continue
+                yield sse_message(event)
+                if follows_game and not event.active:
+                    return
+        finally:
+            events.unsubscribe(subscription)
+
+    return Response(stream(), status=200, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+def not_modified(revision):
+    """
+    Response if user already has the current revision of a game
+
+    :param revision: game revision
+    :return: 304 response
+    """
+    response = Response(status=304)
+    response.set_etag(str(revision), weak=True)
+    return response
+
+
+################################
+# Query string helpers
+################################
+
+def encode_cursor(game_id):
+    """
+    Builds an opaque page token from the last game id of a page
+
+    :param game_id: ObjectId of last game returned
+    :return: url safe token string
+    """
+    return urlsafe_b64encode(game_id.binary)
+
+
+def decode_cursor(token):
+    """
+    Converts a page token back to the game id it was built from
+
+    :param token: url safe token string
+    :return: ObjectId
+    """
+    try:
+        return ObjectId(urlsafe_b64decode(str(token)))
+    except Exception:
+        raise ValueError("Invalid page token")
+
+
+def parse_game_id(value):
+    """
+    Parses a game id query string value
+
+    :param value: 24 character hex string
+    :return: ObjectId
+    """
+    try:
+        return ObjectId(value)
+    except Exception:
+        raise ValueError("Invalid game id")
+
+
+def parse_view(args):
+    """
+    Parses the game representation asked for in the query string
+
+    :param args: query string arguments
+    :return: view name, tuple of selected fields or None for all
+    """
+    view = args.get('view', 'full')
+    if view not in GAME_VIEWS:
+        raise ValueError("View must be one of " + ", ".join(GAME_VIEWS))
+    if 'fields' not in args:
+        return view, None
+    if view != 'full':
+        raise ValueError("Fields can only be selected from the full view")
+
+    fields = set(field.strip() for field in args['fields'].split(','))
+    fields.discard('')
+    if not fields:
+        raise ValueError("No fields selected")
+    for field in fields:
+        if field not in SELECTABLE_FIELDS:
+            raise ValueError("Unknown field " + field)
+    return view, tuple(sorted(fields))
+
+
+def accepts_gzip():
+    """
+    :return: True if user accepts gzip encoded responses
+    """
+    return request.accept_encodings.quality('gzip') > 0
+
+
+def seen_revision():
+    """
+    Latest game revision user has, from the If-None-Match ETags
+
+    :return: revision number, -1 if none
+    """
+    revisions = [-1]
+    # weak tags are given without their W/ prefix
+    for etag in request.if_none_match.as_set(include_weak=True):
+        if etag.isdigit():
+            revisions.append(int(etag))
+    return max(revisions)
+
+
+def parse_bool(value):
+    """
+    Parses a true/false query string value
+
+    :param value: string value
+    :return: boolean
+    """
+    if value.lower() in ('true', '1'):
+        return True
+    if value.lower() in ('false', '0'):
+        return False
+    raise ValueError("Boolean must be true or false")
+
+
+def parse_date(value):
+    """
+    Parses a date or date time query string value
+
+    :param value: YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS string
+    :return: datetime
+    """
+    for date_format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    raise ValueError("Date must be YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS")
 
 
 ################################
 # Add custom error messages
 ################################
 
-@app.errorhandler(400)
 def bad_request(error=None):
     """
     Response if there is a bad request from user
@@ -325,7 +989,6 @@ def bad_request(error=None):
     return Response(message, status=400)
 
 
-@app.errorhandler(404)
 def not_found(error=None):
     """
     Reponse if a resource is not found in database or in a route
@@ -339,7 +1002,17 @@ def not_found(error=None):
     return Response(message, status=404)
 
 
-@app.errorhandler(500)
+def conflict(error=None):
+    """
+    Response if a resource changed too often to apply a request
+
+    :param error: string message
+    :return: 409 response
+    """
+    message = "Conflict: " + str(error)
+    return Response(message, status=409)
+
+
 def server_issue(exception, error=None):
     """
     Response if there was an issue processing a request
@@ -359,6 +1032,108 @@ def server_issue(exception, error=None):
     return Response(message, status=500)
 
 
+################################
+# Request metrics
+################################
+
+def start_request():
+    """
+    Notes when a request started and counts its database operations
+    """
+    g.started = default_timer()
+    start_counting(current_app.config['MONGO_BYTES_SAMPLE'])
+
+
+def record_request(response):
+    """
+    Records a request's latency, status and database operations and bytes
+    under its route pattern
+
+    :param response: response to user
+    :return: same response
+    """
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = (route, request.method)
+    started = getattr(g, 'started', None)
+    if started is not None:
+        REQUEST_SECONDS.observe(labels, default_timer() - started)
+    REQUESTS.inc(labels + (str(response.status_code),))
+
+    operations, sent = stop_counting()
+    if operations is not None:
+        REQUEST_MONGO_OPERATIONS.observe(labels, operations)
+    if sent is not None:
+        REQUEST_MONGO_BYTES.observe(labels, sent)
+    return response
+
+
+################################
+# App factory
+################################
+
+def create_app(config=None):
+    """
+    Builds the app, storage is only connected once a request needs it so
+    an app built before a server forks workers is safe to use in each
+
+    :param config: map of config values overriding environment settings
+    :return: Flask app
+    """
+    app = Flask(__name__)
+    app.config.update(app_config())
+    if config:
+        app.config.update(config)
+
+    # storage backend, built by games() on first use
+    app.config['REPOSITORY'] = None
+
+    # rendered game responses kept by game id and revision
+    app.config['RESPONSE_CACHE'] = LRUCache(
+        app.config['RESPONSE_CACHE_SIZE'])
+
+    # game updates fanned out to event stream subscribers
+    app.config['EVENT_HUB'] = EventHub()
+
+    # add endpoints to API
+    api = Api(app)
+    api.representations['application/json'] = output_json
+    api.add_resource(HomeRoute, '/')
+    api.add_resource(GamesRoute, '/games')
+    api.add_resource(BulkGamesRoute, '/games/bulk')
+    api.add_resource(AllEventsRoute, '/games/events')
+    api.add_resource(ExportRoute, '/games/export')
+    api.add_resource(GameRoute, '/games/<game_id>')
+    api.add_resource(RollsRoute, '/games/<game_id>/rolls')
+    api.add_resource(GameEventsRoute, '/games/<game_id>/events')
+    api.add_resource(StatsRoute, '/stats')
+    api.add_resource(LeaderboardRoute, '/leaderboard')
+    api.add_resource(MetricsRoute, '/metrics')
+
+    # time every request for /metrics
+    app.before_request(start_request)
+    app.after_request(record_request)
+
+    # profile a sample of requests if a profile directory is given
+    if app.config['PROFILE_DIR']:
+        profiler = RequestProfiler(app.config['PROFILE_DIR'],
+                                   app.config['PROFILE_SAMPLE'],
+                                   token=app.config['PROFILE_TOKEN'],
+                                   max_bytes=app.config['PROFILE_MAX_BYTES'])
+        app.before_request(profiler.start)
+        app.after_request(profiler.finish)
+        app.teardown_request(profiler.abandon)
+
+    # add custom error messages
+    app.register_error_handler(400, bad_request)
+    app.register_error_handler(404, not_found)
+    app.register_error_handler(409, conflict)
+    app.register_error_handler(500, server_issue)
+    return app
+
+
+app = create_app()
+
+
 ################################
 # Start app
 ################################
@@ -366,5 +1141,6 @@ def server_issue(exception, error=None):
 if __name__ == '__main__':
     app.run(
         debug=True,
-        host='0.0.0.0'
+        host='0.0.0.0',
+        threaded=True
     )
@@ -0,0 +1,512 @@
+"""
+Benchmarks for the scoring engine, roll rules and HTTP endpoints
+
+Games are generated from a fixed seed so every run times the same work.
+Results can be saved as JSON and compared with a previous run, changes
+beyond a threshold are reported as regressions.
+
+Usage: python app/bench.py [--quick] [--output FILE] [--compare FILE]
+"""
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+from copy import deepcopy
+from datetime import datetime
+from timeit import default_timer
+
+from api import create_app
+from datastore import Game, Player
+from repository import roll_changes
+from rules import FRAMES, apply_rolls
+from vectorized import numpy, roll_array, score_batch
+
+
+# seed games are generated from unless one is given
+SEED = 2016
+
+# games per corpus and timed rounds per benchmark, full and quick runs
+SIZES = {
+    'full': {'games': 1000, 'repeat': 7},
+    'quick': {'games': 100, 'repeat': 3}
+}
+
+# relative change in median time reported as a regression or improvement
+THRESHOLD = 0.1
+
+
+################################
+# Game generation
+################################
+
+def bowled_frames(rand):
+    """
+    Random complete game as bowled, one list of rolls per frame
+
+    :param rand: random.Random to draw from
+    :return: list of frames
+    """
+    frames = []
+    for frame in range(FRAMES - 1):
+        first = rand.randint(0, 10)
+        if first == 10:
+            frames.append([first])
+        else:
+            frames.append([first, rand.randint(0, 10 - first)])
+
+    # last frame, pins reset after a strike or spare for fill rolls
+    first = rand.randint(0, 10)
+    if first == 10:
+        second = rand.randint(0, 10)
+        fill = rand.randint(0, 10 if second == 10 else 10 - second)
+        frames.append([first, second, fill])
+    else:
+        second = rand.randint(0, 10 - first)
+        if first + second == 10:
+            frames.append([first, second, rand.randint(0, 10)])
+        else:
+            frames.append([first, second])
+    return frames
+
+
+def raw_scores(frames, rolls=None):
+    """
+    Converts bowled frames to the raw_scores layout, strikes before the
+    last frame padded with a 0
+
+    :param frames: list of frames as bowled
+    :param rolls: only include this many bowled rolls
+    :return: list of scores
+    """
+    scores = []
+    for number, frame in enumerate(frames):
+        for roll, score in enumerate(frame):
+            if rolls is not None:
+                if rolls == 0:
+                    return scores
+                rolls -= 1
+            scores.append(score)
+            if roll == 0 and score == 10 and number < FRAMES - 1:
+                scores.append(0)
+    return scores
+
+
+def corpora(rand, size):
+    """
+    Games to score, each a list of raw scores
+
+    :param rand: random.Random to draw from
+    :param size: games per corpus
+    :return: map of corpus name to list of games
+    """
+    strikes = [10, 0] * (FRAMES - 1) + [10, 10, 10]
+    spares = [5, 5] * FRAMES + [5]
+
+    partial = []
+    for _ in range(size):
+        frames = bowled_frames(rand)
+        bowled = sum(len(frame) for frame in frames)
+        partial.append(raw_scores(frames, rand.randint(0, bowled - 1)))
+
+    return {
+        'all_strikes': [strikes] * size,
+        'all_spares': [spares] * size,
+        'random': [raw_scores(bowled_frames(rand)) for _ in range(size)],
+        'partial': partial
+    }
+
+
+def roll_order(players_frames):
+    """
+    Rolls of a game in the order they are bowled, each frame taken in
+    turn by every player
+
+    :param players_frames: list of each player's bowled frames
+    :return: list of rolls
+    """
+    rolls = []
+    for frame in range(FRAMES):
+        for frames in players_frames:
+            rolls.extend(frames[frame])
+    return rolls
+
+
+def new_game(players):
+    """
+    :param players: number of players
+    :return: raw document of a new game
+    """
+    players = [Player(player_id=number + 1, name="Bowler %d" % number)
+               for number in range(players)]
+    return Game(players=players).to_mongo().to_dict()
+
+
+################################
+# Timing
+################################
+
+def measure(run, number, repeat, setup=None):
+    """
+    Times a function over several rounds with garbage collection off,
+    like timeit
+
+    :param run: function timed, given the result of setup
+    :param number: operations performed by each call of run
+    :param repeat: rounds to time
+    :param setup: untimed function run before each round
+    :return: result map, times in microseconds per operation
+    """
+    times = []
+    for _ in range(repeat):
+        state = setup() if setup else None
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            start = default_timer()
+            run(state)
+            elapsed = default_timer() - start
+        finally:
+            if collecting:
+                gc.enable()
+        times.append(elapsed * 1e6 / number)
+
+    times.sort()
+    median = times[len(times) // 2]
+    return {
+        "number": number,
+        "repeat": repeat,
+        "min_us": round(times[0], 3),
+        "median_us": round(median, 3),
+        "max_us": round(times[-1], 3),
+        "ops_per_sec": round(1e6 / median, 1) if median else None
+    }
+
+
+################################
+# Benchmarks
+################################
+
+def bench_scoring(rand, size, repeat):
+    """
+    Scoresheets from whole lists of scores, and one roll added to a stored
+    scoresheet as a roll request does
+
+    :return: map of benchmark name to result
+    """
+    results = {}
+    for name, games in sorted(corpora(rand, size).items()):
+        def score(state, games=games):
+            for scores in games:
+                Player.calc_score_sheet(scores)
+
+        results['scoring.calc_score_sheet.' + name] = \
+            measure(score, len(games), repeat)
+
+        # whole corpus scored at once, only if NumPy is installed
+        if numpy is not None:
+            rolls = roll_array(games)
+            results['scoring.score_batch.' + name] = measure(
+                lambda state, rolls=rolls: score_batch(rolls), len(games),
+                repeat)
+
+    # players one roll from the end of a game with stored scoresheets
+    players = []
+    for _ in range(size):
+        scores = raw_scores(bowled_frames(rand))
+        player = {'raw_scores': scores[:-1]}
+        player.update(Player.score_fields(player))
+        player['raw_scores'] = scores
+        players.append((player, scores[-1:]))
+
+    def add_roll(state):
+        for player, rolls in players:
+            Player.score_fields(player, rolls)
+
+    results['scoring.add_roll'] = measure(add_roll, len(players), repeat)
+    return results
+
+
+def bench_rules(rand, size, repeat):
+    """
+    Turn selection and roll validation as in a roll request, alone and with
+    scoresheet updates, over four player games
+
+    :return: map of benchmark name to result
+    """
+    games = [roll_order([bowled_frames(rand) for _ in range(4)])
+             for _ in range(size)]
+    blank = new_game(4)
+    rolls = sum(len(scores) for scores in games)
+
+    def fresh():
+        return [deepcopy(blank) for _ in games]
+
+    def apply_all(documents):
+        for document, scores in zip(documents, games):
+            apply_rolls(document, scores)
+
+    def change_all(documents):
+        for document, scores in zip(documents, games):
+            for score in scores:
+                roll_changes(document, [score])
+
+    return {
+        'rules.apply_roll': measure(apply_all, rolls, repeat, fresh),
+        'rules.roll_changes': measure(change_all, rolls, repeat, fresh)
+    }
+
+
+def bench_http(rand, size, repeat):
+    """
+    Request latency through the test client for each route, against the
+    memory store
+
+    :return: map of benchmark name to result
+    """
+    app = create_app({'STORAGE': 'memory'})
+    client = app.test_client()
+    names = ["Bowler %d" % number for number in range(4)]
+    body = json.dumps(names)
+
+    def create(count):
+        return [json.loads(client.post('/games', data=body).data)["gameID"]
+                for _ in range(count)]
+
+    games = [roll_order([bowled_frames(rand) for _ in names])
+             for _ in range(size)]
+    results = {}
+
+    def home(state):
+        for _ in range(size):
+            client.get('/')
+
+    results['http.home.get'] = measure(home, size, repeat)
+
+    def post_games(state):
+        for _ in range(size):
+            client.post('/games', data=body)
+
+    results['http.games.post'] = measure(post_games, size, repeat)
+
+    bulk = json.dumps([names] * 100)
+
+    def post_bulk(state):
+        for _ in range(size // 100 or 1):
+            client.post('/games/bulk', data=bulk)
+
+    results['http.games_bulk.post'] = \
+        measure(post_bulk, size // 100 or 1, repeat)
+
+    # roll one roll at a time on a tenth of the games, then whole games
+    # at once
+    rolled = games[:size // 10 or 1]
+
+    def put_rolls(game_ids):
+        for game_id, scores in zip(game_ids, rolled):
+            for score in scores:
+                client.put('/games/' + game_id, data=str(score))
+
+    results['http.game.put'] = measure(
+        put_rolls, sum(len(scores) for scores in rolled), repeat,
+        lambda: create(len(rolled)))
+
+    def post_rolls(game_ids):
+        for game_id, scores in zip(game_ids, games):
+            client.post('/games/' + game_id + '/rolls',
+                        data=json.dumps(scores))
+
+    results['http.rolls.post'] = measure(post_rolls, size, repeat,
+                                         lambda: create(size))
+
+    # read finished games, rendered, cached and unchanged
+    finished = create(size)
+    post_rolls(finished)
+
+    def get_games(state):
+        for game_id in finished:
+            client.get('/games/' + game_id)
+
+    # each game was rolled on with one write
+    def get_unchanged(state):
+        for game_id in finished:
+            client.get('/games/' + game_id, headers={'If-None-Match': 'W/"1"'})
+
+    results['http.game.get'] = measure(get_games, size, repeat)
+    results['http.game.get_not_modified'] = \
+        measure(get_unchanged, size, repeat)
+
+    def list_games(state):
+        for _ in range(size // 10 or 1):
+            client.get('/games?limit=50')
+
+    results['http.games.get'] = measure(list_games, size // 10 or 1, repeat)
+
+    def delete_games(game_ids):
+        for game_id in game_ids:
+            client.delete('/games/' + game_id)
+
+    results['http.game.delete'] = measure(delete_games, size, repeat,
+                                          lambda: create(size))
+
+    def get_stats(state):
+        for number in range(size):
+            client.get('/stats?name=' + names[number % len(names)])
+
+    def get_leaderboard(state):
+        for _ in range(size):
+            client.get('/leaderboard')
+
+    results['http.stats.get'] = measure(get_stats, size, repeat)
+    results['http.leaderboard.get'] = measure(get_leaderboard, size, repeat)
+    return results
+
+
+BENCHMARKS = [bench_scoring, bench_rules, bench_http]
+
+
+def run(seed=SEED, size='full', only=None):
+    """
+    Runs benchmarks
+
+    :param seed: seed games are generated from
+    :param size: full or quick
+    :param only: only run benchmarks whose name starts with this
+    :return: run map with settings and results
+    """
+    settings = SIZES[size]
+    results = {}
+    for benchmark in BENCHMARKS:
+        # each group draws from its own generator so groups can run alone
+        rand = random.Random("%s-%s" % (seed, benchmark.__name__))
+        group = benchmark.__name__[len('bench_'):]
+        if only and not (group.startswith(only) or only.startswith(group)):
+            continue
+        for name, result in benchmark(rand, settings['games'],
+                                      settings['repeat']).items():
+            if not only or name.startswith(only):
+                results[name] = result
+
+    return {
+        "seed": seed,
+        "size": size,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+        "results": results
+    }
+
+
+################################
+# Reporting
+################################
+
+def compare(previous, current, threshold=THRESHOLD):
+    """
+    Compares median times of two runs
+
+    :param previous: earlier run map
+    :param current: later run map
+    :param threshold: relative change reported
+    :return: list of (name, previous us, current us, change, status)
+    """
+    rows = []
+    before, after = previous['results'], current['results']
+    for name in sorted(set(before) | set(after)):
+        if name not in after:
+            rows.append((name, before[name]['median_us'], None, None,
+                         'removed'))
+            continue
+        if name not in before:
+            rows.append((name, None, after[name]['median_us'], None, 'new'))
+            continue
+
+        old, new = before[name]['median_us'], after[name]['median_us']
+        change = (new - old) / old if old else 0.0
+        status = ''
+        if change > threshold:
+            status = 'REGRESSION'
+        elif change < -threshold:
+            status = 'improved'
+        rows.append((name, old, new, change, status))
+    return rows
+
+
+def print_results(current):
+    """
+    :param current: run map
+    """
+    print("%-40s %12s %12s %12s" % ("benchmark", "median us", "min us",
+                                    "ops/sec"))
+    for name, result in sorted(current['results'].items()):
+        print("%-40s %12.3f %12.3f %12s" % (
+            name, result['median_us'], result['min_us'],
+            result['ops_per_sec']))
+
+
+def print_comparison(rows):
+    """
+    :param rows: rows from compare
+    """
+    def cell(value, template):
+        return template % value if value is not None else '-'
+
+    print("%-40s %12s %12s %8s" % ("benchmark", "before us", "after us",
+                                   "change"))
+    for name, old, new, change, status in rows:
+        print("%-40s %12s %12s %8s %s" % (
+            name, cell(old, '%.3f'), cell(new, '%.3f'),
+            cell(change * 100 if change is not None else None, '%+.1f%%'),
+            status))
+
+
+################################
+# Command line
+################################
+
+def main():
+    """
+    Parses command line, runs benchmarks and reports results, exiting with
+    an error if compared run regressed
+    """
+    parser = argparse.ArgumentParser(
+        description="Bowling tracker benchmarks")
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--quick', action='store_true',
+                        help="smaller games corpora and fewer rounds")
+    parser.add_argument('--only', help="only benchmarks starting with this, "
+                                       "e.g. scoring or http.game")
+    parser.add_argument('--output', help="save results to this JSON file")
+    parser.add_argument('--compare', help="JSON results of a previous run")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help="relative change reported, default 0.1")
+    args = parser.parse_args()
+
+    current = run(args.seed, 'quick' if args.quick else 'full', args.only)
+    print_results(current)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(current, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)
+        if previous.get('seed') != current['seed'] \
+                or previous.get('size') != current['size']:
+            print("Warning: runs used different seeds or sizes")
+        if args.only:
+            previous['results'] = dict(
+                (name, result)
+                for name, result in previous['results'].items()
+                if name.startswith(args.only))
+        rows = compare(previous, current, args.threshold)
+        print("")
+        print_comparison(rows)
+        if any(row[4] == 'REGRESSION' for row in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
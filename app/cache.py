@@ -0,0 +1,42 @@
+"""
+In-process caching of rendered responses
+"""
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Thread safe map holding the most recently used entries, least recently
+    used entries are dropped once full
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: entry key
+        :return: cached value, None if not cached
+        """
+        with self.__lock:
+            value = self.__items.pop(key, None)
+            if value is not None:
+                self.__items[key] = value
+            return value
+
+    def put(self, key, value):
+        """
+        :param key: entry key
+        :param value: value to cache
+        """
+        with self.__lock:
+            self.__items.pop(key, None)
+            self.__items[key] = value
+            while len(self.__items) > self.size:
+                self.__items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.__items)
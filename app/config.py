@@ -0,0 +1,67 @@
+"""
+Settings read from environment variables
+"""
+import os
+
+from datastore import DATABASE
+
+
+# environment variable for each MongoDB client setting, times are in ms
+MONGO_ENVIRONMENT = {
+    'host': 'BOWLING_MONGO_HOST',
+    'maxPoolSize': 'BOWLING_MONGO_POOL_SIZE',
+    'minPoolSize': 'BOWLING_MONGO_MIN_POOL_SIZE',
+    'connectTimeoutMS': 'BOWLING_MONGO_CONNECT_TIMEOUT',
+    'socketTimeoutMS': 'BOWLING_MONGO_SOCKET_TIMEOUT',
+    'serverSelectionTimeoutMS': 'BOWLING_MONGO_SELECTION_TIMEOUT',
+    'waitQueueTimeoutMS': 'BOWLING_MONGO_WAIT_TIMEOUT'
+}
+
+
+def mongo_settings(environ=os.environ):
+    """
+    MongoDB client settings given in environment, unset ones are left to
+    the driver's defaults
+
+    :param environ: map of environment variables
+    :return: map of client keyword arguments
+    """
+    settings = {}
+    for setting, name in MONGO_ENVIRONMENT.items():
+        value = environ.get(name)
+        if not value:
+            continue
+        try:
+            settings[setting] = value if setting == 'host' else int(value)
+        except ValueError:
+            raise ValueError(name + " must be an integer")
+    return settings
+
+
+def app_config(environ=os.environ):
+    """
+    App settings given in environment
+
+    :param environ: map of environment variables
+    :return: map of Flask config values
+    """
+    return {
+        'STORAGE': environ.get('BOWLING_STORAGE', 'mongo'),
+        'MONGO_DB': environ.get('BOWLING_MONGO_DB', DATABASE),
+        'MONGO_SETTINGS': mongo_settings(environ),
+        'PACK_ROLLS': environ.get('BOWLING_PACK_ROLLS', '').lower()
+        in ('1', 'true'),
+        'READ_PREFERENCE': environ.get('BOWLING_READ_PREFERENCE',
+                                       'primary'),
+        'MAX_STALENESS': int(environ['BOWLING_MAX_STALENESS'])
+        if environ.get('BOWLING_MAX_STALENESS') else None,
+        'MONGO_BYTES_SAMPLE': int(environ.get('BOWLING_MONGO_BYTES_SAMPLE',
+                                              100)),
+        'RESPONSE_CACHE_SIZE': int(environ.get('BOWLING_RESPONSE_CACHE',
+                                               1024)),
+        'PROFILE_DIR': environ.get('BOWLING_PROFILE_DIR'),
+        'PROFILE_SAMPLE': int(environ.get('BOWLING_PROFILE_SAMPLE', 0)),
+        'PROFILE_TOKEN': environ.get('BOWLING_PROFILE_TOKEN'),
+        'PROFILE_MAX_BYTES': int(environ.get('BOWLING_PROFILE_MAX_MB', 100))
+        * 1024 * 1024
+    }
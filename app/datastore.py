@@ -1,8 +1,25 @@
 from mongoengine import *
 from datetime import datetime
 
-# Connects mongoDB to this database namespace
-connect('bowlingdb')
+from metrics import SCORING_SECONDS, timed
+from packing import unpack_scores
+from scoring import ScoreState
+
+# mongoDB database namespace, connected to by storage backend
+DATABASE = 'bowlingdb'
+
+
+class RollsField(ListField):
+    """
+    Player's rolls, stored as a list of integers or packed
+    """
+
+    def __init__(self, **kwargs):
+        super(RollsField, self).__init__(
+            IntField(min_value=0, max_value=10), **kwargs)
+
+    def to_python(self, value):
+        return super(RollsField, self).to_python(unpack_scores(value))
 
 
 class Player(EmbeddedDocument):
@@ -12,118 +29,53 @@ class Player(EmbeddedDocument):
     player_id = IntField(min_value=1, max_value=4, required=True)
     name = StringField(min_length=1, required=True)
     active = BooleanField(default=True)
-    raw_scores = ListField(IntField(min_value=0, max_value=10))
+    raw_scores = RollsField()
+
+    # scoresheet kept up to date on every roll
+    frame_results = ListField(StringField())
+    frame_scores = ListField(IntField())
+    total = IntField(default=0)
+    score_state = DictField()
 
-    STRIKE = "X"
-    SPARE = "S"
+    SHEET_FIELDS = ('frame_results', 'frame_scores', 'total')
 
     @classmethod
+    @timed(SCORING_SECONDS, 'calc_score_sheet')
     def calc_score_sheet(cls, scores):
         """
         Calculates player's frame results, frame scores, and running totals
         """
-        frame_results, frame_scores, running_totals = [], [], []
-
-        # calculate frame results and frame scores
-        for roll, score in enumerate(scores):
-            frame = roll / 2
-
-            # add in fill scores for last frame strike or spare
-            if roll > 18 and (scores[18] == 10 or sum(scores[18:20]) == 10):
-                # add extra score to last frame's strike
-                frame_scores[9] += score
-
-                # append correct result
-                if score == 10:
-                    frame_results[9] += "-" + str(cls.STRIKE)
-                else:
-                    frame_results[9] += "-" + str(score)
-                continue
-
-            # check if frame's first roll
-            if roll % 2 != 1:
-                frame_score = score
-
-                # add strike symbol and strike score
-                if score == 10:
-                    frame_results.append(cls.STRIKE)
-
-                    # add additional points
-                    frame_score += cls.__add_extra(cls.STRIKE, roll, scores)
-                else:
-                    frame_results.append(str(score))
-
-                # add new score entry to frame result
-                frame_scores.append(frame_score)
-                continue
-
-            # assume frame's second roll and set frame final score
-            frame_score = frame_scores[-1] + score
-
-            # if score equals 10 and not a strike, then spare
-            if score != 0 and frame_score == 10:
-                # add spare to frame result
-                frame_results[frame] += "-" + str(cls.SPARE)
-
-                # get next roll
-                frame_score += cls.__add_extra(cls.SPARE, roll, scores)
-
-            # otherwise only use score if first wasn't a strike
-            elif frame_score < 10:
-                frame_results[frame] += "-" + str(score)
-
-            # set new frame score
-            frame_scores[-1] = frame_score
-
-        # sum up frame scores for current total
-        total = sum(frame_scores)
-
-        # set all player score values
-        scoresheet = {
-            "frame_results": frame_results,
-            "frame_scores": frame_scores,
-            "total": total
-        }
-        return scoresheet
+        return ScoreState.from_rolls(scores).score_sheet()
 
     @classmethod
-    def __add_extra(cls, roll_type, roll_num, scores):
+    @timed(SCORING_SECONDS, 'score_fields')
+    def score_fields(cls, player, rolls=()):
         """
-        Grabs any extra points for scoring a strike or a spare
+        Scores new rolls onto a raw player's stored scoresheet, rescoring
+        every roll if the stored scoresheet is missing or out of step
 
-        :param roll_type: STRIKE or SPARE
-        :param roll_num: current roll number
-        :param scores: list of all scores
-        :return: extra points integer
+        :param player: raw player document, scores including new rolls
+        :param rolls: rolls just added to scores
+        :return: map of scoresheet fields to store on player
         """
-        extra_points = 0
-
-        # if type spare then get next roll
-        if roll_type == cls.SPARE:
-            if roll_num + 1 < len(scores) - 1:
-                extra_points += scores[roll_num + 1]
-
-        # if type strike get next two valid rolls
-        if roll_type == cls.STRIKE:
-            second_roll, third_roll = 0, 0
-
-            # skip next roll since 0, grab 2nd
-            if roll_num + 2 < len(scores) - 1:
-                second_roll = scores[roll_num + 2]
-
-            # grab 3rd roll unless 2nd was strike or fill
-            if roll_num + 3 < len(scores) - 1 \
-                    and (second_roll < 10 or roll_num + 3 == 19):
-                third_roll = scores[roll_num + 3]
-
-            # if 2nd roll was strike grab the 4th
-            elif roll_num + 4 < len(scores) - 1:
-                third_roll = scores[roll_num + 4]
-
-            # sum the next two valid rolls to add to frame score
-            extra_points = second_roll + third_roll
-
-        return extra_points
+        scores = player.get('raw_scores', [])
+        stored = player.get('score_state')
+
+        if stored and stored['rolls'] == len(scores) - len(rolls):
+            values = dict(stored)
+            for field in cls.SHEET_FIELDS:
+                values[field] = player[field]
+            state = ScoreState.from_dict(values)
+            for score in rolls:
+                state.add(score)
+        else:
+            state = ScoreState.from_rolls(scores)
+
+        # split scoresheet from state needed to carry on scoring
+        fields = {'score_state': state.to_dict()}
+        for field in cls.SHEET_FIELDS:
+            fields[field] = fields['score_state'].pop(field)
+        return fields
 
 
 class Game(Document):
@@ -134,7 +86,27 @@ class Game(Document):
                         max_length=4, required=True)
     active = BooleanField(default=True)
     date_started = DateTimeField(default=datetime.now)
-    meta = {'collection': 'games'}
+    revision = IntField(default=0)
+    current_player = IntField(min_value=1, max_value=4, default=1)
+    current_frame = IntField(min_value=1, max_value=10, default=1)
+    current_roll = IntField(min_value=1, max_value=3, default=1)
+    meta = {
+        'collection': 'games',
+
+        # listings page in id order, equality filters read ids in order
+        # off their index, a date range only finds its games with it and
+        # sorts a page of them
+        'indexes': [
+            ('active', 'id'),
+            ('date_started', 'id'),
+            ('players.name', 'id')
+        ],
+        'index_background': True,
+
+        # created when a server process first connects its repository, or
+        # by the create-indexes command
+        'auto_create_index': False
+    }
 
     @queryset_manager
     def games(self, query_set):
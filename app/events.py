@@ -0,0 +1,117 @@
+"""
+In-process publish/subscribe of game updates
+
+Writes publish each updated game once, rendered, to the game's topic and
+the all games topic.  Every subscriber has a bounded queue, a subscriber
+whose queue is full is dropped rather than holding up the write.
+"""
+import threading
+from collections import namedtuple
+from Queue import Empty, Full, Queue
+
+
+# topic every game update is published to
+ALL_GAMES = 'games'
+
+# updates waiting per subscriber before it is dropped
+QUEUE_SIZE = 16
+
+# seconds between keepalive comments on an idle stream
+KEEPALIVE = 15
+
+# a game update, body is the rendered game
+Event = namedtuple('Event', ['game_id', 'revision', 'active', 'body'])
+
+
+class Subscription(object):
+    """
+    A subscriber's queue of updates on one topic
+    """
+
+    def __init__(self, topic, size=QUEUE_SIZE):
+        self.topic = topic
+        self.queue = Queue(size)
+        self.dropped = False
+
+    def get(self, timeout=KEEPALIVE):
+        """
+        Waits for the next update
+
+        :param timeout: seconds to wait
+        :return: Event, None if none arrived or subscription was dropped
+        """
+        if self.dropped:
+            return None
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+
+class EventHub(object):
+    """
+    Fans out game updates to subscribers of each topic
+    """
+
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.__topics = {}
+        self.__lock = threading.Lock()
+
+    def subscribe(self, topic):
+        """
+        :param topic: string game id or ALL_GAMES
+        :return: new Subscription
+        """
+        subscription = Subscription(topic, self.queue_size)
+        with self.__lock:
+            self.__topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        :param subscription: Subscription to stop sending updates to
+        """
+        with self.__lock:
+            subscribers = self.__topics.get(subscription.topic)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.__topics[subscription.topic]
+
+    def publish(self, event):
+        """
+        Queues an update for subscribers of its game and of all games,
+        never blocks
+
+        :param event: Event to send
+        """
+        with self.__lock:
+            subscribers = list(self.__topics.get(event.game_id, ())) + \
+                list(self.__topics.get(ALL_GAMES, ()))
+
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(event)
+            except Full:
+                subscription.dropped = True
+                self.unsubscribe(subscription)
+
+    def subscribers(self, topic):
+        """
+        :param topic: string game id or ALL_GAMES
+        :return: number of subscribers
+        """
+        with self.__lock:
+            return len(self.__topics.get(topic, ()))
+
+
+def sse_message(event):
+    """
+    Formats an update as a server-sent event
+
+    :param event: Event to send
+    :return: event stream text
+    """
+    return "id: %s-%d\nevent: game\ndata: %s\n\n" % (
+        event.game_id, event.revision, event.body)
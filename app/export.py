@@ -0,0 +1,133 @@
+"""
+NDJSON export of game history
+
+Games are read in id order a batch at a time and written one JSON line
+each, with players' rolls and scoresheets, so memory use stays the same
+however many games there are.  An export is resumed after the id of the
+last game it wrote.
+"""
+import gzip
+import json
+import zlib
+
+from bson import ObjectId
+
+from datastore import Player
+from packing import unpack_game
+
+
+# games read from the database per round trip
+BATCH_SIZE = 500
+
+# fields of a game kept in an export
+EXPORT_FIELDS = ('players', 'active', 'date_started', 'revision')
+
+
+def mongo_games(collection, after=None, since=None, batch_size=BATCH_SIZE):
+    """
+    Walks games in id order with a server side cursor
+
+    :param collection: games collection
+    :param after: only games with ids after this ObjectId
+    :param since: only games started at or after this datetime
+    :param batch_size: games per round trip
+    :return: generator of raw game documents
+    """
+    filters = {}
+    if after is not None:
+        filters['_id'] = {'$gt': after}
+    if since is not None:
+        filters['date_started'] = {'$gte': since}
+
+    fields = dict((field, 1) for field in EXPORT_FIELDS)
+    cursor = collection.find(filters, fields).sort('_id', 1) \
+        .batch_size(batch_size)
+    try:
+        for game in cursor:
+            yield unpack_game(game)
+    finally:
+        cursor.close()
+
+
+def game_record(game):
+    """
+    Builds the exported form of a game
+
+    :param game: raw game document
+    :return: map of game values
+    """
+    players = []
+    for player in game['players']:
+        scores = player.get('raw_scores', [])
+        if 'score_state' in player:
+            sheet = dict((field, player.get(field))
+                         for field in Player.SHEET_FIELDS)
+        else:
+            sheet = Player.calc_score_sheet(scores)
+        players.append({
+            "player_id": player['player_id'],
+            "name": player['name'],
+            "active": player.get('active', True),
+            "raw_scores": scores,
+            "scoresheet": sheet
+        })
+
+    return {
+        "id": str(game['_id']),
+        "active": game.get('active', True),
+        "date_started": str(game['date_started']),
+        "revision": game.get('revision', 0),
+        "players": players
+    }
+
+
+def export_lines(games):
+    """
+    :param games: iterable of raw game documents
+    :return: generator of NDJSON lines
+    """
+    for game in games:
+        yield json.dumps(game_record(game), sort_keys=True) + "\n"
+
+
+def gzip_chunks(lines, lines_per_chunk=BATCH_SIZE):
+    """
+    Compresses lines as a gzip stream, flushed every so many lines so the
+    reader is never far behind
+
+    :param lines: iterable of text lines
+    :param lines_per_chunk: lines compressed between flushes
+    :return: generator of compressed chunks
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    pending = 0
+    for line in lines:
+        chunk = compressor.compress(line)
+        pending += 1
+        if pending == lines_per_chunk:
+            chunk += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def last_exported_id(path):
+    """
+    Finds the last game fully written to an export file, reading it
+    through.  An interrupted export may end part way through a line or a
+    compressed block, everything readable before that counts.
+
+    :param path: NDJSON file, gzipped if name ends in .gz
+    :return: ObjectId of last game, None if file has none
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    last = None
+    with opener(path, 'rb') as exported:
+        try:
+            for line in exported:
+                if line.endswith("\n"):
+                    last = line
+        except (IOError, EOFError, zlib.error):
+            pass
+    return ObjectId(json.loads(last)["id"]) if last else None
@@ -0,0 +1,28 @@
+"""
+Gunicorn settings for serving with a worker process per core
+
+Each worker imports the app after it is forked and connects to MongoDB on
+its first request, so no connection is shared between processes.
+
+Usage: gunicorn -c app/gunicorn_conf.py api:app
+"""
+import multiprocessing
+import os
+
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+bind = os.environ.get('BOWLING_BIND', '0.0.0.0:5000')
+
+# greenlet workers as in serve.py, one per core
+worker_class = 'gevent'
+workers = int(os.environ.get('BOWLING_WORKERS',
+                             multiprocessing.cpu_count()))
+worker_connections = int(os.environ.get('BOWLING_WORKER_CONNECTIONS',
+                                        10000))
+
+# games in memory are per process so memory storage runs one worker
+if os.environ.get('BOWLING_STORAGE') == 'memory':
+    workers = 1
+
+# load app in each worker rather than once before forking
+preload_app = False
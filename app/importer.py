@@ -0,0 +1,226 @@
+"""
+Bulk import of historical games from NDJSON
+
+Each line is one game, either player names with rolls in the order they
+were bowled:
+
+    {"players": ["Ann", "Bob"], "rolls": [10, 7, 3, 9], "active": false,
+     "date_started": "2014-09-02T19:30:00"}
+
+or a line written by the export, with each player's rolls.  Every game is
+replayed through the same rules as rolls sent with PUT, in a pool of
+processes, and valid games are inserted a batch at a time.  Lines are read
+a block at a time, so memory use stays the same however big the file is.
+"""
+import json
+from collections import deque
+from datetime import datetime
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from mongoengine import ValidationError
+from pymongo.errors import BulkWriteError
+
+from datastore import Game, Player
+from export import BATCH_SIZE
+from packing import bowled_rolls, pack_scores
+from rules import RuleError, Turn, apply_roll, apply_rolls, deactivate
+
+
+# MongoDB error code of an insert with an id already stored
+DUPLICATE_KEY = 11000
+
+# date formats accepted for date_started, export writes the first
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d')
+
+
+def game_document(record, pack_rolls=False):
+    """
+    Builds the game document to insert for an imported game, replaying its
+    rolls with the rules
+
+    :param record: map of imported game values
+    :param pack_rolls: store rolls packed
+    :return: raw game document
+    """
+    if type(record) != dict:
+        raise ValueError("Game must be a JSON object")
+    entries = record.get('players')
+    if type(entries) != list or not (0 < len(entries) < 5):
+        raise ValueError("Invalid number of players")
+
+    # players are given by name, or as exported with their rolls
+    exported = all(type(entry) == dict for entry in entries)
+    names = [entry.get('name') for entry in entries] if exported \
+        else entries
+    game = Game(players=[Player(player_id=(num + 1), name=name)
+                         for num, name in enumerate(names)])
+    game.validate()
+    document = game.to_mongo().to_dict()
+
+    if 'id' in record:
+        document['_id'] = ObjectId(record['id'])
+    if 'date_started' in record:
+        document['date_started'] = parse_started(record['date_started'])
+
+    # raises InvalidRoll
+    if exported:
+        replay_players(document, entries)
+    else:
+        apply_rolls(document, record.get('rolls', []))
+    if not record.get('active', True) and document['active']:
+        deactivate(document)
+
+    for player in document['players']:
+        player.update(Player.score_fields(player))
+        if pack_rolls and 'raw_scores' in player:
+            player['raw_scores'] = pack_scores(player['raw_scores'])
+    return document
+
+
+def replay_players(game, entries):
+    """
+    Applies exported players' rolls in turn order, players who left part
+    way are inactivated when their turn comes without rolls left
+
+    :param game: raw game document, updated in place
+    :param entries: list of exported players
+    """
+    waiting = []
+    for entry in entries:
+        scores = entry.get('raw_scores', [])
+        if type(scores) != list:
+            raise ValueError("Rolls must be a list")
+        waiting.append(deque(bowled_rolls(scores)))
+
+    while any(waiting) and game['active']:
+        turn = Turn.of(game)
+        if waiting[turn.player - 1]:
+            apply_roll(game, waiting[turn.player - 1].popleft())
+        elif not entries[turn.player - 1].get('active', True):
+            deactivate(game, turn.player)
+        else:
+            raise RuleError("Player " + str(turn.player) +
+                            " has no rolls left on their turn")
+    if any(waiting):
+        raise RuleError("Rolls left after game ended")
+
+    # players who left after their last turn
+    for num, entry in enumerate(entries):
+        if game['active'] and not entry.get('active', True) \
+                and game['players'][num]['active']:
+            deactivate(game, num + 1)
+
+
+def parse_started(value):
+    """
+    :param value: date as exported, or YYYY-MM-DD[THH:MM:SS]
+    :return: datetime
+    """
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except (TypeError, ValueError):
+            continue
+    raise ValueError("Invalid date_started")
+
+
+def check_line(numbered, pack_rolls=False):
+    """
+    Validates one imported line, run in pool processes
+
+    :param numbered: line number, line
+    :param pack_rolls: store rolls packed
+    :return: line number, game document or None, error message or None
+    """
+    number, line = numbered
+    try:
+        return number, game_document(json.loads(line), pack_rolls), None
+    except (ValueError, TypeError, InvalidId, ValidationError) \
+            as exception:
+        message = str(exception) or type(exception).__name__
+        if getattr(exception, 'index', None) is not None:
+            message = "Roll %d: %s" % (exception.index + 1, message)
+        return number, None, message
+
+
+def import_games(lines, insert, reject, processes=None,
+                 batch_size=BATCH_SIZE, pack_rolls=False):
+    """
+    Validates lines in a pool of processes and inserts valid games in
+    batches.  One block of lines is validated while the block before it is
+    inserted.
+
+    :param lines: iterable of NDJSON lines
+    :param insert: function inserting a list of game documents, returning
+        how many were inserted
+    :param reject: function given line number, line and error message of
+        an invalid game
+    :param processes: validating processes, one per core if None
+    :param batch_size: games per insert
+    :param pack_rolls: store rolls packed
+    :return: games imported, games already stored, games rejected
+    """
+    processes = processes or cpu_count()
+    numbered = ((number, line) for number, line in enumerate(lines, 1)
+                if line.strip())
+    check = partial(check_line, pack_rolls=pack_rolls)
+    counts = [0, 0, 0]
+
+    def store(block, checked):
+        batch = []
+        for number, game, error in checked:
+            if error is not None:
+                counts[2] += 1
+                reject(number, block[number], error)
+                continue
+            batch.append(game)
+            if len(batch) == batch_size:
+                store_batch(batch)
+                batch = []
+        if batch:
+            store_batch(batch)
+
+    def store_batch(batch):
+        inserted = insert(batch)
+        counts[0] += inserted
+        counts[1] += len(batch) - inserted
+
+    pool = Pool(processes)
+    try:
+        pending = None
+        while True:
+            block = list(islice(numbered, batch_size * processes))
+            checking = pool.map_async(check, block, batch_size) \
+                if block else None
+            if pending is not None:
+                store(dict(pending[0]), pending[1].get())
+            if checking is None:
+                break
+            pending = block, checking
+    finally:
+        pool.terminate()
+        pool.join()
+    return tuple(counts)
+
+
+def mongo_insert(collection):
+    """
+    :param collection: games collection
+    :return: function inserting a batch of games unordered, skipping games
+        whose exported id is already stored
+    """
+    def insert(games):
+        try:
+            return len(collection.insert_many(games, ordered=False)
+                       .inserted_ids)
+        except BulkWriteError as exception:
+            errors = exception.details['writeErrors']
+            if any(error['code'] != DUPLICATE_KEY for error in errors):
+                raise
+            return exception.details['nInserted']
+    return insert
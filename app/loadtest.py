@@ -0,0 +1,534 @@
+"""
+Load test simulating lanes bowling games
+
+Each lane creates a game, bowls its rolls at a human pace with pins drawn
+from a configurable distribution, and now and then a player leaves part
+way, while displays at the lane poll the game for its scoresheet.  Latency
+of every request is recorded per route and reported as throughput and
+percentiles, so lanes can be added until latency is no longer acceptable.
+
+Lanes draw rolls from a fixed seed, so every run bowls the same games.  Runs
+against a server by URL, or in process through Flask's test client.  The
+requests of the Postman collection can be replayed as a smoke test.
+
+Usage: python app/loadtest.py [--url URL] [--lanes N] [--duration SECONDS]
+       python app/loadtest.py --replay POSTMAN.json [--url URL]
+"""
+import argparse
+import httplib
+import json
+import math
+import random
+import socket
+import sys
+import threading
+import time
+from timeit import default_timer
+from urlparse import urlparse
+
+from api import create_app
+from bench import SEED, new_game
+from rules import Turn, apply_roll, deactivate
+
+
+# relative weights of knocking down 0 - 10 pins with a full rack, roughly a
+# league bowler averaging 150
+FIRST_BALL = (2, 1, 1, 1, 2, 3, 5, 9, 16, 22, 30)
+
+# chance of picking up a spare, otherwise remaining pins fall uniformly
+SPARE_RATE = 0.4
+
+# latency percentiles reported
+PERCENTILES = (50, 95, 99)
+
+# placeholder values of a replayed Postman collection
+REPLAY_VALUES = {'<player_id>': "1"}
+
+
+################################
+# Transports
+################################
+
+class TestClientTransport(object):
+    """
+    Requests made in process through Flask's test client
+    """
+
+    def __init__(self, app):
+        """
+        :param app: Flask app
+        """
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        :return: status code, map of lowercase header names, body
+        """
+        response = self.client.open(path, method=method, data=body,
+                                    headers=headers or {})
+        return response.status_code, \
+            dict((name.lower(), value) for name, value in response.headers), \
+            response.data
+
+
+class HTTPTransport(object):
+    """
+    Requests made to a server over one keep-alive connection
+    """
+
+    def __init__(self, url, timeout=30):
+        """
+        :param url: server URL, e.g. http://localhost:5000
+        :param timeout: seconds to wait on the server
+        """
+        parts = urlparse(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        :return: status code, map of lowercase header names, body
+        """
+        if self.connection is None:
+            self.connection = httplib.HTTPConnection(self.host, self.port,
+                                                     timeout=self.timeout)
+        try:
+            self.connection.request(method, path, body, headers or {})
+            response = self.connection.getresponse()
+            return response.status, dict(response.getheaders()), \
+                response.read()
+        except (httplib.HTTPException, socket.error):
+            # a roll may have been applied, so never resend, reconnect for
+            # the next request
+            self.connection.close()
+            self.connection = None
+            raise
+
+
+################################
+# Recording
+################################
+
+class Recorder(object):
+    """
+    Latency of requests per route, shared by every lane and display
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def call(self, transport, route, method, path, body=None, headers=None):
+        """
+        Times a request, errors and responses of 400 or above are failures
+
+        :param transport: transport making the request
+        :param route: name latency is recorded under, e.g. PUT /games/<id>
+        :return: status code, 0 if request failed, headers, body
+        """
+        start = default_timer()
+        try:
+            status, headers, data = transport.request(method, path, body,
+                                                      headers)
+        except (httplib.HTTPException, socket.error):
+            status, headers, data = 0, {}, ''
+        elapsed = default_timer() - start
+
+        with self.lock:
+            self.latencies.setdefault(route, []).append(elapsed)
+            self.failures.setdefault(route, 0)
+            if not 0 < status < 400:
+                self.failures[route] += 1
+        return status, headers, data
+
+    def report(self, seconds):
+        """
+        :param seconds: length of the run
+        :return: list of (route, requests, failures, requests per second,
+            latency in ms at each of PERCENTILES)
+        """
+        rows = []
+        for route, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            rows.append((route, len(latencies), self.failures[route],
+                         len(latencies) / seconds if seconds else 0.0,
+                         [percentile(latencies, rank) * 1000
+                          for rank in PERCENTILES]))
+        return rows
+
+
+def percentile(ordered, rank):
+    """
+    :param ordered: sorted list of values
+    :param rank: percentile, 0 - 100
+    :return: nearest rank value, 0 if no values
+    """
+    if not ordered:
+        return 0
+    index = int(math.ceil(rank / 100.0 * len(ordered))) - 1
+    return ordered[min(max(index, 0), len(ordered) - 1)]
+
+
+################################
+# Lanes
+################################
+
+def parse_weights(text):
+    """
+    :param text: comma separated weights of knocking down 0 - 10 pins
+    :return: tuple of 11 weights
+    """
+    try:
+        weights = tuple(float(weight) for weight in text.split(','))
+    except ValueError:
+        raise ValueError("Pin weights must be numbers")
+    if len(weights) != 11 or min(weights) < 0 or not sum(weights):
+        raise ValueError("Give 11 pin weights for 0 - 10 pins")
+    return weights
+
+
+def next_pins(rand, scores, turn, weights=FIRST_BALL,
+              spare_rate=SPARE_RATE):
+    """
+    Draws the pins knocked down by a player's next roll
+
+    :param rand: random.Random to draw from
+    :param scores: player's raw scores
+    :param turn: Turn of the roll
+    :param weights: relative weights of 0 - 10 pins with a full rack
+    :param spare_rate: chance of knocking down all pins left standing
+    :return: pins
+    """
+    standing = 10
+    if turn.roll == 2 and scores[-1] != 10:
+        standing = 10 - scores[-1]
+    elif turn.roll == 3 and scores[-2] == 10 and scores[-1] != 10:
+        standing = 10 - scores[-1]
+
+    if standing == 10:
+        pick = rand.uniform(0, sum(weights))
+        for pins, weight in enumerate(weights):
+            pick -= weight
+            if pick < 0:
+                return pins
+        return 10
+    if rand.random() < spare_rate:
+        return standing
+    return rand.randint(0, standing - 1)
+
+
+class Lane(object):
+    """
+    Lane bowling games one after another, displays follow the game it is on
+    """
+
+    def __init__(self, number, transport, recorder, options, deadline=None):
+        """
+        :param number: lane number, rolls are drawn from the seed and it
+        :param transport: transport the lane's requests are made with
+        :param recorder: Recorder of latencies
+        :param options: parsed command line options
+        :param deadline: default_timer value the lane stops at
+        """
+        self.number = number
+        self.rand = random.Random("%s-%s" % (options.seed, number))
+        self.transport = transport
+        self.recorder = recorder
+        self.options = options
+        self.deadline = deadline
+        self.game_id = None
+        self.done = False
+        self.rolls = 0
+
+    def running(self):
+        return self.deadline is None or default_timer() < self.deadline
+
+    def pause(self, seconds):
+        """
+        Waits about this long, humans are never exact
+        """
+        if seconds > 0:
+            time.sleep(self.rand.uniform(0.5, 1.5) * seconds)
+
+    def run(self):
+        try:
+            games = 0
+            while self.running() and (not self.options.games or
+                                      games < self.options.games):
+                self.bowl()
+                games += 1
+        finally:
+            self.done = True
+
+    def bowl(self):
+        """
+        Creates a game and bowls it until finished or the run ends
+        """
+        options = self.options
+        names = ["Lane %d Bowler %d" % (self.number + 1, number + 1)
+                 for number in range(options.players)]
+        status, _, data = self.recorder.call(
+            self.transport, 'POST /games', 'POST', '/games',
+            json.dumps(names), {'Content-Type': 'application/json'})
+        if status != 201:
+            self.pause(options.roll_seconds)
+            return
+        self.game_id = json.loads(data)["gameID"]
+        path = '/games/' + self.game_id
+
+        game = new_game(options.players)
+        while game['active'] and self.running():
+            self.pause(options.roll_seconds)
+            turn = Turn.of(game)
+            player = game['players'][turn.player - 1]
+
+            # a player leaves at the start of a frame now and then, games
+            # keep at least one bowler
+            others = [other for other in game['players']
+                      if other['active'] and other is not player]
+            if turn.roll == 1 and others and \
+                    self.rand.random() < options.leave_rate:
+                deactivate(game, turn.player)
+                self.recorder.call(self.transport, 'DELETE /games/<id>',
+                                   'DELETE', path, str(turn.player))
+                continue
+
+            pins = next_pins(self.rand, player.get('raw_scores', []), turn,
+                             options.weights, options.spare_rate)
+            apply_roll(game, pins)
+            self.rolls += 1
+            self.recorder.call(self.transport, 'PUT /games/<id>', 'PUT',
+                               path, str(pins))
+
+    def display(self, transport, rand):
+        """
+        Polls the lane's game like a scoreboard, only refreshing it once it
+        changed
+
+        :param transport: transport of the display's requests
+        :param rand: random.Random of the display's poll times
+        """
+        etag, game_id = None, None
+        while not self.done:
+            if self.options.poll_seconds > 0:
+                time.sleep(rand.uniform(0.5, 1.5) * self.options.poll_seconds)
+            if self.game_id is None:
+                continue
+            if self.game_id != game_id:
+                etag, game_id = None, self.game_id
+            headers = {'If-None-Match': etag} if etag else {}
+            status, headers, _ = self.recorder.call(
+                transport, 'GET /games/<id>', 'GET', '/games/' + game_id,
+                headers=headers)
+            if status == 200:
+                etag = headers.get('etag')
+
+
+def simulate(options, transports):
+    """
+    Runs lanes and their displays in threads until every lane is done
+
+    :param options: parsed command line options
+    :param transports: function giving a new transport
+    :return: Recorder, seconds run, rolls bowled
+    """
+    recorder = Recorder()
+    start = default_timer()
+    deadline = start + options.duration if options.duration else None
+    lanes = [Lane(number, transports(), recorder, options, deadline)
+             for number in range(options.lanes)]
+
+    threads = []
+    for number, lane in enumerate(lanes):
+        threads.append(threading.Thread(target=lane.run))
+        for display in range(options.displays):
+            rand = random.Random("%s-%s-%s" % (options.seed, number, display))
+            threads.append(threading.Thread(target=lane.display,
+                                            args=(transports(), rand)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return recorder, default_timer() - start, \
+        sum(lane.rolls for lane in lanes)
+
+
+################################
+# Postman replay
+################################
+
+def replay(path, transport, recorder):
+    """
+    Sends the requests of a Postman collection in its order.  <game_id> is
+    filled in with the game the collection created, or a new one if it
+    has not created one yet.
+
+    :param path: Postman collection JSON file
+    :param transport: transport requests are made with
+    :param recorder: Recorder of latencies
+    :return: list of (request name, method, path, status)
+    """
+    with open(path) as collection_file:
+        collection = json.load(collection_file)
+    requests = dict((item['id'], item) for item in collection['requests'])
+    order = collection.get('order') or [item['id'] for item in
+                                        collection['requests']]
+
+    values = dict(REPLAY_VALUES)
+    results = []
+    for request_id in order:
+        item = requests[request_id]
+        method = item.get('method', 'GET').upper()
+        url = item['url'] if '://' in item['url'] else 'http://' + item['url']
+        route = urlparse(url).path or '/'
+
+        if '<game_id>' in route and '<game_id>' not in values:
+            status, _, data = recorder.call(
+                transport, 'POST /games', 'POST', '/games',
+                json.dumps(["Replay"]), {'Content-Type': 'application/json'})
+            if status == 201:
+                values['<game_id>'] = json.loads(data)["gameID"]
+
+        headers = dict(line.split(':', 1) for line in
+                       item.get('headers', '').splitlines() if ':' in line)
+        headers = dict((name.strip(), value.strip())
+                       for name, value in headers.items())
+        body = item.get('data') if method not in ('GET', 'HEAD') else None
+        if not isinstance(body, basestring):
+            body = None
+
+        filled = [route, body]
+        for placeholder, value in values.items():
+            filled = [text.replace(placeholder, value)
+                      if text is not None else None for text in filled]
+        status, _, data = recorder.call(transport, method + ' ' + route,
+                                        method, filled[0], filled[1],
+                                        headers)
+
+        # later requests use the game the collection creates
+        if method == 'POST' and route == '/games' and status == 201:
+            values['<game_id>'] = json.loads(data)["gameID"]
+        results.append((item.get('name', request_id), method, filled[0],
+                        status))
+    return results
+
+
+################################
+# Reporting
+################################
+
+def print_report(rows, seconds, rolls):
+    """
+    :param rows: rows from Recorder.report
+    :param seconds: length of the run
+    :param rolls: rolls bowled
+    """
+    print("%-22s %9s %9s %10s %9s %9s %9s" % (
+        "route", "requests", "failures", "req/sec", "p50 ms", "p95 ms",
+        "p99 ms"))
+    for route, count, failures, rate, latencies in rows:
+        print("%-22s %9d %9d %10.1f %9.2f %9.2f %9.2f" % tuple(
+            [route, count, failures, rate] + latencies))
+    total = sum(row[1] for row in rows)
+    print("")
+    print("%d requests, %d rolls in %.1f seconds, %.1f requests/sec" % (
+        total, rolls, seconds, total / seconds if seconds else 0.0))
+
+
+################################
+# Command line
+################################
+
+def main():
+    """
+    Parses command line and runs the lanes or replays a collection, exiting
+    with an error if any request failed
+    """
+    parser = argparse.ArgumentParser(
+        description="Bowling tracker load test")
+    parser.add_argument('--url', help="server to test, e.g. "
+                                      "http://localhost:5000, default is "
+                                      "the test client")
+    parser.add_argument('--storage', default='memory',
+                        help="test client storage, memory or mongo")
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--lanes', type=int, default=10)
+    parser.add_argument('--players', type=int, default=4,
+                        help="bowlers per game, 1 - 4")
+    parser.add_argument('--displays', type=int, default=2,
+                        help="displays polling each lane")
+    parser.add_argument('--duration', type=float, default=60,
+                        help="seconds to run, 0 to run until games done")
+    parser.add_argument('--games', type=int, default=0,
+                        help="games per lane, 0 for no limit")
+    parser.add_argument('--roll-seconds', type=float, default=10,
+                        help="average time between rolls on a lane")
+    parser.add_argument('--poll-seconds', type=float, default=2,
+                        help="average time between display polls")
+    parser.add_argument('--pins', default=','.join(map(str, FIRST_BALL)),
+                        help="weights of knocking down 0 - 10 pins with a "
+                             "full rack")
+    parser.add_argument('--spare-rate', type=float, default=SPARE_RATE)
+    parser.add_argument('--leave-rate', type=float, default=0.005,
+                        help="chance a player leaves at a frame")
+    parser.add_argument('--replay', help="Postman collection to replay "
+                                         "instead, e.g. POSTMAN.json")
+    parser.add_argument('--output', help="save results to this JSON file")
+    args = parser.parse_args()
+
+    if not 0 < args.players < 5:
+        parser.error("--players must be 1 - 4")
+    if not (args.duration or args.games):
+        parser.error("give a --duration or --games")
+    try:
+        args.weights = parse_weights(args.pins)
+    except ValueError as exception:
+        parser.error(str(exception))
+
+    if args.url:
+        def transports():
+            return HTTPTransport(args.url)
+    else:
+        app = create_app({'STORAGE': args.storage})
+
+        def transports():
+            return TestClientTransport(app)
+
+    if args.replay:
+        recorder = Recorder()
+        results = replay(args.replay, transports(), recorder)
+        for name, method, path, status in results:
+            print("%-22s %-7s %-36s %s" % (name, method, path, status))
+        if any(not 0 < status < 400 for _, _, _, status in results):
+            sys.exit(1)
+        return
+
+    recorder, seconds, rolls = simulate(args, transports)
+    rows = recorder.report(seconds)
+    print_report(rows, seconds, rolls)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                "seed": args.seed,
+                "lanes": args.lanes,
+                "seconds": seconds,
+                "rolls": rolls,
+                "routes": dict(
+                    (route, {"requests": count, "failures": failures,
+                             "per_sec": rate,
+                             "latency_ms": dict(zip(PERCENTILES, latencies))})
+                    for route, count, failures, rate, latencies in rows)
+            }, output, indent=2, sort_keys=True)
+
+    if any(row[2] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+"""
+Management commands for the bowling tracker database
+
+Usage: python app/manage.py <command> [options]
+"""
+import argparse
+import gzip
+import json
+import sys
+from datetime import datetime
+from itertools import islice
+
+from bson import ObjectId
+from mongoengine import connect
+
+from config import app_config
+from datastore import Game, Player
+from export import export_lines, gzip_chunks, last_exported_id, mongo_games
+from importer import import_games, mongo_insert
+from packing import is_packed, pack_scores, unpack_game
+from repository import read_preference
+from rules import Turn
+from stats import MongoStats
+from vectorized import roll_array, score_batch
+
+
+# games fetched from database per round trip
+BATCH_SIZE = 500
+
+
+################################
+# Commands
+################################
+
+def create_indexes(args):
+    """
+    Creates indexes declared on games, existing indexes are left as they
+    are.  The API also creates them in each server process on its first
+    request needing storage, this builds them before traffic arrives.
+
+    :param args: parsed command line arguments
+    """
+    Game.ensure_indexes()
+    for name in sorted(Game._get_collection().index_information()):
+        print("Index " + name)
+
+
+def backfill_turns(args):
+    """
+    Stores turn pointer on games saved before turns were tracked
+
+    :param args: parsed command line arguments
+    """
+    collection = Game._get_collection()
+    missing = {'current_player': {'$exists': False}}
+
+    count = 0
+    for game in collection.find(missing, {'players': 1}) \
+            .batch_size(args.batch_size):
+        turn = {}
+        Turn.backfill(unpack_game(game)).store(turn)
+
+        # skip games given a turn by a roll since the scan started
+        guard = dict(missing, _id=game['_id'])
+        result = collection.update_one(guard, {'$set': turn})
+        count += result.modified_count
+
+    print("Backfilled turns on %d games" % count)
+
+
+def backfill_scores(args):
+    """
+    Stores scoresheets on players of games saved before scoresheets were
+    stored
+
+    :param args: parsed command line arguments
+    """
+    collection = Game._get_collection()
+    missing = {
+        'players': {'$elemMatch': {'score_state': {'$exists': False}}}
+    }
+
+    count = 0
+    for game in collection.find(missing, {'players': 1, 'revision': 1}) \
+            .batch_size(args.batch_size):
+        update = {}
+        for index, player in enumerate(unpack_game(game)['players']):
+            sheet = Player.score_fields(player)
+            for field, value in sheet.items():
+                update['players.%d.%s' % (index, field)] = value
+
+        # skip games rolled on since the scan started, rolls store sheets
+        guard = {'_id': game['_id'], 'revision': game.get('revision')}
+        result = collection.update_one(guard, {'$set': update})
+        count += result.modified_count
+
+    print("Backfilled scoresheets on %d games" % count)
+
+
+def check_scores(args):
+    """
+    Rescores a random sample of games and reports any stored scoresheets
+    that drifted from their rolls
+
+    :param args: parsed command line arguments
+    """
+    collection = Game._get_collection()
+    sample = collection.aggregate([
+        {'$match': {'players.score_state': {'$exists': True}}},
+        {'$sample': {'size': args.sample}},
+        {'$project': {'players': 1}}
+    ])
+
+    checked, drifted = 0, 0
+    for game in sample:
+        checked += 1
+        for player in unpack_game(game)['players']:
+            if 'score_state' not in player:
+                continue
+            expected = Player.calc_score_sheet(player.get('raw_scores', []))
+            stored = dict((field, player.get(field))
+                          for field in Player.SHEET_FIELDS)
+            if stored != expected:
+                drifted += 1
+                print("Drift in game %s player %d: stored total %s, rolls "
+                      "total %d" % (game['_id'], player['player_id'],
+                                    stored['total'], expected['total']))
+
+    print("Checked %d games, %d players drifted" % (checked, drifted))
+    if drifted:
+        sys.exit(1)
+
+
+def audit_scores(args):
+    """
+    Rescores every stored player with the batch scorer, NumPy needed, and
+    reports any whose stored frame scores or total drifted from their rolls
+
+    :param args: parsed command line arguments
+    """
+    games = Game._get_collection().find(
+        {'players.score_state': {'$exists': True}},
+        {'players.player_id': 1, 'players.raw_scores': 1,
+         'players.frame_scores': 1, 'players.total': 1}) \
+        .batch_size(args.batch_size)
+
+    checked, drifted = 0, 0
+    while True:
+        players = [(game['_id'], player)
+                   for game in islice(games, args.batch_size)
+                   for player in unpack_game(game)['players']
+                   if 'frame_scores' in player]
+        if not players:
+            break
+
+        scores, totals, frames = score_batch(roll_array(
+            [player.get('raw_scores', []) for _, player in players]))
+        for (game_id, player), row, total, count in \
+                zip(players, scores, totals, frames):
+            checked += 1
+            if player['frame_scores'] != row[:count].tolist() or \
+                    player['total'] != total:
+                drifted += 1
+                print("Drift in game %s player %d: stored total %s, rolls "
+                      "total %d" % (game_id, player['player_id'],
+                                    player['total'], total))
+
+    print("Audited %d players, %d drifted" % (checked, drifted))
+    if drifted:
+        sys.exit(1)
+
+
+def pack_rolls(args):
+    """
+    Packs rolls of games still storing them as lists, run with
+    BOWLING_PACK_ROLLS set on the API so new rolls are packed too
+
+    :param args: parsed command line arguments
+    """
+    collection = Game._get_collection()
+    unpacked = {'players.raw_scores.0': {'$exists': True}}
+
+    count = 0
+    for game in collection.find(unpacked, {'players.raw_scores': 1,
+                                           'revision': 1}) \
+            .batch_size(args.batch_size):
+        update = {}
+        for index, player in enumerate(game['players']):
+            if 'raw_scores' in player and \
+                    not is_packed(player['raw_scores']):
+                update['players.%d.raw_scores' % index] = \
+                    pack_scores(player['raw_scores'])
+
+        # skip games rolled on since the scan started
+        guard = {'_id': game['_id'], 'revision': game.get('revision')}
+        result = collection.update_one(guard, {'$set': update})
+        count += result.modified_count
+
+    print("Packed rolls of %d games" % count)
+
+
+def export(args):
+    """
+    Writes games oldest first as one JSON line each, gzipped if output
+    name ends in .gz, to file or standard output
+
+    :param args: parsed command line arguments
+    """
+    after = ObjectId(args.after) if args.after else None
+    if args.resume:
+        after = last_exported_id(args.resume)
+    since = datetime.strptime(args.since, '%Y-%m-%d') if args.since \
+        else None
+
+    # read from secondaries if the API does
+    config = app_config()
+    reads = read_preference(config['READ_PREFERENCE'],
+                            config['MAX_STALENESS'])
+    games = Game._get_collection().with_options(read_preference=reads)
+
+    chunks = export_lines(mongo_games(games, after, since, args.batch_size))
+    if args.output and args.output.endswith('.gz'):
+        chunks = gzip_chunks(chunks, args.batch_size)
+
+    output = open(args.output, 'wb') if args.output else sys.stdout
+    try:
+        for chunk in chunks:
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
+
+
+def import_file(args):
+    """
+    Validates games of an NDJSON file with the rules and inserts valid
+    ones in batches, invalid games are written to a reject file
+
+    :param args: parsed command line arguments
+    """
+    opener = gzip.open if args.input.endswith('.gz') else open
+    rejects = open(args.rejects, 'w')
+
+    def reject(number, line, error):
+        rejects.write(json.dumps({"line": number, "error": error,
+                                  "game": line.rstrip("\n")}) + "\n")
+
+    collection = Game._get_collection()
+    try:
+        with opener(args.input, 'rb') as lines:
+            imported, existing, rejected = import_games(
+                lines, mongo_insert(collection), reject, args.processes,
+                args.batch_size, app_config()['PACK_ROLLS'])
+    finally:
+        rejects.close()
+
+    print("Imported %d games, %d already imported, %d rejected to %s" % (
+        imported, existing, rejected, args.rejects))
+    if imported and not args.skip_stats:
+        MongoStats(Game._get_db()).rebuild(collection)
+        print("Rebuilt statistics and leaderboards")
+
+
+def rebuild_stats(args):
+    """
+    Recomputes player statistics and leaderboards from every game
+
+    :param args: parsed command line arguments
+    """
+    MongoStats(Game._get_db()).rebuild(Game._get_collection())
+    print("Rebuilt statistics and leaderboards")
+
+
+################################
+# Command line
+################################
+
+def main():
+    """
+    Parses command line and runs chosen command
+    """
+    parser = argparse.ArgumentParser(
+        description="Bowling tracker management commands")
+    commands = parser.add_subparsers(dest='command')
+
+    command = commands.add_parser(
+        'create-indexes', help="create indexes listing filters use")
+    command.set_defaults(run=create_indexes)
+
+    command = commands.add_parser(
+        'backfill-turns', help="store turn pointer on existing games")
+    command.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    command.set_defaults(run=backfill_turns)
+
+    command = commands.add_parser(
+        'backfill-scores', help="store scoresheets on existing games")
+    command.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    command.set_defaults(run=backfill_scores)
+
+    command = commands.add_parser(
+        'check-scores', help="compare stored scoresheets to rolls")
+    command.add_argument('--sample', type=int, default=1000,
+                         help="number of random games to check")
+    command.set_defaults(run=check_scores)
+
+    command = commands.add_parser(
+        'audit-scores', help="rescore every game at once with NumPy")
+    command.add_argument('--batch-size', type=int, default=10000,
+                         help="games scored together")
+    command.set_defaults(run=audit_scores)
+
+    command = commands.add_parser(
+        'pack-rolls', help="store rolls of existing games packed")
+    command.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    command.set_defaults(run=pack_rolls)
+
+    command = commands.add_parser(
+        'export', help="write games as NDJSON, one line per game")
+    command.add_argument('--output', help="file to write, gzipped if it "
+                                          "ends in .gz, standard output if "
+                                          "not given")
+    command.add_argument('--since', help="only games started on or after "
+                                         "this YYYY-MM-DD date")
+    command.add_argument('--after', help="only games after this game id")
+    command.add_argument('--resume', help="an interrupted export, only games "
+                                          "after its last complete line")
+    command.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    command.set_defaults(run=export)
+
+    command = commands.add_parser(
+        'import', help="insert games from NDJSON, checked with the rules")
+    command.add_argument('input', help="NDJSON file, gzipped if it ends in "
+                                       ".gz")
+    command.add_argument('--rejects', default='rejects.ndjson',
+                         help="file invalid games are written to")
+    command.add_argument('--processes', type=int,
+                         help="validating processes, default one per core")
+    command.add_argument('--skip-stats', action='store_true',
+                         help="leave statistics to a later rebuild-stats")
+    command.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    command.set_defaults(run=import_file)
+
+    command = commands.add_parser(
+        'rebuild-stats', help="recompute statistics and leaderboards")
+    command.set_defaults(run=rebuild_stats)
+
+    args = parser.parse_args()
+    config = app_config()
+    connect(config['MONGO_DB'], **config['MONGO_SETTINGS'])
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""
+Process metrics exposed in Prometheus text format
+
+Recording a value is a dict lookup and an add under a lock, values are
+only formatted when /metrics is scraped.  Each process keeps its own
+metrics.
+"""
+import threading
+from bisect import bisect_left
+from functools import wraps
+from itertools import count
+from timeit import default_timer
+
+from bson import BSON
+from pymongo import monitoring
+
+
+# upper bounds in seconds of latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+# upper bounds of database operations per request buckets
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+# upper bounds of database bytes per request buckets
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                 16777216)
+
+
+class Metric(object):
+    """
+    A named metric with values kept per combination of label values
+    """
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def render(self):
+        """
+        :return: list of exposition lines
+        """
+        lines = ["# HELP %s %s" % (self.name, self.description),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines.extend(self.samples(label_values, value))
+        return lines
+
+    def samples(self, label_values, value):
+        """
+        :param label_values: tuple of label values
+        :param value: stored value for labels
+        :return: list of sample lines
+        """
+        raise NotImplementedError
+
+    def label_text(self, label_values, extra=()):
+        """
+        :param label_values: tuple of label values
+        :param extra: further (label, value) pairs
+        :return: label set text, empty if no labels
+        """
+        pairs = list(zip(self.labels, label_values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('%s="%s"' % (label, escape(value))
+                              for label, value in pairs) + "}"
+
+
+class Counter(Metric):
+    """
+    Total only ever increased
+    """
+    kind = 'counter'
+
+    def inc(self, label_values=(), amount=1):
+        """
+        :param label_values: tuple of label values
+        :param amount: amount to add
+        """
+        with self.lock:
+            self.values[label_values] = \
+                self.values.get(label_values, 0) + amount
+
+    def samples(self, label_values, value):
+        return ["%s%s %s" % (self.name, self.label_text(label_values),
+                             number(value))]
+
+
+class Histogram(Metric):
+    """
+    Count of observations per bucket, with their sum and count
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, label_values, value):
+        """
+        :param label_values: tuple of label values
+        :param value: observed value
+        """
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                # one count per bucket, then +Inf, then sum
+                counts = self.values[label_values] = \
+                    [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bucket] += 1
+            counts[-1] += value
+
+    def samples(self, label_values, value):
+        lines, total = [], 0
+        bounds = [number(bound) for bound in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, value[:-1]):
+            total += count
+            lines.append("%s_bucket%s %d" % (
+                self.name, self.label_text(label_values, [('le', bound)]),
+                total))
+        labels = self.label_text(label_values)
+        lines.append("%s_sum%s %s" % (self.name, labels, number(value[-1])))
+        lines.append("%s_count%s %d" % (self.name, labels, total))
+        return lines
+
+
+class Registry(object):
+    """
+    Metrics rendered together at /metrics
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        """
+        :param metric: Metric to render
+        :return: metric
+        """
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        :return: Prometheus text exposition of every metric
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    """
+    :param value: label value
+    :return: value escaped for exposition
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def number(value):
+    """
+    :param value: int or float
+    :return: shortest exposition text of value
+    """
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+################################
+# App metrics
+################################
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.add(Histogram(
+    'bowling_request_duration_seconds',
+    "Time to build a response, per route and method",
+    ('route', 'method')))
+
+REQUESTS = REGISTRY.add(Counter(
+    'bowling_requests_total',
+    "Requests answered, per route, method and status",
+    ('route', 'method', 'status')))
+
+REQUEST_MONGO_OPERATIONS = REGISTRY.add(Histogram(
+    'bowling_request_mongo_operations',
+    "MongoDB operations made by a request, per route and method",
+    ('route', 'method'), COUNT_BUCKETS))
+
+REQUEST_MONGO_BYTES = REGISTRY.add(Histogram(
+    'bowling_request_mongo_bytes',
+    "BSON bytes of MongoDB commands and replies of a sampled request, per "
+    "route and method",
+    ('route', 'method'), BYTES_BUCKETS))
+
+MONGO_SECONDS = REGISTRY.add(Histogram(
+    'bowling_mongo_operation_duration_seconds',
+    "MongoDB operation round trip time, per command",
+    ('command',)))
+
+MONGO_FAILURES = REGISTRY.add(Counter(
+    'bowling_mongo_operation_failures_total',
+    "MongoDB operations that failed, per command",
+    ('command',)))
+
+MONGO_SENT_BYTES = REGISTRY.add(Counter(
+    'bowling_mongo_sent_bytes_total',
+    "BSON bytes of MongoDB commands sent by sampled requests, per command",
+    ('command',)))
+
+MONGO_RECEIVED_BYTES = REGISTRY.add(Counter(
+    'bowling_mongo_received_bytes_total',
+    "BSON bytes of MongoDB replies to sampled requests, per command",
+    ('command',)))
+
+SCORING_SECONDS = REGISTRY.add(Histogram(
+    'bowling_scoring_duration_seconds',
+    "Time spent computing scoresheets, per function",
+    ('function',), (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                    0.001, 0.0025, 0.005, 0.01)))
+
+
+def timed(histogram, *label_values):
+    """
+    Decorator observing how long each call of a function takes
+
+    :param histogram: Histogram to observe times in
+    :param label_values: label values to observe times under
+    :return: decorator
+    """
+    def decorate(function):
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            start = default_timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(label_values, default_timer() - start)
+        return timed_function
+    return decorate
+
+
+################################
+# MongoDB operations
+################################
+
+# operations and bytes of the request being handled on this thread
+current = threading.local()
+
+# requests counted so far, picks the requests whose bytes are counted
+counted_requests = count(1)
+
+
+def start_counting(byte_sample=0):
+    """
+    Starts counting MongoDB operations for a request on this thread.  Bytes
+    are only counted for a sample of requests, as the driver does not give
+    sizes and encoding commands and replies again costs as much as decoding
+    them.
+
+    :param byte_sample: count bytes of one in this many requests, 0 for
+        none
+    """
+    current.operations = 0
+    sampled = byte_sample > 0 and next(counted_requests) % byte_sample == 0
+    current.bytes = 0 if sampled else None
+
+
+def stop_counting():
+    """
+    :return: MongoDB operations made since start_counting, None if not
+        counting, and bytes sent and received, None if not sampled
+    """
+    operations = getattr(current, 'operations', None)
+    sent = getattr(current, 'bytes', None)
+    current.operations = current.bytes = None
+    return operations, sent
+
+
+class MongoListener(monitoring.CommandListener):
+    """
+    Records every MongoDB command, events are published on the thread that
+    made the command
+    """
+
+    def started(self, event):
+        if getattr(current, 'operations', None) is not None:
+            current.operations += 1
+        if getattr(current, 'bytes', None) is not None:
+            size = len(BSON.encode(event.command))
+            current.bytes += size
+            MONGO_SENT_BYTES.inc((event.command_name,), size)
+
+    def succeeded(self, event):
+        MONGO_SECONDS.observe((event.command_name,),
+                              event.duration_micros / 1e6)
+        if getattr(current, 'bytes', None) is not None:
+            size = len(BSON.encode(event.reply))
+            current.bytes += size
+            MONGO_RECEIVED_BYTES.inc((event.command_name,), size)
+
+    def failed(self, event):
+        MONGO_SECONDS.observe((event.command_name,),
+                              event.duration_micros / 1e6)
+        MONGO_FAILURES.inc((event.command_name,))
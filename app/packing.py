@@ -0,0 +1,97 @@
+"""
+Packed encoding of a player's rolls
+
+Rolls are packed as bowled, without the 0 padding strikes get before the
+last frame, two to a byte at 4 bits each.  A nibble of 15 pads an odd
+number of rolls, so a full game of 21 rolls packs into 11 bytes.  Packed
+rolls are stored as BSON binary of a user defined subtype, rolls stored
+as a list of integers are read the same way.
+"""
+from bson import Binary
+
+from rules import FRAMES
+
+
+# BSON binary subtype of packed rolls
+SUBTYPE = 0x80
+
+# nibble padding an odd number of rolls
+PAD = 0xF
+
+
+def bowled_rolls(scores):
+    """
+    :param scores: list of scores, strikes padded with a 0
+    :return: list of rolls as bowled, without strike padding
+    """
+    bowled = []
+    index = 0
+    while index < len(scores):
+        score = scores[index]
+        bowled.append(score)
+
+        # strike padding is put back when unpacking
+        if score == 10 and index < (FRAMES - 1) * 2 and index % 2 == 0:
+            if index + 1 < len(scores) and scores[index + 1] != 0:
+                raise ValueError("Strike not padded with a 0")
+            index += 2
+        else:
+            index += 1
+    return bowled
+
+
+def pack_scores(scores):
+    """
+    :param scores: list of scores, strikes padded with a 0
+    :return: packed Binary
+    """
+    bowled = bowled_rolls(scores)
+    if len(bowled) % 2:
+        bowled.append(PAD)
+    packed = bytearray((bowled[number] << 4) | bowled[number + 1]
+                       for number in range(0, len(bowled), 2))
+    return Binary(bytes(packed), SUBTYPE)
+
+
+def is_packed(value):
+    """
+    :param value: stored rolls
+    :return: True if rolls are packed
+    """
+    return isinstance(value, Binary)
+
+
+def unpack_scores(value):
+    """
+    :param value: packed Binary, or list of scores
+    :return: list of scores, strikes padded with a 0
+    """
+    if value is None:
+        return []
+    if not is_packed(value):
+        return list(value)
+
+    scores = []
+    for byte in bytearray(value):
+        for score in (byte >> 4, byte & PAD):
+            if score == PAD:
+                continue
+            first = len(scores) < (FRAMES - 1) * 2 and len(scores) % 2 == 0
+            scores.append(score)
+            if first and score == 10:
+                scores.append(0)
+    return scores
+
+
+def unpack_game(game):
+    """
+    Unpacks every player's rolls of a raw game in place, so rules and
+    scoring only ever see lists
+
+    :param game: raw game document
+    :return: same game
+    """
+    for player in game.get('players', []):
+        if 'raw_scores' in player:
+            player['raw_scores'] = unpack_scores(player['raw_scores'])
+    return game
@@ -0,0 +1,259 @@
+"""
+Sampling request profiler
+
+Profiles one in every N requests, or requests sending the profile header,
+with cProfile.  Each profile is written compressed to a directory, named
+with its time, route, game id and duration, and the oldest profiles are
+removed once the directory is over its size cap.  Only one request is
+profiled at a time per process.
+
+The command line merges saved profiles into a report of the hottest
+functions.
+
+Usage: python app/profiling.py DIRECTORY [--route ROUTE] [--top N]
+"""
+import argparse
+import cProfile
+import marshal
+import os
+import pstats
+import re
+import sys
+import threading
+import zlib
+from datetime import datetime
+from itertools import count
+from timeit import default_timer
+
+from flask import g, request
+
+
+# suffix of saved profiles
+SUFFIX = '.prof.z'
+
+# header asking for a request to be profiled
+HEADER = 'X-Profile'
+
+# bytes of profiles kept before the oldest are removed
+MAX_BYTES = 100 * 1024 * 1024
+
+
+class RequestProfiler(object):
+    """
+    Flask request hooks profiling a sample of requests
+    """
+
+    def __init__(self, directory, sample=0, header=HEADER, token=None,
+                 max_bytes=MAX_BYTES):
+        """
+        :param directory: directory profiles are written to
+        :param sample: profile one in this many requests, 0 for none
+        :param header: header asking for a request to be profiled
+        :param token: value header must have, any value if None
+        :param max_bytes: size cap of directory
+        """
+        self.directory = directory
+        self.sample = sample
+        self.header = header
+        self.token = token
+        self.max_bytes = max_bytes
+        self.__requests = count(1)
+        self.__busy = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def wanted(self):
+        """
+        :return: True if request handled should be profiled
+        """
+        asked = request.headers.get(self.header)
+        if asked is not None and (self.token is None or asked == self.token):
+            return True
+        return self.sample > 0 and next(self.__requests) % self.sample == 0
+
+    def start(self):
+        """
+        Before request hook, starts profiling if request is sampled and no
+        other request is being profiled
+        """
+        g.profile = None
+        if not self.wanted() or not self.__busy.acquire(False):
+            return
+        g.profile = cProfile.Profile()
+        g.profile_started = default_timer()
+        g.profile.enable()
+
+    def finish(self, response):
+        """
+        After request hook, stops profiling and saves profile
+
+        :param response: response to user
+        :return: same response
+        """
+        profile = getattr(g, 'profile', None)
+        if profile is None:
+            return response
+
+        profile.disable()
+        duration = default_timer() - g.profile_started
+        g.profile = None
+        self.__busy.release()
+
+        try:
+            route = request.url_rule.rule if request.url_rule else None
+            game_id = (request.view_args or {}).get('game_id')
+            self.save(profile, request.method, route, game_id, duration)
+        except Exception as exception:
+            print("Profile not saved: " + str(exception))
+        return response
+
+    def abandon(self, exception=None):
+        """
+        Teardown hook, stops profiling a request that failed before its
+        profile was saved
+
+        :param exception: exception ending request, if any
+        """
+        profile = getattr(g, 'profile', None)
+        if profile is not None:
+            profile.disable()
+            g.profile = None
+            self.__busy.release()
+
+    def save(self, profile, method, route, game_id, duration):
+        """
+        Writes a compressed profile and trims directory to its size cap
+
+        :param profile: stopped cProfile.Profile
+        :param method: HTTP method
+        :param route: route pattern, None if unmatched
+        :param game_id: game id requested, None if none
+        :param duration: seconds request took
+        :return: path written
+        """
+        profile.create_stats()
+        data = zlib.compress(marshal.dumps(profile.stats))
+
+        name = profile_name(datetime.utcnow(), method, route, game_id,
+                            duration)
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'wb') as dump:
+            dump.write(data)
+        os.rename(path + '.tmp', path)
+
+        self.trim()
+        return path
+
+    def trim(self):
+        """
+        Removes oldest profiles until directory is under its size cap
+        """
+        profiles = sorted(saved_profiles(self.directory))
+        size = sum(os.path.getsize(path) for path in profiles)
+        for path in profiles:
+            if size <= self.max_bytes:
+                break
+            size -= os.path.getsize(path)
+            os.remove(path)
+
+
+def profile_name(started, method, route, game_id, duration):
+    """
+    File name of a profile, sorting by time
+
+    :param started: datetime of profile
+    :param method: HTTP method
+    :param route: route pattern, None if unmatched
+    :param game_id: game id requested, None if none
+    :param duration: seconds request took
+    :return: file name
+    """
+    # game ids come from the url so keep only what an id can hold
+    game_id = re.sub(r'[^A-Za-z0-9]', '', game_id or '')[:24] or '-'
+    return "%s_%s_%s_%s_%dms%s" % (
+        started.strftime('%Y%m%dT%H%M%S%f'), method, route_slug(route),
+        game_id, duration * 1000, SUFFIX)
+
+
+def route_slug(route):
+    """
+    :param route: route pattern such as /games/<game_id>, None if unmatched
+    :return: route usable in a file name, such as games.game.id
+    """
+    if route is None:
+        return 'unmatched'
+    return re.sub(r'[^A-Za-z0-9]+', '.', route).strip('.') or 'home'
+
+
+def saved_profiles(directory):
+    """
+    :param directory: profiles directory
+    :return: list of paths of saved profiles
+    """
+    return [os.path.join(directory, name) for name in os.listdir(directory)
+            if name.endswith(SUFFIX)]
+
+
+################################
+# Reports
+################################
+
+class SavedProfile(object):
+    """
+    Saved profile loadable by pstats
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as dump:
+            self.stats = marshal.loads(zlib.decompress(dump.read()))
+
+    def create_stats(self):
+        pass
+
+
+def merge(paths):
+    """
+    :param paths: list of saved profile paths
+    :return: pstats.Stats of all profiles added together
+    """
+    stats = pstats.Stats(SavedProfile(paths[0]))
+    for path in paths[1:]:
+        stats.add(SavedProfile(path))
+    return stats
+
+
+def main():
+    """
+    Parses command line and prints hottest functions over saved profiles
+    """
+    parser = argparse.ArgumentParser(
+        description="Merge saved request profiles into a report")
+    parser.add_argument('directory')
+    parser.add_argument('--route', help="only profiles of routes containing "
+                                        "this, such as games.game.id")
+    parser.add_argument('--method', help="only profiles of this method")
+    parser.add_argument('--sort', default='cumulative',
+                        help="pstats sort key, default cumulative")
+    parser.add_argument('--top', type=int, default=30,
+                        help="functions listed, default 30")
+    args = parser.parse_args()
+
+    paths = []
+    for path in sorted(saved_profiles(args.directory)):
+        _, method, route = os.path.basename(path).split('_')[:3]
+        if args.route and args.route not in route:
+            continue
+        if args.method and args.method.upper() != method:
+            continue
+        paths.append(path)
+    if not paths:
+        print("No profiles found")
+        sys.exit(1)
+
+    print("Merged %d profiles" % len(paths))
+    merge(paths).strip_dirs().sort_stats(args.sort).print_stats(args.top)
+
+
+if __name__ == '__main__':
+    main()
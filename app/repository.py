@@ -0,0 +1,577 @@
+"""
+Storage backends behind the API routes
+
+Routes only talk to a GameRepository so the same API can run against
+MongoDB or an in-process memory store for local runs and load tests.
+"""
+import threading
+from bisect import bisect_right
+from copy import deepcopy
+
+from bson import ObjectId
+from mongoengine import connect
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, \
+    Secondary, SecondaryPreferred
+
+from datastore import DATABASE, Game, Player
+from export import BATCH_SIZE, mongo_games
+from metrics import MongoListener
+from packing import pack_scores, unpack_game
+from rules import TURN_FIELDS, apply_rolls, deactivate
+from stats import MemoryStats, MongoStats, active_flags, ended_players
+from views import GAME_FIELDS, LISTING_FIELDS, GameView
+
+
+class Conflict(Exception):
+    """
+    Raised when a game keeps changing underneath a conditional update
+    """
+    pass
+
+
+class GameRepository(object):
+    """
+    Interface every storage backend implements, games are returned as
+    GameView objects and missing games raise Game.DoesNotExist.  Each
+    backend keeps a StatsStore as stats, updated as players' games end.
+    """
+
+    def list_games(self, limit, after=None, active=None, started_after=None,
+                   started_before=None, player=None):
+        """
+        Games in id order, only id, active and players' names and totals are
+        required to be loaded
+
+        :param limit: maximum number of games
+        :param after: only games with ids after this ObjectId
+        :param active: only games with this active flag
+        :param started_after: only games started at or after this datetime
+        :param started_before: only games started before this datetime
+        :param player: only games with a player of this name
+        :return: list of GameView objects
+        """
+        raise NotImplementedError
+
+    def get_game(self, game_id, latest=False):
+        """
+        :param game_id: ObjectId of game
+        :param latest: read from where writes go, reads may otherwise lag
+            writes by the backend's staleness limit
+        :return: GameView
+        """
+        raise NotImplementedError
+
+    def revision(self, game_id, latest=False):
+        """
+        Current revision of a game without loading the rest of it, every
+        write bumps the revision
+
+        :param game_id: ObjectId of game
+        :param latest: read from where writes go
+        :return: revision number, 0 if never changed
+        """
+        raise NotImplementedError
+
+    def create_game(self, players):
+        """
+        :param players: list of Player objects
+        :return: new Game
+        """
+        raise NotImplementedError
+
+    def create_games(self, player_lists):
+        """
+        Creates many games with one write, a game that fails to be written
+        does not stop the others
+
+        :param player_lists: list of lists of Player objects
+        :return: list in same order of new Games, or error message for
+        games not written
+        """
+        raise NotImplementedError
+
+    def push_roll(self, game_id, score):
+        """
+        Applies a roll to the player whose turn it is
+
+        :param game_id: ObjectId of game
+        :param score: number of pins knocked down
+        :return: updated GameView
+        """
+        return self.push_rolls(game_id, [score])
+
+    def push_rolls(self, game_id, scores):
+        """
+        Applies rolls in order with one write, none are applied if any roll
+        breaks the rules
+
+        :param game_id: ObjectId of game
+        :param scores: list of pins knocked down
+        :return: updated GameView
+        """
+        raise NotImplementedError
+
+    def deactivate(self, game_id, player_id=None):
+        """
+        Inactivates a player, or the whole game if no player given
+
+        :param game_id: ObjectId of game
+        :param player_id: player to inactivate
+        :return: updated GameView
+        """
+        raise NotImplementedError
+
+    def export_games(self, after=None, since=None, batch_size=BATCH_SIZE):
+        """
+        Walks every game in id order, a batch at a time
+
+        :param after: only games with ids after this ObjectId
+        :param since: only games started at or after this datetime
+        :param batch_size: games read per batch
+        :return: generator of raw game documents, not to be changed
+        """
+        raise NotImplementedError
+
+    def rebuild_stats(self):
+        """
+        Recomputes statistics and leaderboards from every game
+        """
+        raise NotImplementedError
+
+    def record_ended(self, was_active, game):
+        """
+        Adds players whose game just ended to statistics, a failure is only
+        logged since the game change is already saved
+
+        :param was_active: game and players' active flags before change
+        :param game: raw game document after change
+        """
+        try:
+            ended = ended_players(was_active, game)
+            if ended:
+                self.stats.record(game, ended)
+        except Exception as exception:
+            print("Statistics not recorded for game " + str(game['_id']) +
+                  ": " + str(exception))
+
+
+def roll_changes(game, scores):
+    """
+    Applies rolls to a raw game, keeping each player's stored scoresheet in
+    step with their new rolls
+
+    :param game: raw game document, updated in place
+    :param scores: list of pins knocked down
+    :return: map of index of each player who bowled to rolls added and map
+        of player fields changed
+    """
+    # raises InvalidRoll
+    appended = apply_rolls(game, scores)
+
+    changed = {}
+    for index, rolls in appended.items():
+        player = game['players'][index]
+        changes = Player.score_fields(player, rolls)
+        changes['active'] = player['active']
+        player.update(changes)
+        changed[index] = (rolls, changes)
+    return changed
+
+
+################################
+# MongoDB storage
+################################
+
+def listing(collection, limit, after=None, active=None, started_after=None,
+            started_before=None, player=None):
+    """
+    Cursor listing games in id order, only fetching fields used in
+    listings.  Each filter is served by one of the indexes declared on
+    Game.  Active and player filters read ids in order off the index, a
+    date range is sorted by id after the scan, keeping only one page.
+
+    :param collection: games collection
+    :return: pymongo Cursor, see GameRepository.list_games for parameters
+    """
+    filters = {}
+    if after is not None:
+        filters['_id'] = {'$gt': after}
+    if active is not None:
+        filters['active'] = active
+    if started_after is not None or started_before is not None:
+        filters['date_started'] = {}
+    if started_after is not None:
+        filters['date_started']['$gte'] = started_after
+    if started_before is not None:
+        filters['date_started']['$lt'] = started_before
+    if player is not None:
+        filters['players.name'] = player
+    return collection.find(filters, LISTING_FIELDS).sort('_id', 1) \
+        .limit(limit)
+
+
+class MongoRepository(GameRepository):
+    """
+    Games stored in MongoDB, writes are single conditional updates
+    """
+
+    # attempts at a conditional update before giving up
+    MAX_RETRIES = 5
+
+    def __init__(self, db=DATABASE, pack_rolls=False, reads=None,
+                 **settings):
+        """
+        :param db: database name
+        :param pack_rolls: store rolls packed, rolls are read in either form
+        :param reads: read preference of game, listing, export and
+            statistics reads, primary if None
+        :param settings: MongoDB client settings
+        """
+        self.pack_rolls = pack_rolls
+
+        # every command is counted and timed for /metrics
+        connect(db, event_listeners=[MongoListener()], **settings)
+        self.stats = MongoStats(Game._get_db(), reads)
+
+        # writes and reads needing the latest game always use the primary
+        self.reads = Game._get_collection()
+        if reads is not None:
+            self.reads = self.reads.with_options(read_preference=reads)
+
+        # builds in the background, nothing to do if indexes exist
+        Game.ensure_indexes()
+
+    def list_games(self, limit, after=None, active=None, started_after=None,
+                   started_before=None, player=None):
+        games = list(listing(self.reads, limit, after, active, started_after,
+                             started_before, player))
+
+        # games saved before scoresheets were stored and not backfilled
+        # are read again with their rolls to be scored
+        unscored = [game['_id'] for game in games
+                    if any('total' not in entry for entry in game['players'])]
+        if unscored:
+            fields = dict(LISTING_FIELDS, **{'players.raw_scores': 1})
+            rolls = dict((game['_id'], game) for game in self.reads.find(
+                {'_id': {'$in': unscored}}, fields))
+            games = [rolls.get(game['_id'], game) for game in games]
+        return [GameView(game) for game in games]
+
+    def get_game(self, game_id, latest=False):
+        game = self.__reads(latest).find_one({'_id': game_id}, GAME_FIELDS)
+        if game is None:
+            raise Game.DoesNotExist("Game ID can not be found")
+        return GameView(game)
+
+    def revision(self, game_id, latest=False):
+        game = self.__reads(latest).find_one({'_id': game_id},
+                                             {'revision': 1})
+        if game is None:
+            raise Game.DoesNotExist("Game ID can not be found")
+        return game.get('revision', 0)
+
+    def create_game(self, players):
+        return Game(players=players).save()
+
+    def create_games(self, player_lists):
+        new_games = [Game(players=players) for players in player_lists]
+        for game in new_games:
+            game.validate()
+
+        # unordered so every game is tried, ids are set on documents first
+        documents, errors = [game.to_mongo() for game in new_games], {}
+        try:
+            Game._get_collection().insert_many(documents, ordered=False)
+        except BulkWriteError as exception:
+            for error in exception.details['writeErrors']:
+                errors[error['index']] = error['errmsg']
+
+        for num, (game, document) in enumerate(zip(new_games, documents)):
+            if num in errors:
+                new_games[num] = errors[num]
+            else:
+                game.id = document['_id']
+        return new_games
+
+    def push_rolls(self, game_id, scores):
+        def roll(game):
+            # raises InvalidRoll, status is built once turn has moved on
+            changed = roll_changes(game, scores)
+            status = self.__status(game)
+            for index, (rolls, changes) in changed.items():
+                player = 'players.' + str(index)
+
+                # whole rolls are set so stored format can change
+                scores_after = game['players'][index]['raw_scores']
+                status[player + '.raw_scores'] = pack_scores(scores_after) \
+                    if self.pack_rolls else scores_after
+                for field, value in changes.items():
+                    status[player + '.' + field] = value
+
+            return {'$set': status}
+
+        return self.__conditional_update(game_id, roll)
+
+    def deactivate(self, game_id, player_id=None):
+        def end(game):
+            # raises RuleError if already inactive
+            index = deactivate(game, player_id)
+            status = self.__status(game)
+            if index is not None:
+                status['players.%d.active' % index] = False
+            return {'$set': status}
+
+        return self.__conditional_update(game_id, end)
+
+    def export_games(self, after=None, since=None, batch_size=BATCH_SIZE):
+        return mongo_games(self.reads, after, since, batch_size)
+
+    def rebuild_stats(self):
+        self.stats.rebuild(Game._get_collection())
+
+    def __reads(self, latest):
+        """
+        :param latest: read from primary
+        :return: games collection to read from
+        """
+        return Game._get_collection() if latest else self.reads
+
+    def __status(self, game):
+        """
+        Builds fields to set for game status and turn
+
+        :param game: raw game document after change
+        :return: map of fields to set
+        """
+        status = {'active': game['active']}
+        for field in TURN_FIELDS:
+            status[field] = game[field]
+        return status
+
+    def __conditional_update(self, game_id, change):
+        """
+        Applies a change with one conditional update guarded by the game's
+        revision, retrying if another write got there first
+
+        :param game_id: ObjectId of game
+        :param change: function changing a raw game, returns update document
+        :return: updated GameView
+        """
+        collection = Game._get_collection()
+
+        for _ in range(self.MAX_RETRIES):
+            game = collection.find_one({'_id': game_id})
+            if game is None:
+                raise Game.DoesNotExist("Game ID can not be found")
+            unpack_game(game)
+
+            # guard on revision read, games saved before revisions existed
+            # have no field to match
+            guard = {'_id': game_id}
+            if 'revision' in game:
+                guard['revision'] = game['revision']
+            else:
+                guard['revision'] = {'$exists': False}
+
+            was_active = active_flags(game)
+            update = change(game)
+            update['$inc'] = {'revision': 1}
+
+            updated = collection.find_one_and_update(
+                guard, update, return_document=ReturnDocument.AFTER)
+            if updated is not None:
+                unpack_game(updated)
+                self.record_ended(was_active, updated)
+                return GameView(updated)
+
+        raise Conflict("Game updated too many times concurrently")
+
+
+################################
+# In-process memory storage
+################################
+
+class MemoryRepository(GameRepository):
+    """
+    Games stored as raw documents in a dict, for local runs and load tests
+    without a database.  Writes to a game are serialized by a per-game lock
+    and replace the stored document, so reads never see a half applied
+    write and need no lock.
+    """
+
+    def __init__(self):
+        self.__games = {}
+        self.__locks = {}
+        self.__ids = []
+        self.__lock = threading.Lock()
+        self.stats = MemoryStats()
+
+    def list_games(self, limit, after=None, active=None, started_after=None,
+                   started_before=None, player=None):
+        # ids are created in order so start after given id by bisecting
+        start = 0 if after is None else bisect_right(self.__ids, after)
+
+        games = []
+        for game_id in self.__ids[start:]:
+            if len(games) == limit:
+                break
+            game = self.__games[game_id]
+            if active is not None and game['active'] != active:
+                continue
+            if started_after is not None \
+                    and game['date_started'] < started_after:
+                continue
+            if started_before is not None \
+                    and game['date_started'] >= started_before:
+                continue
+            if player is not None and player not in \
+                    [entry['name'] for entry in game['players']]:
+                continue
+            games.append(GameView(game))
+        return games
+
+    def get_game(self, game_id, latest=False):
+        return GameView(self.__stored(game_id))
+
+    def revision(self, game_id, latest=False):
+        return self.__stored(game_id).get('revision', 0)
+
+    def create_game(self, players):
+        return self.create_games([players])[0]
+
+    def create_games(self, player_lists):
+        documents = []
+        for players in player_lists:
+            game = Game(players=players)
+            game.validate()
+            documents.append(game.to_mongo().to_dict())
+
+        # ids handed out under lock so they are stored in order
+        with self.__lock:
+            for document in documents:
+                document['_id'] = ObjectId()
+                self.__games[document['_id']] = document
+                self.__locks[document['_id']] = threading.Lock()
+                self.__ids.append(document['_id'])
+        return [Game._from_son(document) for document in documents]
+
+    def push_rolls(self, game_id, scores):
+        def roll(game):
+            roll_changes(game, scores)
+
+        return self.__update(game_id, roll)
+
+    def deactivate(self, game_id, player_id=None):
+        def end(game):
+            deactivate(game, player_id)
+
+        return self.__update(game_id, end)
+
+    def export_games(self, after=None, since=None, batch_size=BATCH_SIZE):
+        start = 0 if after is None else bisect_right(self.__ids, after)
+        for game_id in self.__ids[start:]:
+            game = self.__games[game_id]
+            if since is None or game['date_started'] >= since:
+                yield game
+
+    def rebuild_stats(self):
+        self.stats.rebuild(self.__games.values())
+
+    def __stored(self, game_id):
+        """
+        :param game_id: ObjectId of game
+        :return: stored raw game document
+        """
+        try:
+            return self.__games[game_id]
+        except KeyError:
+            raise Game.DoesNotExist("Game ID can not be found")
+
+    def __update(self, game_id, change):
+        """
+        Applies a change to a copy of a game under its lock and stores the
+        copy if the change succeeds
+
+        :param game_id: ObjectId of game
+        :param change: function changing a raw game in place
+        :return: updated GameView
+        """
+        self.__stored(game_id)
+        with self.__locks[game_id]:
+            game = deepcopy(self.__games[game_id])
+            was_active = active_flags(game)
+            change(game)
+            game['revision'] = game.get('revision', 0) + 1
+            self.__games[game_id] = game
+
+        self.record_ended(was_active, game)
+        return GameView(game)
+
+
+################################
+# Backend selection
+################################
+
+REPOSITORIES = {
+    'mongo': MongoRepository,
+    'memory': MemoryRepository
+}
+
+
+def create_repository(name='mongo', db=DATABASE, pack_rolls=False,
+                      reads='primary', max_staleness=None, **settings):
+    """
+    Builds storage backend by name
+
+    :param name: mongo or memory
+    :param db: database name, mongo only
+    :param pack_rolls: store rolls packed, mongo only
+    :param reads: read preference mode of reads that may lag, mongo only
+    :param max_staleness: seconds a secondary may lag and still be read,
+        mongo only
+    :param settings: MongoDB client settings, mongo only
+    :return: GameRepository
+    """
+    if name not in REPOSITORIES:
+        raise ValueError("Unknown storage backend " + str(name))
+    if name == 'mongo':
+        return MongoRepository(db, pack_rolls,
+                               read_preference(reads, max_staleness),
+                               **settings)
+    return REPOSITORIES[name]()
+
+
+################################
+# Read routing
+################################
+
+# read preference modes by name, as in MongoDB connection strings
+READ_PREFERENCES = {
+    'primary': Primary,
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest
+}
+
+
+def read_preference(mode='primary', max_staleness=None):
+    """
+    Builds a read preference, MongoDB 3.4 or later is needed to bound
+    staleness and the bound must be at least 90 seconds
+
+    :param mode: read preference mode name
+    :param max_staleness: seconds a secondary may lag the primary and
+        still be read, None for no limit
+    :return: pymongo read preference
+    """
+    if mode not in READ_PREFERENCES:
+        raise ValueError("Unknown read preference " + str(mode))
+    if mode == 'primary':
+        if max_staleness is not None:
+            raise ValueError("Max staleness needs reads from secondaries")
+        return Primary()
+    return READ_PREFERENCES[mode](
+        max_staleness=-1 if max_staleness is None else max_staleness)
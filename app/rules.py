@@ -0,0 +1,265 @@
+"""
+Rules for applying a roll to a game
+
+Works on raw game documents (dicts shaped like the games collection) so the
+same rules can build atomic database updates without loading Game objects.
+"""
+from numbers import Integral
+
+# frames in a game, last frame can have a third fill roll
+FRAMES = 10
+
+# game document fields holding the turn pointer
+TURN_FIELDS = ('current_player', 'current_frame', 'current_roll')
+
+
+class RuleError(ValueError):
+    """
+    Raised when a request breaks the rules of the game
+    """
+    pass
+
+
+class InvalidRoll(RuleError):
+    """
+    Raised when a roll breaks the rules of the game, index is the roll's
+    position when applying many rolls
+    """
+
+    def __init__(self, message, index=None):
+        super(InvalidRoll, self).__init__(message)
+        self.index = index
+
+
+class Turn(object):
+    """
+    Turn pointer state machine: which player is up, in which frame (1 - 10)
+    and which roll of the frame (1 - 3)
+    """
+
+    def __init__(self, player=1, frame=1, roll=1):
+        self.player = player
+        self.frame = frame
+        self.roll = roll
+
+    @classmethod
+    def of(cls, game):
+        """
+        Reads turn pointer from a game, working it out from scores if the
+        game was saved before turns were stored
+
+        :param game: raw game document
+        :return: Turn
+        """
+        if 'current_player' not in game:
+            return cls.backfill(game)
+        return cls(game['current_player'], game['current_frame'],
+                   game['current_roll'])
+
+    @classmethod
+    def backfill(cls, game):
+        """
+        Works out turn pointer from players' scores, player part way through
+        a frame is up, otherwise the first player with fewest frames
+
+        :param game: raw game document
+        :return: Turn
+        """
+        turn = None
+        for player in game['players']:
+
+            # if player is inactive or done then skip
+            scores = player.get('raw_scores', [])
+            if not player.get('active', True) or finished(scores):
+                continue
+
+            frame, roll = position(scores)
+            if roll > 1:
+                return cls(player['player_id'], frame, roll)
+            if turn is None or frame < turn.frame:
+                turn = cls(player['player_id'], frame, roll)
+
+        # no active players, leave pointer at start
+        return turn or cls()
+
+    def store(self, game):
+        """
+        Writes turn pointer onto a game
+
+        :param game: raw game document
+        """
+        game['current_player'] = self.player
+        game['current_frame'] = self.frame
+        game['current_roll'] = self.roll
+
+    def rolled(self, scores):
+        """
+        Moves on within the frame after a roll was added to scores
+
+        :param scores: player's scores including new roll
+        :return: True if player's frame is complete
+        """
+        # strike or second roll ends frames before the last
+        if self.frame < FRAMES:
+            if self.roll == 1 and len(scores) % 2 == 1:
+                self.roll = 2
+                return False
+            return True
+
+        # last frame gets a fill roll for a strike or spare
+        first, second = scores[18:20] + [0] * (20 - len(scores))
+        if self.roll == 1 or (self.roll == 2 and first + second >= 10):
+            self.roll += 1
+            return False
+        return True
+
+    def pass_on(self, game):
+        """
+        Passes turn to next active player, later players bowl this frame and
+        earlier players the next.  Ends the game if nobody is left.
+
+        :param game: raw game document
+        """
+        active = [player['player_id'] for player in game['players']
+                  if player.get('active', True)]
+        following = [player_id for player_id in active
+                     if player_id > self.player]
+
+        if following:
+            self.player = following[0]
+        elif active and self.frame < FRAMES:
+            self.player = active[0]
+            self.frame += 1
+        else:
+            # nobody left to bowl
+            game['active'] = False
+        self.roll = 1
+
+
+def position(scores):
+    """
+    Frame and roll a player's next roll falls on
+
+    :param scores: player's scores, strikes padded with a 0
+    :return: frame number (1 - 10), roll number (1 - 3)
+    """
+    if len(scores) < 18:
+        return len(scores) // 2 + 1, len(scores) % 2 + 1
+    return FRAMES, len(scores) - 17
+
+
+def finished(scores):
+    """
+    Checks if a player has bowled every frame
+
+    :param scores: player's scores, strikes padded with a 0
+    :return: True if no rolls left
+    """
+    return len(scores) > 20 or \
+        (len(scores) == 20 and sum(scores[18:]) < 10)
+
+
+def apply_roll(game, score):
+    """
+    Assigns a roll to the player whose turn it is, updating the game document
+    in place
+
+    :param game: raw game document
+    :param score: number of pins knocked down
+    :return: index of player who bowled, list of rolls appended to scores
+    """
+    # check if game active
+    if not game.get('active', True):
+        raise InvalidRoll("Game is no longer active")
+
+    # validate roll value, rolls must be whole numbers, not true/false
+    if isinstance(score, bool) or not isinstance(score, Integral) \
+            or not (0 <= score <= 10):
+        raise InvalidRoll("Roll must be integer between 0 - 10")
+
+    turn = Turn.of(game)
+    index = turn.player - 1
+    player = game['players'][index]
+    if not player.get('active', True):
+        raise InvalidRoll("No active players remain")
+    scores = player.setdefault('raw_scores', [])
+
+    # check if second roll too high, last frame pins reset after a strike
+    if turn.roll == 2 and scores[-1] != 10 and scores[-1] + score > 10:
+        raise InvalidRoll("Second roll is too high")
+    if turn.roll == 3 and scores[-2] == 10 and scores[-1] != 10 \
+            and scores[-1] + score > 10:
+        raise InvalidRoll("Fill roll is too high")
+
+    # if first roll is a 10 then add 0 too unless end frame
+    if score == 10 and turn.roll == 1 and turn.frame < FRAMES:
+        rolls = [score, 0]
+    else:
+        rolls = [score]
+    scores.extend(rolls)
+
+    # player is done after last frame, then move turn on
+    if turn.rolled(scores):
+        if turn.frame == FRAMES:
+            player['active'] = False
+        turn.pass_on(game)
+    turn.store(game)
+
+    return index, rolls
+
+
+def apply_rolls(game, scores):
+    """
+    Assigns rolls in order, updating the game document in place
+
+    :param game: raw game document
+    :param scores: list of pins knocked down
+    :return: map of index of each player who bowled to rolls appended
+    """
+    appended = {}
+    for number, score in enumerate(scores):
+        try:
+            index, rolls = apply_roll(game, score)
+        except InvalidRoll as exception:
+            exception.index = number
+            raise
+        appended.setdefault(index, []).extend(rolls)
+    return appended
+
+
+def deactivate(game, player_id=None):
+    """
+    Inactivates a player, passing turn on if it was theirs, or the whole game
+    if no player given.  Updates the game document in place.
+
+    :param game: raw game document
+    :param player_id: player to inactivate, None for whole game
+    :return: index of player inactivated, None for whole game
+    """
+    # if game already inactive nothing to do
+    if not game.get('active', True):
+        raise RuleError("Game already inactive")
+
+    # if not trying to inactivate player inactivate game
+    turn = Turn.of(game)
+    if player_id is None:
+        game['active'] = False
+        turn.store(game)
+        return None
+
+    # check if valid player id
+    if not (0 < player_id < len(game['players']) + 1):
+        raise RuleError("Player ID outside integer range")
+
+    # inactive player matching id unless already inactive
+    player = game['players'][player_id - 1]
+    if not player.get('active', True):
+        raise RuleError("Player already inactive")
+    player['active'] = False
+
+    # move turn on if it was theirs, game ends if nobody left
+    if turn.player == player_id:
+        turn.pass_on(game)
+    turn.store(game)
+
+    return player_id - 1
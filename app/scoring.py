@@ -0,0 +1,176 @@
+"""
+Incremental scoring engine
+
+Scores a player's rolls one at a time in the raw_scores layout (strikes
+before the last frame padded with a 0), producing the same scoresheet as
+scoring the whole list at once.
+"""
+
+
+class ScoreState(object):
+    """
+    Running scoresheet updated in constant time per roll
+
+    Bonus rolls are only counted towards a strike or spare once a roll has
+    followed them, so a sheet always matches one scored from the full list.
+    """
+    STRIKE = "X"
+    SPARE = "S"
+
+    def __init__(self):
+        self.rolls = 0
+        self.last = 0
+        self.first = 0
+        self.fill = False
+        self.pending = []
+        self.frame_results = []
+        self.frame_scores = []
+        self.total = 0
+
+    @classmethod
+    def from_rolls(cls, scores):
+        """
+        Builds state by adding each roll in turn
+
+        :param scores: list of rolls
+        :return: ScoreState
+        """
+        state = cls()
+        for score in scores:
+            state.add(score)
+        return state
+
+    @classmethod
+    def from_dict(cls, values):
+        """
+        Rebuilds state saved with to_dict
+
+        :param values: map of state values
+        :return: ScoreState
+        """
+        state = cls()
+        for key in ('rolls', 'last', 'first', 'fill', 'total'):
+            setattr(state, key, values[key])
+        state.pending = [list(bonus) for bonus in values['pending']]
+        state.frame_results = list(values['frame_results'])
+        state.frame_scores = list(values['frame_scores'])
+        return state
+
+    def to_dict(self):
+        """
+        Saves state to a map of plain values
+
+        :return: map of state values
+        """
+        values = self.score_sheet()
+        values.update({
+            "rolls": self.rolls,
+            "last": self.last,
+            "first": self.first,
+            "fill": self.fill,
+            "pending": [list(bonus) for bonus in self.pending]
+        })
+        return values
+
+    def score_sheet(self):
+        """
+        Player's frame results, frame scores and running total
+
+        :return: scoresheet map
+        """
+        return {
+            "frame_results": list(self.frame_results),
+            "frame_scores": list(self.frame_scores),
+            "total": self.total
+        }
+
+    def add(self, score):
+        """
+        Adds the next roll to the scoresheet
+
+        :param score: pins knocked down, 0 for strike padding
+        """
+        roll = self.rolls
+
+        # previous roll now followed by another so counts towards bonuses
+        if roll > 0:
+            self.__add_bonus(roll - 1, self.last)
+
+        # add in fill scores for last frame strike or spare
+        if roll == 19:
+            self.fill = self.first == 10 or self.first + score == 10
+        if roll > 18 and self.fill:
+            if score == 10:
+                self.frame_results[9] += "-" + self.STRIKE
+            else:
+                self.frame_results[9] += "-" + str(score)
+            self.__add_score(9, score)
+
+        # check if frame's first roll
+        elif roll % 2 != 1:
+            self.first = score
+            self.frame_scores.append(0)
+
+            # add strike symbol, bonus comes from next two rolls
+            if score == 10:
+                self.frame_results.append(self.STRIKE)
+                if roll < 18:
+                    self.pending.append([roll // 2, roll + 2, True])
+            else:
+                self.frame_results.append(str(score))
+            self.__add_score(roll // 2, score)
+
+        # otherwise frame's second roll
+        else:
+            frame = roll // 2
+            frame_score = self.frame_scores[frame] + score
+
+            # if score equals 10 and not a strike, then spare
+            if score != 0 and frame_score == 10:
+                self.frame_results[frame] += "-" + self.SPARE
+                self.pending.append([frame, roll + 1, False])
+
+            # otherwise only show score if first wasn't a strike
+            elif frame_score < 10:
+                self.frame_results[frame] += "-" + str(score)
+            self.__add_score(frame, score)
+
+        self.last = score
+        self.rolls += 1
+
+    def __add_score(self, frame, score):
+        """
+        Adds points to a frame and the total
+
+        :param frame: frame index
+        :param score: points to add
+        """
+        self.frame_scores[frame] += score
+        self.total += score
+
+    def __add_bonus(self, roll, score):
+        """
+        Adds a roll to strikes and spares waiting on it
+
+        :param roll: roll number
+        :param score: pins knocked down on roll
+        """
+        waiting = []
+        for bonus in self.pending:
+            frame, wanted, strike = bonus
+            if wanted != roll:
+                waiting.append(bonus)
+                continue
+
+            self.__add_score(frame, score)
+
+            # strike wants one more, skipping padding after another strike
+            # unless it falls in the last frame
+            if strike:
+                if score < 10 or roll + 1 == 19:
+                    bonus[1] = roll + 1
+                else:
+                    bonus[1] = roll + 2
+                bonus[2] = False
+                waiting.append(bonus)
+        self.pending = waiting
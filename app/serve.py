@@ -0,0 +1,46 @@
+"""
+Asynchronous serving mode
+
+Serves the same app as api.py from a gevent server, each connection is a
+greenlet instead of a thread.  The standard library is patched before the
+app is loaded so pymongo's sockets, the memory store's locks and event
+stream queues all yield while waiting, letting one process hold thousands
+of connections including long lived event streams.
+
+Usage: python app/serve.py [--host HOST] [--port PORT]
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from api import app
+
+
+# connections served at once, more wait to be accepted
+MAX_CONNECTIONS = 10000
+
+
+def main():
+    """
+    Parses command line and serves app until stopped
+    """
+    parser = argparse.ArgumentParser(
+        description="Serve bowling tracker asynchronously")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--max-connections', type=int,
+                        default=MAX_CONNECTIONS)
+    args = parser.parse_args()
+
+    server = WSGIServer((args.host, args.port), app,
+                        spawn=Pool(args.max_connections))
+    print("Serving on %s:%d" % (args.host, args.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+"""
+Player statistics and leaderboards
+
+Aggregates are updated as each player's game ends, so reading them costs
+the same however much history there is.  A full rebuild recomputes them
+from every game.
+"""
+import threading
+
+from pymongo import ReplaceOne
+
+from rules import FRAMES, finished
+
+
+# games kept on each leaderboard
+LEADERBOARD_SIZE = 10
+
+# leaderboard of every game, others are per day started
+ALL_TIME = 'all'
+
+
+def frame_marks(scores):
+    """
+    Counts frames bowled and strikes and spares, only the first mark of the
+    last frame counts
+
+    :param scores: player's scores, strikes padded with a 0
+    :return: frames, strikes, spares
+    """
+    strikes, spares = 0, 0
+    for frame in range(FRAMES):
+        rolls = scores[frame * 2:frame * 2 + 2]
+        if rolls and rolls[0] == 10:
+            strikes += 1
+        elif len(rolls) == 2 and sum(rolls) == 10:
+            spares += 1
+    frames = min(len(scores) // 2, FRAMES)
+    return frames, strikes, spares
+
+
+def player_line(game, index):
+    """
+    Summary of a player's ended game, only complete games count towards
+    averages and leaderboards
+
+    :param game: raw game document
+    :param index: index of player
+    :return: map of values to record
+    """
+    player = game['players'][index]
+    scores = player.get('raw_scores', [])
+    frames, strikes, spares = frame_marks(scores)
+    return {
+        "game_id": str(game['_id']),
+        "player_id": player['player_id'],
+        "name": player['name'],
+        "day": game['date_started'].strftime('%Y-%m-%d'),
+        "total": player.get('total', 0),
+        "complete": finished(scores),
+        "frames": frames,
+        "strikes": strikes,
+        "spares": spares
+    }
+
+
+def ended_players(was_active, game):
+    """
+    Players whose game ended with a change, by finishing, being inactivated
+    or the game being inactivated
+
+    :param was_active: game active flag and players' active flags before
+    :param game: raw game document after change
+    :return: list of player indexes
+    """
+    game_active, players_active = was_active
+    if not game_active:
+        return []
+    return [index for index, player in enumerate(game['players'])
+            if players_active[index]
+            and not (game['active'] and player.get('active', True))]
+
+
+def active_flags(game):
+    """
+    Game and players' active flags to compare after a change
+
+    :param game: raw game document
+    :return: game active flag, list of players' active flags
+    """
+    return game.get('active', True), \
+        [player.get('active', True) for player in game['players']]
+
+
+def player_summary(stats):
+    """
+    Builds statistics returned to user from stored counts
+
+    :param stats: stored counts for a name
+    :return: statistics map
+    """
+    games, frames = stats['games'], stats['frames']
+    open_frames = frames - stats['strikes']
+    return {
+        "name": stats['_id'],
+        "games": games,
+        "average": round(float(stats['pins']) / games, 2) if games else 0,
+        "high_game": stats['high_game'],
+        "frames": frames,
+        "strike_rate": round(float(stats['strikes']) / frames, 3)
+        if frames else 0,
+        "spare_rate": round(float(stats['spares']) / open_frames, 3)
+        if open_frames else 0
+    }
+
+
+def leaderboard_entry(line):
+    """
+    :param line: summary of player's game
+    :return: leaderboard entry
+    """
+    return dict((key, line[key])
+                for key in ('game_id', 'player_id', 'name', 'total'))
+
+
+class StatsStore(object):
+    """
+    Interface every statistics store implements
+    """
+
+    def record(self, game, indexes):
+        """
+        Adds players' ended games to statistics
+
+        :param game: raw game document
+        :param indexes: list of indexes of players whose game ended
+        """
+        raise NotImplementedError
+
+    def player(self, name):
+        """
+        :param name: player name
+        :return: statistics map, None if name has no ended games
+        """
+        raise NotImplementedError
+
+    def leaderboard(self, day=ALL_TIME):
+        """
+        :param day: YYYY-MM-DD day games started, or ALL_TIME
+        :return: list of leaderboard entries, highest first
+        """
+        raise NotImplementedError
+
+
+################################
+# MongoDB statistics
+################################
+
+class MongoStats(StatsStore):
+    """
+    Counts per name in player_stats, top games per day in leaderboards
+    """
+
+    def __init__(self, db, reads=None):
+        """
+        :param db: database holding statistics
+        :param reads: read preference of statistics reads, primary if None
+        """
+        self.players = db['player_stats']
+        self.leaderboards = db['leaderboards']
+        self.player_reads = db.get_collection('player_stats',
+                                              read_preference=reads)
+        self.board_reads = db.get_collection('leaderboards',
+                                             read_preference=reads)
+
+    def record(self, game, indexes):
+        for index in indexes:
+            line = player_line(game, index)
+            complete = line['complete']
+            counts = {
+                'games': 1 if complete else 0,
+                'pins': line['total'] if complete else 0,
+                'frames': line['frames'],
+                'strikes': line['strikes'],
+                'spares': line['spares']
+            }
+            high_game = line['total'] if complete else 0
+            self.players.update_one(
+                {'_id': line['name']},
+                {'$inc': counts, '$max': {'high_game': high_game}},
+                upsert=True)
+
+            # complete games compete for all time and day's leaderboards
+            if line['complete']:
+                entry = leaderboard_entry(line)
+                for board in (ALL_TIME, line['day']):
+                    self.leaderboards.update_one({'_id': board}, {
+                        '$push': {'top': {
+                            '$each': [entry],
+                            '$sort': {'total': -1},
+                            '$slice': LEADERBOARD_SIZE
+                        }}
+                    }, upsert=True)
+
+    def player(self, name):
+        stats = self.player_reads.find_one({'_id': name})
+        return player_summary(stats) if stats else None
+
+    def leaderboard(self, day=ALL_TIME):
+        board = self.board_reads.find_one({'_id': day})
+        return board['top'] if board else []
+
+    def rebuild(self, games):
+        """
+        Recomputes every statistic from ended games with aggregation
+        pipelines, replacing stored statistics.  Statistics come from
+        stored scoresheets so backfill scoresheets first.
+
+        :param games: games collection
+        """
+        games.aggregate(self.player_pipeline(), allowDiskUse=True)
+
+        # one leaderboard document per day plus all time
+        boards = list(games.aggregate(self.leaderboard_pipeline(),
+                                      allowDiskUse=True))
+        boards.extend(games.aggregate(self.leaderboard_pipeline(ALL_TIME),
+                                      allowDiskUse=True))
+        for board in boards:
+            for entry in board['top']:
+                entry['game_id'] = str(entry['game_id'])
+
+        self.leaderboards.delete_many(
+            {'_id': {'$nin': [board['_id'] for board in boards]}})
+        if boards:
+            self.leaderboards.bulk_write(
+                [ReplaceOne({'_id': board['_id']}, board, upsert=True)
+                 for board in boards])
+
+    @classmethod
+    def ended_stages(cls):
+        """
+        Pipeline stages giving one document per player whose game ended,
+        with frames, strikes, spares and complete worked out from stored
+        scoresheets the same way as frame_marks and finished, so rolls may
+        be stored in either format
+        """
+        rolls = {'$ifNull': ['$players.score_state.rolls', 0]}
+        results = {'$ifNull': ['$players.frame_results', []]}
+        last_result = {'$ifNull': [{'$arrayElemAt': [results, FRAMES - 1]},
+                                   '']}
+
+        def marked(start, mark):
+            # frames whose result has mark at start, such as X or 5-S
+            return {'$size': {'$filter': {
+                'input': results,
+                'as': 'result',
+                'cond': {'$eq': [{'$substr': ['$$result', start, 1]}, mark]}
+            }}}
+
+        return [
+            {'$unwind': '$players'},
+            {'$match': {'$or': [{'active': False},
+                                {'players.active': False}]}},
+            {'$project': {
+                'name': '$players.name',
+                'player_id': '$players.player_id',
+                'total': {'$ifNull': ['$players.total', 0]},
+                'day': {'$dateToString': {'format': '%Y-%m-%d',
+                                          'date': '$date_started'}},
+                'frames': {'$min': [{'$floor': {'$divide': [rolls, 2]}},
+                                    FRAMES]},
+                'strikes': marked(0, 'X'),
+                # last frame spares are shown as pins, so come from fill
+                'spares': {'$add': [marked(2, 'S'), {'$cond': [{'$and': [
+                    {'$ifNull': ['$players.score_state.fill', False]},
+                    {'$ne': [{'$substr': [last_result, 0, 1]}, 'X']}
+                ]}, 1, 0]}]},
+                'complete': {'$or': [
+                    {'$gt': [rolls, 20]},
+                    {'$and': [{'$eq': [rolls, 20]},
+                              {'$lt': [{'$arrayElemAt': [
+                                  '$players.frame_scores', FRAMES - 1]},
+                                  10]}]}
+                ]}
+            }}
+        ]
+
+    @classmethod
+    def player_pipeline(cls):
+        """
+        Pipeline writing counts per name to player_stats
+        """
+        return cls.ended_stages() + [
+            {'$group': {
+                '_id': '$name',
+                'games': {'$sum': {'$cond': ['$complete', 1, 0]}},
+                'pins': {'$sum': {'$cond': ['$complete', '$total', 0]}},
+                'high_game': {'$max': {'$cond': ['$complete', '$total', 0]}},
+                'frames': {'$sum': '$frames'},
+                'strikes': {'$sum': '$strikes'},
+                'spares': {'$sum': '$spares'}
+            }},
+            {'$out': 'player_stats'}
+        ]
+
+    @classmethod
+    def leaderboard_pipeline(cls, board=None):
+        """
+        Pipeline giving top complete games for each day, or all time
+        """
+        return cls.ended_stages() + [
+            {'$match': {'complete': True}},
+            {'$sort': {'total': -1}},
+            {'$group': {
+                '_id': board or '$day',
+                'top': {'$push': {
+                    'game_id': '$_id',
+                    'player_id': '$player_id',
+                    'name': '$name',
+                    'total': '$total'
+                }}
+            }},
+            {'$project': {'top': {'$slice': ['$top', LEADERBOARD_SIZE]}}}
+        ]
+
+
+################################
+# In-process memory statistics
+################################
+
+class MemoryStats(StatsStore):
+    """
+    Statistics kept in dicts alongside the memory store
+    """
+
+    def __init__(self):
+        self.players = {}
+        self.leaderboards = {}
+        self.lock = threading.Lock()
+
+    def record(self, game, indexes):
+        with self.lock:
+            for index in indexes:
+                self.__add(player_line(game, index))
+
+    def player(self, name):
+        stats = self.players.get(name)
+        return player_summary(stats) if stats else None
+
+    def leaderboard(self, day=ALL_TIME):
+        return list(self.leaderboards.get(day, []))
+
+    def rebuild(self, games):
+        """
+        Recomputes every statistic from ended games
+
+        :param games: raw game documents
+        """
+        with self.lock:
+            self.players, self.leaderboards = {}, {}
+            for game in games:
+                for index, player in enumerate(game['players']):
+                    if not (game['active'] and player.get('active', True)):
+                        self.__add(player_line(game, index))
+
+    def __add(self, line):
+        """
+        Adds a player's ended game to counts and leaderboards
+
+        :param line: summary of player's game
+        """
+        stats = self.players.setdefault(line['name'], {
+            '_id': line['name'], 'games': 0, 'pins': 0, 'high_game': 0,
+            'frames': 0, 'strikes': 0, 'spares': 0
+        })
+        for key in ('frames', 'strikes', 'spares'):
+            stats[key] += line[key]
+        if not line['complete']:
+            return
+
+        stats['games'] += 1
+        stats['pins'] += line['total']
+        stats['high_game'] = max(stats['high_game'], line['total'])
+
+        for board in (ALL_TIME, line['day']):
+            top = self.leaderboards.setdefault(board, [])
+            top.append(leaderboard_entry(line))
+            top.sort(key=lambda entry: -entry['total'])
+            del top[LEADERBOARD_SIZE:]
@@ -1,9 +1,37 @@
-from unittest import TestCase, main
+from unittest import TestCase, main, skipIf
+from argparse import Namespace
 from mongoengine import connect
+from mongoengine.connection import disconnect
+from bson import BSON, ObjectId
+from datetime import datetime, timedelta
 import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import zlib
 
-from api import app
+from api import app, create_app
+from bench import bowled_frames, compare, corpora, new_game, raw_scores, \
+    roll_order
+from config import app_config, mongo_settings
+from export import export_lines, gzip_chunks, last_exported_id
+from importer import check_line, game_document, import_games
+from loadtest import Recorder, TestClientTransport, next_pins, percentile, \
+    replay, simulate
+from packing import is_packed, pack_scores, unpack_game, unpack_scores
+from profiling import RequestProfiler, merge, saved_profiles
+from metrics import MONGO_SENT_BYTES, Counter, Histogram, MongoListener, \
+    start_counting, stop_counting
 from datastore import Game, Player
+from events import ALL_GAMES, Event, EventHub
+from repository import MemoryRepository, listing, read_preference
+from rules import InvalidRoll, RuleError, Turn, apply_roll, apply_rolls, \
+    deactivate
+from scoring import ScoreState
+from vectorized import numpy, roll_array, score_batch
+from views import GameView, PlayerView
 
 
 class TestHomeEndpoint(TestCase):
@@ -70,6 +98,97 @@ class TestAllGamesEndpoint(TestCase):
         assert list == type(data)
         assert 1 == len(data)
 
+    def test_list_unscored_games(self):
+        """
+        Tests games saved before scoresheets were stored list real totals
+        """
+        Game(players=[Player(player_id=1, name="Calvin Johnson")]).save()
+        Game._get_collection().insert_one({
+            'active': True, 'date_started': datetime(2015, 1, 1),
+            'players': [
+                {'player_id': 1, 'name': "Old", 'raw_scores': [10, 0, 7, 2]},
+                {'player_id': 2, 'name': "Packed",
+                 'raw_scores': pack_scores([10, 0, 10, 0, 3])}]})
+
+        response = self.app.get('/games')
+        data = json.loads(response.data)
+        assert [game["totals"] for game in data] == [[0], [26, 33]]
+
+    def test_paginate_games(self):
+        """
+        Tests retrieving games a page at a time with filters
+        """
+        # add three games, last one inactive
+        for active in (True, True, False):
+            players = [Player(player_id=1, name="Calvin Johnson")]
+            Game(players=players, active=active).save()
+
+        # first page points to next page
+        response = self.app.get('/games?limit=2')
+        assert '200' in response.status
+        data = json.loads(response.data)
+        assert 2 == len(data)
+        token = response.headers.get('X-Next-Page')
+        assert token
+
+        # last page has no next page
+        response = self.app.get('/games?limit=2&after=' + token)
+        data = json.loads(response.data)
+        assert 1 == len(data)
+        assert not data[0]["active"]
+        assert response.headers.get('X-Next-Page') is None
+
+        # filter on active games and date window
+        response = self.app.get('/games?active=true')
+        assert 2 == len(json.loads(response.data))
+        response = self.app.get('/games?started_before=2000-01-01')
+        assert 0 == len(json.loads(response.data))
+
+        # filter on a player's games
+        Game(players=[Player(player_id=1, name="D Thomas"),
+                      Player(player_id=2, name="Chris Bosh")]).save()
+        response = self.app.get('/games?player=Chris%20Bosh')
+        data = json.loads(response.data)
+        assert [game["players"][1] for game in data] == ["Chris Bosh"]
+
+        # invalid paging and filters
+        for query in ('limit=0', 'limit=hi', 'after=bad', 'active=maybe',
+                      'started_after=yesterday'):
+            response = self.app.get('/games?' + query)
+            assert '400' in response.status
+
+    def test_filters_use_indexes(self):
+        """
+        Tests each listing filter is an index scan of its declared index
+        """
+        Game.ensure_indexes()
+        for num in range(200):
+            players = [Player(player_id=1, name="Bowler %d" % (num % 20))]
+            Game(players=players, active=num % 10 == 0,
+                 date_started=datetime(2015, 1, 1) + timedelta(num)).save()
+
+        queries = {
+            'active_1__id_1': {'active': True},
+            'date_started_1__id_1': {
+                'started_after': datetime(2015, 3, 1),
+                'started_before': datetime(2015, 3, 8)},
+            'players.name_1__id_1': {'player': "Bowler 7"}
+        }
+        for index, filters in queries.items():
+            cursor = listing(Game._get_collection(), 51, **filters)
+            stage = cursor.explain()['queryPlanner']['winningPlan']
+            stages = [stage['stage']]
+            while 'inputStage' in stage:
+                stage = stage['inputStage']
+                stages.append(stage['stage'])
+            assert stage['stage'] == 'IXSCAN'
+            assert stage['indexName'] == index
+
+            # ids come off equality filter indexes in order, date ranges
+            # are sorted a page at a time
+            sorted_in_memory = 'SORT' in stages
+            assert sorted_in_memory == (index == 'date_started_1__id_1')
+
     def test_create_valid_game(self):
         """
         Tests posting a valid game
@@ -182,6 +301,68 @@ class TestGamesEndpoint(TestCase):
         response = self.app.put('/games/' + self.valid_id, data='10')
         assert '400' in response.status
 
+    def test_roll_revision(self):
+        """
+        Tests each roll bumps the game revision in one update
+        """
+        self.app.put('/games/' + self.valid_id, data='10')
+        response = self.app.put('/games/' + self.valid_id, data='3')
+        assert '200' in response.status
+        data = json.loads(response.data)
+        assert data["players"][1]["scoresheet"]["frame_results"] == ['3']
+
+        game = Game.games.get(id=self.valid_id)
+        assert game.revision == 2
+        assert game.players[0].total == 10
+        stored = Game._get_collection().find_one(
+            {'_id': ObjectId(self.valid_id)})
+        assert PlayerView(stored['players'][1]).score_sheet() == \
+            Player.calc_score_sheet([3])
+        assert game.players[0].raw_scores == [10, 0]
+        assert game.players[1].raw_scores == [3]
+
+    def test_stored_turn(self):
+        """
+        Tests stored turn pointer moves on with rolls and games end
+        """
+        url = '/games/' + self.valid_id
+        self.app.put(url, data='10')
+        stored = Game._get_collection().find_one(
+            {'_id': ObjectId(self.valid_id)})
+        assert (stored['current_player'], stored['current_frame'],
+                stored['current_roll']) == (2, 1, 1)
+
+        # second roll is checked against the first
+        self.app.put(url, data='6')
+        assert '400' in self.app.put(url, data='5').status
+
+        response = self.app.post(url + '/rolls', data=json.dumps(
+            [4] + [10] * 22))
+        assert '200' in response.status
+        stored = Game._get_collection().find_one(
+            {'_id': ObjectId(self.valid_id)})
+        assert not stored['active']
+        assert [player['total'] for player in stored['players']] == \
+            [300, 290]
+
+    def test_bulk_create_write_errors(self):
+        """
+        Tests games refused by the database are reported and the others
+        are still created
+        """
+        # collection rejects games with a blocked name
+        collection = Game._get_collection()
+        collection.database.command('collMod', collection.name, validator={
+            'players.name': {'$ne': 'Blocked'}})
+        response = self.app.post('/games/bulk', data=json.dumps(
+            [["Jarret Jack"], ["Blocked"], ["Chris Bosh"]]))
+        assert '201' in response.status
+        data = json.loads(response.data)
+        assert "error" in data["games"][1]
+        assert data["message"] == "2 new games created."
+        for result in (data["games"][0], data["games"][2]):
+            assert collection.find_one({'_id': ObjectId(result["gameID"])})
+
     def test_delete_game(self):
         """
         Tests inactiving games
@@ -226,6 +407,878 @@ class TestGamesEndpoint(TestCase):
         assert '405' in response.status
 
 
+class TestMemoryStorage(TestCase):
+
+    def setUp(self):
+        """
+        Setup app on a memory store with a game
+        """
+        self.repository = app.config['REPOSITORY']
+        app.config['REPOSITORY'] = MemoryRepository()
+        self.app = app.test_client()
+
+        players = ["Calvin Johnson", "Michael Jordan"]
+        response = self.app.post('/games', data=json.dumps(players))
+        self.valid_id = json.loads(response.data)["gameID"]
+
+    def tearDown(self):
+        """
+        Put back app's storage
+        """
+        app.config['REPOSITORY'] = self.repository
+
+    def test_game_flow(self):
+        """
+        Tests creating, listing, rolling on and ending games
+        """
+        response = self.app.post('/games', data=json.dumps(["D Thomas"]))
+        assert '201' in response.status
+
+        # list a page at a time
+        response = self.app.get('/games?limit=1')
+        data = json.loads(response.data)
+        assert data[0]["game_id"] == self.valid_id
+        response = self.app.get(
+            '/games?limit=1&after=' + response.headers['X-Next-Page'])
+        assert 1 == len(json.loads(response.data))
+
+        # roll and read back
+        self.app.put('/games/' + self.valid_id, data='10')
+        response = self.app.put('/games/' + self.valid_id, data='4')
+        data = json.loads(response.data)
+        assert data["players"][0]["scoresheet"]["frame_results"] == ['X']
+        assert data["players"][1]["scoresheet"]["total"] == 4
+        response = self.app.put('/games/' + self.valid_id, data='7')
+        assert '400' in response.status
+
+        # missing games and ending games
+        response = self.app.get('/games/5795434f0640fd14497c3888')
+        assert '404' in response.status
+        response = self.app.delete('/games/' + self.valid_id, data='2')
+        assert '200' in response.status
+        response = self.app.delete('/games/' + self.valid_id)
+        assert not json.loads(response.data)["active"]
+        response = self.app.get('/games?active=false')
+        assert 1 == len(json.loads(response.data))
+        response = self.app.get('/games?player=D%20Thomas')
+        data = json.loads(response.data)
+        assert [game["players"] for game in data] == [["D Thomas"]]
+
+    def test_conditional_get(self):
+        """
+        Tests game ETags follow revisions and matching ones answer 304
+        """
+        url = '/games/' + self.valid_id
+        response = self.app.get(url)
+        etag = response.headers['ETag']
+        assert etag == 'W/"0"'
+
+        # unchanged game is not sent again
+        response = self.app.get(url, headers={'If-None-Match': etag})
+        assert '304' in response.status
+        assert response.headers['ETag'] == etag
+        assert response.data == ''
+
+        # a roll changes the tag and the game is sent again
+        response = self.app.put(url, data='7')
+        assert response.headers['ETag'] == 'W/"1"'
+        response = self.app.get(url, headers={'If-None-Match': etag})
+        assert '200' in response.status
+        data = json.loads(response.data)
+        assert data["players"][0]["scoresheet"]["total"] == 7
+
+        # rendered once per revision and shared between responses
+        assert app.config['RESPONSE_CACHE'].get(
+            (ObjectId(self.valid_id), 1, 'full', None)) == response.data
+        response = self.app.delete(url, data='1')
+        assert response.headers['ETag'] == 'W/"2"'
+        response = self.app.get(url, headers={'If-None-Match': '"2"'})
+        assert '304' in response.status
+
+        # weak validators, as sent back by caches, compare by revision
+        response = self.app.get(url, headers={'If-None-Match': 'W/"2"'})
+        assert '304' in response.status
+        response = self.app.get(url, headers={'If-None-Match': 'W/"1"'})
+        assert '200' in response.status
+
+    def test_game_views(self):
+        """
+        Tests compact views and field selection of a game
+        """
+        url = '/games/' + self.valid_id
+        self.app.put(url, data='10')
+        self.app.put(url, data='7')
+        full = json.loads(self.app.get(url).data)
+        players = full["players"]
+
+        response = self.app.get(url + '?view=totals')
+        assert json.loads(response.data) == {
+            "id": self.valid_id, "active": True,
+            "players": [player["name"] for player in players],
+            "totals": [player["scoresheet"]["total"] for player in players]}
+        assert response.headers['ETag'] == 'W/"2"'
+
+        data = json.loads(self.app.get(url + '?view=array').data)
+        assert data[:3] == [full["id"], full["active"], full["date_started"]]
+        assert data[3][0] == [1, players[0]["name"], True,
+                              players[0]["scoresheet"]["frame_results"],
+                              players[0]["scoresheet"]["frame_scores"],
+                              players[0]["scoresheet"]["total"]]
+
+        data = json.loads(self.app.get(
+            url + '?fields=active,players.name,players.scoresheet.total').data)
+        assert data == {"active": True, "players": [
+            {"name": player["name"],
+             "scoresheet": {"total": player["scoresheet"]["total"]}}
+            for player in players]}
+
+        for query in ('?view=wide', '?fields=players.password',
+                      '?view=totals&fields=active', '?fields=,'):
+            assert '400' in self.app.get(url + query).status
+
+    def test_gzip_responses(self):
+        """
+        Tests large JSON responses are gzipped if accepted
+        """
+        players = ["Ann", "Bob", "Cat", "Dan"]
+        response = self.app.post('/games', data=json.dumps(players))
+        url = '/games/' + json.loads(response.data)["gameID"]
+        for score in [10] * 20:
+            self.app.put(url, data=str(score))
+        plain = self.app.get(url)
+        assert 'Content-Encoding' not in plain.headers
+        assert plain.headers['Vary'] == 'Accept-Encoding'
+
+        for _ in range(2):
+            response = self.app.get(url, headers={'Accept-Encoding': 'gzip'})
+            assert response.headers['Content-Encoding'] == 'gzip'
+            assert zlib.decompress(response.data, 16 + zlib.MAX_WBITS) == \
+                plain.data
+        response = self.app.get(url, headers={'Accept-Encoding': 'gzip;q=0'})
+        assert 'Content-Encoding' not in response.headers
+
+        # small responses are not worth compressing
+        response = self.app.get(url + '?view=totals',
+                                headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+
+        for _ in range(20):
+            self.app.post('/games', data='["Ann", "Bob"]')
+        response = self.app.get('/games', headers={'Accept-Encoding': 'gzip'})
+        assert len(json.loads(zlib.decompress(
+            response.data, 16 + zlib.MAX_WBITS))) > 20
+
+    def test_event_streams(self):
+        """
+        Tests game updates are streamed to game and all games subscribers
+        """
+        url = '/games/' + self.valid_id
+        game_stream = self.app.get(url + '/events', buffered=False)
+        all_stream = self.app.get('/games/events', buffered=False)
+        assert game_stream.mimetype == 'text/event-stream'
+        game_events, all_events = iter(game_stream.response), \
+            iter(all_stream.response)
+
+        # game stream starts with current game
+        assert next(all_events) == ': connected\n\n'
+        assert next(game_events) == ': connected\n\n'
+        event = next(game_events)
+        assert event.startswith('id: ' + self.valid_id + '-0\n')
+
+        # each write is pushed to both streams
+        self.app.put(url, data='7')
+        self.app.delete(url)
+        for events in (game_events, all_events):
+            event = next(events)
+            assert event.startswith('id: ' + self.valid_id + '-1\n')
+            data = json.loads(event.split('data: ')[1])
+            assert data["players"][0]["scoresheet"]["total"] == 7
+            event = next(events)
+            assert not json.loads(event.split('data: ')[1])["active"]
+
+        # game stream ends with game, streams unsubscribe when closed
+        self.assertRaises(StopIteration, next, game_events)
+        all_stream.close()
+        assert 0 == app.config['EVENT_HUB'].subscribers(self.valid_id)
+        assert 0 == app.config['EVENT_HUB'].subscribers(ALL_GAMES)
+
+        response = self.app.get('/games/5795434f0640fd14497c3888/events')
+        assert '404' in response.status
+
+    def test_metrics(self):
+        """
+        Tests requests are timed per route pattern and exposed at /metrics
+        """
+        self.app.put('/games/' + self.valid_id, data='3')
+        self.app.get('/games/' + self.valid_id)
+        self.app.get('/nowhere')
+        response = self.app.get('/metrics')
+        assert '200' in response.status
+        assert response.mimetype == 'text/plain'
+
+        lines = response.data.split("\n")
+        assert any(line.startswith('bowling_requests_total{route="/games/'
+                                   '<game_id>",method="GET",status="200"}')
+                   for line in lines)
+        assert any(line.startswith('bowling_requests_total{route="unmatched"'
+                                   ',method="GET",status="404"}')
+                   for line in lines)
+        assert any(line.startswith(
+            'bowling_request_duration_seconds_bucket{route="/games/<game_id>"'
+            ',method="GET",le="+Inf"}') for line in lines)
+        assert any(line.startswith('bowling_scoring_duration_seconds_count'
+                                   '{function="score_fields"}')
+                   for line in lines)
+
+    def test_export(self):
+        """
+        Tests every game is streamed as a JSON line, gzipped if accepted
+        """
+        self.app.put('/games/' + self.valid_id, data='10')
+        response = self.app.post('/games', data=json.dumps(["D Thomas"]))
+        second_id = json.loads(response.data)["gameID"]
+
+        response = self.app.get('/games/export')
+        assert response.mimetype == 'application/x-ndjson'
+        lines = response.data.splitlines()
+        assert [json.loads(line)["id"] for line in lines] == \
+            [self.valid_id, second_id]
+        player = json.loads(lines[0])["players"][0]
+        assert player["raw_scores"] == [10, 0]
+        assert player["scoresheet"]["frame_results"] == ['X']
+
+        # resume after last game read, and filter on start date
+        response = self.app.get('/games/export?after=' + self.valid_id)
+        assert 1 == len(response.data.splitlines())
+        response = self.app.get('/games/export?since=2999-01-01')
+        assert response.data == ''
+        response = self.app.get('/games/export?after=nope')
+        assert '400' in response.status
+
+        response = self.app.get('/games/export',
+                                headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        data = zlib.decompress(response.data, 16 + zlib.MAX_WBITS)
+        assert data.splitlines() == lines
+
+    def test_bulk_create(self):
+        """
+        Tests creating many games at once
+        """
+        player_lists = [
+            ["Calvin Johnson", "Michael Jordan"],
+            [],
+            ["Jarret Jack"],
+            ["Chris Bosh", 5]
+        ]
+        response = self.app.post('/games/bulk', data=json.dumps(player_lists))
+        assert '201' in response.status
+        results = json.loads(response.data)["games"]
+        assert "error" in results[1] and "error" in results[3]
+
+        # new games returned in order
+        response = self.app.get('/games/' + results[2]["gameID"])
+        assert json.loads(response.data)["players"][0]["name"] == \
+            "Jarret Jack"
+
+        # nothing valid to create
+        for body in ('hi', '[]', json.dumps([[]]), json.dumps([["a"]] * 101)):
+            response = self.app.post('/games/bulk', data=body)
+            assert '400' in response.status
+
+    def test_batch_rolls(self):
+        """
+        Tests sending many rolls at once
+        """
+        url = '/games/' + self.valid_id + '/rolls'
+
+        # invalid roll rejects whole batch and reports its position
+        response = self.app.post(url, data=json.dumps([10, 3, 4, 5, 6]))
+        assert '400' in response.status
+        assert json.loads(response.data)["index"] == 4
+        response = self.app.post(url, data=json.dumps([10, True]))
+        assert json.loads(response.data)["index"] == 1
+        for body in ('hi', '[]', '{}', json.dumps([1] * 85)):
+            response = self.app.post(url, data=body)
+            assert '400' in response.status
+
+        # valid rolls all applied in one go
+        response = self.app.post(url, data=json.dumps([10, 3, 4, 5, 5]))
+        assert '200' in response.status
+        data = json.loads(response.data)
+        assert data["players"][0]["scoresheet"]["frame_results"] == \
+            ['X', '5-S']
+        assert data["players"][1]["scoresheet"]["total"] == 7
+
+        # whole game to the end
+        response = self.app.post(url, data=json.dumps([10] * 21))
+        data = json.loads(response.data)
+        assert not data["active"]
+        assert data["players"][1]["scoresheet"]["total"] == 277
+
+    def test_stats_and_leaderboard(self):
+        """
+        Tests statistics and leaderboards follow ended games
+        """
+        # strikes for one player, three spares then gutters for other
+        scores = []
+        for frame in range(9):
+            scores += [10] + ([9, 1] if frame < 3 else [0, 0])
+        url = '/games/' + self.valid_id + '/rolls'
+        self.app.post(url, data=json.dumps(scores + [10, 10, 10]))
+
+        # perfect game complete, no stats until other player's game ends
+        response = self.app.get('/stats?name=Calvin Johnson')
+        data = json.loads(response.data)
+        assert data["games"] == 1 and data["high_game"] == 300
+        assert data["strike_rate"] == 1
+        response = self.app.get('/stats?name=Michael Jordan')
+        assert '404' in response.status
+
+        # ending game early counts frames but not a game
+        self.app.delete('/games/' + self.valid_id)
+        response = self.app.get('/stats?name=Michael Jordan')
+        data = json.loads(response.data)
+        assert data["games"] == 0 and data["frames"] == 9
+        assert data["spare_rate"] == 0.333
+
+        response = self.app.get('/leaderboard')
+        data = json.loads(response.data)
+        assert [entry["total"] for entry in data] == [300]
+        response = self.app.get('/leaderboard?date=2000-01-01')
+        assert json.loads(response.data) == []
+        for query in ('', '?date=today', '?limit=11'):
+            response = self.app.get(('/stats' if not query else
+                                     '/leaderboard') + query)
+            assert '400' in response.status
+        response = self.app.get('/leaderboard?limit=x')
+        assert response.data == "Bad request: Limit not a valid integer"
+        response = self.app.get('/leaderboard?date=today')
+        assert response.data == "Bad request: Date must be YYYY-MM-DD " \
+            "or YYYY-MM-DDTHH:MM:SS"
+
+        # rebuild gives same statistics
+        before = app.config['REPOSITORY'].stats.player("Michael Jordan")
+        app.config['REPOSITORY'].rebuild_stats()
+        assert app.config['REPOSITORY'].stats.player("Michael Jordan") == \
+            before
+
+    def test_concurrent_rolls(self):
+        """
+        Tests rolls sent at once from many threads are all applied
+        """
+        def roll():
+            self.app.put('/games/' + self.valid_id, data='1')
+
+        threads = [threading.Thread(target=roll) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        response = self.app.get('/games/' + self.valid_id)
+        data = json.loads(response.data)
+        assert [player["scoresheet"]["total"]
+                for player in data["players"]] == [10, 10]
+
+
+class TestEventHub(TestCase):
+
+    def test_publish(self):
+        """
+        Tests updates reach subscribers of their game and of all games
+        """
+        hub = EventHub()
+        game = hub.subscribe('a')
+        other = hub.subscribe('b')
+        every = hub.subscribe(ALL_GAMES)
+
+        event = Event('a', 1, True, '{}')
+        hub.publish(event)
+        assert game.get(timeout=0) == event
+        assert every.get(timeout=0) == event
+        assert other.get(timeout=0) is None
+
+        hub.unsubscribe(game)
+        hub.publish(event)
+        assert game.get(timeout=0) is None
+        assert hub.subscribers('a') == 0
+
+    def test_drop_slow_subscriber(self):
+        """
+        Tests a subscriber that falls behind is dropped without blocking
+        """
+        hub = EventHub(queue_size=2)
+        slow = hub.subscribe('a')
+        fast = hub.subscribe('a')
+
+        for revision in range(3):
+            hub.publish(Event('a', revision, True, '{}'))
+            assert fast.get(timeout=0).revision == revision
+
+        assert slow.dropped and not fast.dropped
+        assert slow.get(timeout=0) is None
+        assert hub.subscribers('a') == 1
+
+
+class TestAppFactory(TestCase):
+
+    def test_lazy_connect(self):
+        """
+        Tests storage is only built once a request needs it
+        """
+        factory_app = create_app({'STORAGE': 'memory'})
+        assert factory_app.config['REPOSITORY'] is None
+
+        client = factory_app.test_client()
+        response = client.get('/')
+        assert '200' in response.status
+        assert factory_app.config['REPOSITORY'] is None
+
+        response = client.post('/games', data=json.dumps(["D Thomas"]))
+        assert '201' in response.status
+        assert isinstance(factory_app.config['REPOSITORY'], MemoryRepository)
+
+    def test_mongo_settings(self):
+        """
+        Tests MongoDB client settings are read from environment
+        """
+        settings = mongo_settings({
+            'BOWLING_MONGO_HOST': 'mongodb://db1,db2/?replicaSet=rs0',
+            'BOWLING_MONGO_POOL_SIZE': '20',
+            'BOWLING_MONGO_SELECTION_TIMEOUT': '2000',
+            'BOWLING_MONGO_SOCKET_TIMEOUT': ''
+        })
+        assert settings == {
+            'host': 'mongodb://db1,db2/?replicaSet=rs0',
+            'maxPoolSize': 20,
+            'serverSelectionTimeoutMS': 2000
+        }
+        self.assertRaises(ValueError, mongo_settings,
+                          {'BOWLING_MONGO_POOL_SIZE': 'many'})
+
+    def test_read_preference(self):
+        """
+        Tests reads are routed by mode with bounded staleness
+        """
+        config = app_config({'BOWLING_READ_PREFERENCE': 'secondaryPreferred',
+                             'BOWLING_MAX_STALENESS': '120'})
+        reads = read_preference(config['READ_PREFERENCE'],
+                                config['MAX_STALENESS'])
+        assert reads.document == {'mode': 'secondaryPreferred',
+                                  'maxStalenessSeconds': 120}
+        assert read_preference().document == {'mode': 'primary'}
+        self.assertRaises(ValueError, read_preference, 'fastest')
+        self.assertRaises(ValueError, read_preference, 'primary', 90)
+
+
+@skipIf(not os.environ.get('BOWLING_TEST_REPLICA_SET'),
+        "BOWLING_TEST_REPLICA_SET not set")
+class TestReplicaSetReads(TestCase):
+
+    def setUp(self):
+        """
+        Setup app reading from secondaries of the replica set given in
+        BOWLING_TEST_REPLICA_SET, such as a single host started with
+        mongod --replSet rs0
+        """
+        disconnect()
+        Game._collection = None
+        self.app = create_app({
+            'MONGO_SETTINGS': {
+                'host': os.environ['BOWLING_TEST_REPLICA_SET']},
+            'READ_PREFERENCE': 'secondaryPreferred',
+            'MAX_STALENESS': 90
+        })
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        """
+        Put back default connection of other tests
+        """
+        disconnect()
+        Game._collection = None
+        connect("bowlingdb")
+
+    def test_routed_reads(self):
+        """
+        Tests reads go to secondaries and writes and latest reads to
+        primary, with the game readable straight after a roll
+        """
+        response = self.client.post('/games', data=json.dumps(["D Thomas"]))
+        game_id = json.loads(response.data)["gameID"]
+        response = self.client.put('/games/' + game_id, data='10')
+        etag = response.headers['ETag']
+        assert etag == 'W/"1"'
+
+        # writer polling with its new revision is never sent older ones
+        response = self.client.get('/games/' + game_id,
+                                   headers={'If-None-Match': etag})
+        assert '304' in response.status
+        response = self.client.get('/games/' + game_id,
+                                   headers={'If-None-Match': 'W/"1"'})
+        assert '304' in response.status
+        response = self.client.get('/games?limit=500')
+        assert game_id in [game["game_id"]
+                           for game in json.loads(response.data)]
+
+        repository = self.app.config['REPOSITORY']
+        assert repository.reads.read_preference.document == {
+            'mode': 'secondaryPreferred', 'maxStalenessSeconds': 90}
+        assert Game._get_collection().read_preference.mode == 0
+
+
+class TestMetrics(TestCase):
+
+    def test_histogram(self):
+        """
+        Tests observations are rendered as cumulative buckets
+        """
+        histogram = Histogram('latency', "Latency", ('route',), (0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(('/games',), value)
+        assert histogram.render() == [
+            '# HELP latency Latency',
+            '# TYPE latency histogram',
+            'latency_bucket{route="/games",le="0.1"} 2',
+            'latency_bucket{route="/games",le="1.0"} 3',
+            'latency_bucket{route="/games",le="+Inf"} 4',
+            'latency_sum{route="/games"} 3.65',
+            'latency_count{route="/games"} 4']
+
+        counter = Counter('rolls', "Rolls", ('name',))
+        counter.inc(('say "hi"',), 2)
+        assert counter.render()[-1] == 'rolls{name="say \\"hi\\""} 2'
+
+    def test_mongo_listener(self):
+        """
+        Tests database commands are counted against the current request
+        """
+        class Event(object):
+            def __init__(self, **values):
+                self.__dict__.update(values)
+
+        listener = MongoListener()
+        command, reply = {'find': 'games'}, {'ok': 1}
+        sent = MONGO_SENT_BYTES.values.get(('find',), 0)
+        start_counting()
+        for _ in range(3):
+            listener.started(Event(command_name='find', command=command))
+            listener.succeeded(Event(command_name='find', reply=reply,
+                                     duration_micros=150))
+        assert stop_counting() == (3, None)
+        assert MONGO_SENT_BYTES.values.get(('find',), 0) == sent
+
+        # sampled requests count bytes too
+        start_counting(1)
+        listener.started(Event(command_name='find', command=command))
+        listener.succeeded(Event(command_name='find', reply=reply,
+                                 duration_micros=150))
+        size = len(BSON.encode(command)) + len(BSON.encode(reply))
+        assert stop_counting() == (1, size)
+        assert MONGO_SENT_BYTES.values[('find',)] == \
+            sent + len(BSON.encode(command))
+
+        # commands outside a request are not counted against one
+        listener.started(Event(command_name='find', command={'find': 'x'}))
+        assert stop_counting() == (None, None)
+
+
+class TestProfiler(TestCase):
+
+    def setUp(self):
+        """
+        Setup app on a memory store profiling every other request
+        """
+        self.directory = tempfile.mkdtemp()
+        self.app = create_app({
+            'STORAGE': 'memory',
+            'PROFILE_DIR': self.directory,
+            'PROFILE_SAMPLE': 2,
+            'PROFILE_TOKEN': 'secret'
+        })
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        """
+        Remove saved profiles
+        """
+        shutil.rmtree(self.directory)
+
+    def test_sampled_profiles(self):
+        """
+        Tests sampled and asked for requests are saved tagged and merged
+        """
+        response = self.client.post('/games', data=json.dumps(["A", "B"]))
+        game_id = json.loads(response.data)["gameID"]
+        for _ in range(3):
+            self.client.get('/games/' + game_id)
+        assert 2 == len(saved_profiles(self.directory))
+
+        # header asks for a profile only with the token
+        self.client.get('/', headers={'X-Profile': 'guess'})
+        self.client.get('/', headers={'X-Profile': 'secret'})
+        names = sorted(os.listdir(self.directory))
+        assert 3 == len(names)
+        assert names[1].split('_')[1:4] == ['GET', 'games.game.id', game_id]
+        assert names[2].split('_')[1:4] == ['GET', 'home', '-']
+
+        stats = merge(saved_profiles(self.directory))
+        assert any(function[2] == 'game_info' for function in stats.stats)
+
+    def test_size_cap(self):
+        """
+        Tests oldest profiles are removed once over the size cap
+        """
+        profiler = RequestProfiler(self.directory, max_bytes=250)
+        for number in range(4):
+            name = '2016010%dT000000000000_GET_home_-_1ms.prof.z' % number
+            with open(os.path.join(self.directory, name), 'wb') as dump:
+                dump.write('x' * 100)
+        profiler.trim()
+        assert sorted(os.listdir(self.directory)) == [
+            '20160102T000000000000_GET_home_-_1ms.prof.z',
+            '20160103T000000000000_GET_home_-_1ms.prof.z']
+
+
+class TestBench(TestCase):
+
+    def test_generated_games(self):
+        """
+        Tests benchmark games are the same for a seed and follow the rules
+        """
+        first, second = random.Random(7), random.Random(7)
+        for _ in range(200):
+            players_frames = [bowled_frames(first) for _ in range(3)]
+            assert players_frames == [bowled_frames(second) for _ in range(3)]
+
+            game = new_game(3)
+            apply_rolls(game, roll_order(players_frames))
+            assert not game["active"]
+            for player, frames in zip(game["players"], players_frames):
+                assert player["raw_scores"] == raw_scores(frames)
+
+    def test_compare(self):
+        """
+        Tests changes in median time beyond threshold are reported
+        """
+        def run(**times):
+            return {"results": dict((name, {"median_us": time})
+                                    for name, time in times.items())}
+
+        rows = compare(run(a=10.0, b=10.0, c=10.0, d=1.0),
+                       run(a=12.0, b=10.5, c=5.0, e=1.0), 0.1)
+        assert [(row[0], row[4]) for row in rows] == [
+            ('a', 'REGRESSION'), ('b', ''), ('c', 'improved'),
+            ('d', 'removed'), ('e', 'new')]
+
+
+class TestLoadTest(TestCase):
+
+    def test_lanes_bowl_valid_games(self):
+        """
+        Tests lanes bowl the same rolls for a seed without failed requests
+        """
+        options = Namespace(seed=3, lanes=3, players=2, displays=2,
+                            duration=0, games=2, roll_seconds=0,
+                            poll_seconds=0.001, weights=(1,) * 11,
+                            spare_rate=0.3, leave_rate=0.05)
+        app = create_app({'STORAGE': 'memory'})
+        runs = []
+        for _ in range(2):
+            recorder, seconds, rolls = simulate(
+                options, lambda: TestClientTransport(app))
+            rows = dict((row[0], row) for row in recorder.report(seconds))
+            assert all(row[2] == 0 for row in rows.values())
+            assert rows['POST /games'][1] == 6
+            assert rows['PUT /games/<id>'][1] == rolls
+            assert rows['GET /games/<id>'][1] > 0
+            runs.append(rolls)
+        assert runs[0] == runs[1]
+
+    def test_pins_follow_rules(self):
+        """
+        Tests drawn pins never knock down more pins than are standing
+        """
+        rand = random.Random(5)
+        for _ in range(200):
+            game = new_game(1)
+            while game["active"]:
+                turn = Turn.of(game)
+                apply_roll(game, next_pins(rand, game["players"][0].get(
+                    "raw_scores", []), turn, spare_rate=0.5))
+        assert percentile([1, 2, 3, 4], 50) == 2
+        assert percentile([1, 2, 3, 4], 99) == 4
+
+    def test_replay_postman(self):
+        """
+        Tests every request of the Postman collection succeeds
+        """
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'POSTMAN.json')
+        transport = TestClientTransport(create_app({'STORAGE': 'memory'}))
+        results = replay(path, transport, Recorder())
+        assert [result[1] for result in results] == \
+            ['GET', 'GET', 'POST', 'GET', 'PUT', 'DELETE']
+        assert all(200 <= result[3] < 300 for result in results)
+        assert '<' not in results[-1][2]
+
+
+class TestPacking(TestCase):
+
+    def test_round_trip(self):
+        """
+        Tests packed rolls unpack to the same scores at every point of a game
+        """
+        rand = random.Random(11)
+        for _ in range(500):
+            frames = bowled_frames(rand)
+            bowled = sum(len(frame) for frame in frames)
+            for rolls in range(bowled + 1):
+                scores = raw_scores(frames, rolls)
+                packed = pack_scores(scores)
+                assert len(packed) == (rolls + 1) // 2
+                assert unpack_scores(packed) == scores
+
+        perfect = [10, 0] * 9 + [10, 10, 10]
+        assert len(pack_scores(perfect)) == 6
+        assert unpack_scores(pack_scores(perfect)) == perfect
+        self.assertRaises(ValueError, pack_scores, [10, 3])
+
+    def test_mixed_formats(self):
+        """
+        Tests games read the same whether rolls are packed or lists
+        """
+        scores = [10, 0, 7, 3, 4]
+        assert unpack_scores(scores) == scores
+        assert unpack_scores(None) == []
+
+        game = Game(players=[Player(player_id=1, name="Calvin Johnson"),
+                             Player(player_id=2, name="Michael Jordan")])
+        document = game.to_mongo().to_dict()
+        document['_id'] = ObjectId()
+        document['players'][0]['raw_scores'] = pack_scores(scores)
+        document['players'][1]['raw_scores'] = list(scores)
+
+        loaded = GameView(document)
+        assert loaded.players[0].raw_scores == scores
+        assert loaded.players[0].score_sheet() == \
+            loaded.players[1].score_sheet()
+
+        # a calculated scoresheet is kept on the view
+        assert loaded.players[0].score_sheet() is \
+            loaded.players[0].score_sheet()
+
+        assert is_packed(document['players'][0]['raw_scores'])
+        unpack_game(document)
+        assert document['players'][0]['raw_scores'] == scores
+        assert not is_packed(document['players'][0]['raw_scores'])
+
+
+class TestExport(TestCase):
+
+    def test_resume_interrupted(self):
+        """
+        Tests last complete game is found in an interrupted export
+        """
+        game_ids = [ObjectId() for _ in range(500)]
+        lines = [json.dumps({"id": str(game_id)}) + "\n"
+                 for game_id in game_ids]
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'games.ndjson')
+            with open(path, 'wb') as exported:
+                exported.write("".join(lines) + '{"id": "5795')
+            assert last_exported_id(path) == game_ids[-1]
+
+            # gzip stream cut off part way through
+            data = "".join(gzip_chunks(lines, 100))
+            with open(path + '.gz', 'wb') as exported:
+                exported.write(data[:len(data) // 2])
+            last = last_exported_id(path + '.gz')
+            assert last in game_ids[:-1]
+
+            with open(path + '.gz', 'wb') as exported:
+                exported.write(data)
+            assert last_exported_id(path + '.gz') == game_ids[-1]
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestImport(TestCase):
+
+    def test_replay_export(self):
+        """
+        Tests exported games import as the same game as played through the
+        rules, including players and games ended early
+        """
+        rand = random.Random(19)
+        repository = MemoryRepository()
+        for players in range(1, 5):
+            frames = [bowled_frames(rand) for _ in range(players)]
+            game = repository.create_game(
+                [Player(player_id=num + 1, name="Bowler %d" % num)
+                 for num in range(players)])
+            rolls = roll_order(frames)
+            repository.push_rolls(game.id, rolls[:len(rolls) // 2])
+            if players > 1:
+                repository.deactivate(game.id, 1)
+            repository.push_rolls(game.id, rolls[len(rolls) // 2:][:5])
+        repository.deactivate(game.id)
+
+        lines = list(export_lines(repository.export_games()))
+        for line in lines:
+            record = json.loads(line)
+            imported = json.loads(list(export_lines(
+                [game_document(record)]))[0])
+            # imported games start again at revision 0
+            del record['revision'], imported['revision']
+            assert imported == record
+
+        # rolls as bowled, with the same errors as PUT
+        game = game_document({"players": ["A", "B"], "rolls": [10, 3, 4]})
+        assert game['players'][0]['raw_scores'] == [10, 0]
+        assert game['current_player'] == 1
+        try:
+            game_document({"players": ["A"], "rolls": [3, 9]})
+            assert False
+        except InvalidRoll as exception:
+            assert exception.index == 1
+
+    def test_import_games(self):
+        """
+        Tests lines are checked in a pool and inserted in batches, with
+        invalid games rejected by line number
+        """
+        lines = [json.dumps({"players": ["A"], "rolls": [10] * 12})] * 250
+        lines[10] = '{"players": []}'
+        lines[20] = '{"players": ["A"], "rolls": [7, 7]}'
+        lines[30] = "\n"
+
+        batches, rejects = [], []
+        counts = import_games(lines, lambda games: batches.append(games)
+                              or len(games) - 1,
+                              lambda *reject: rejects.append(reject), 2, 100)
+        assert counts == (244, 3, 2)
+        assert [len(batch) for batch in batches] == [100, 98, 49]
+        assert batches[0][0]['players'][0]['total'] == 300
+        assert [(number, error) for number, _, error in rejects] == \
+            [(11, "Invalid number of players"),
+             (21, "Roll 2: Second roll is too high")]
+
+    def test_reject_non_integer_rolls(self):
+        """
+        Tests fractional and true/false rolls are rejected in either form
+        """
+        for rolls in ([5.5, 2], [3, True], [False]):
+            exported = {"players": [{"name": "A", "raw_scores": rolls}]}
+            named = {"players": ["A"], "rolls": rolls}
+            for record in (exported, named):
+                number, game, error = check_line((1, json.dumps(record)))
+                assert game is None
+                assert "Roll must be integer between 0 - 10" in error
+
+
 class TestScoring(TestCase):
 
     def test_score_calculation(self):
@@ -258,5 +1311,288 @@ class TestScoring(TestCase):
         assert info["frame_scores"][1] == 20
         assert info["total"] == 57
 
+    @skipIf(numpy is None, "NumPy not installed")
+    def test_score_batch(self):
+        """
+        Tests batch scoring matches scoresheets of whole and part games
+        """
+        games = [[], [0, 10] * 10 + [3], [0] * 16 + [10, 0, 3, 4]]
+        for corpus in corpora(random.Random(21), 500).values():
+            games.extend(corpus)
+
+        scores, totals, frames = score_batch(roll_array(games))
+        for num, game in enumerate(games):
+            info = Player.calc_score_sheet(game)
+            assert scores[num][:frames[num]].tolist() == \
+                info["frame_scores"]
+            assert totals[num] == info["total"]
+
+        # fewer columns are games not yet finished, last roll not a bonus
+        scores, totals, frames = score_batch([[10, 0, 10, 0, 5]])
+        assert scores[0].tolist() == [20, 10, 5] + [0] * 7
+        assert frames[0] == 3
+
+
+class TestScoreState(TestCase):
+
+    def test_matches_whole_list_scoring(self):
+        """
+        Tests incremental scoring against scoring whole list of rolls, for
+        every legal last two frames and every prefix of random games
+        """
+        for prefix in ([10, 0] * 8, [5, 5] * 8, [3, 4] * 8):
+            for ninth in legal_frames():
+                for tenth in legal_last_frames():
+                    scores = prefix + ninth + tenth
+                    assert Player.calc_score_sheet(scores) == \
+                        whole_list_score_sheet(scores)
+
+        generator = random.Random(300)
+        for _ in range(2000):
+            frames = [generator.choice(legal_frames()) for _ in range(9)]
+            scores = sum(frames, []) + generator.choice(legal_last_frames())
+            state = ScoreState()
+            for roll, score in enumerate(scores):
+                state.add(score)
+                assert state.score_sheet() == \
+                    whole_list_score_sheet(scores[:roll + 1])
+
+    def test_save_and_restore(self):
+        """
+        Tests state picks up where it left off after saving
+        """
+        scores = [10, 0, 10, 0, 7, 3, 4, 2, 10, 0]
+        state = ScoreState.from_rolls(scores[:5])
+        restored = ScoreState.from_dict(json.loads(
+            json.dumps(state.to_dict())))
+        for score in scores[5:]:
+            restored.add(score)
+        assert restored.score_sheet() == Player.calc_score_sheet(scores)
+
+
+    def test_stored_score_sheet(self):
+        """
+        Tests scoresheet stored on players follows their rolls
+        """
+        player = {"player_id": 1, "name": "Calvin Johnson",
+                  "raw_scores": [10, 0, 4]}
+
+        # missing scoresheet scored from every roll
+        player.update(Player.score_fields(player))
+        assert player["frame_results"] == ['X', '4']
+
+        # stored scoresheet carries on from new rolls
+        for rolls in ([5], [10, 0], [10, 0], [3]):
+            player["raw_scores"].extend(rolls)
+            player.update(Player.score_fields(player, rolls))
+        stored = dict((field, player[field]) for field in Player.SHEET_FIELDS)
+        assert stored == Player.calc_score_sheet(player["raw_scores"])
+
+        # scoresheet out of step is rescored
+        player["raw_scores"].append(6)
+        player.update(Player.score_fields(player))
+        assert player["total"] == \
+            Player.calc_score_sheet(player["raw_scores"])["total"]
+
+
+def legal_frames():
+    """
+    Every legal frame before the last, strikes padded with a 0
+    """
+    frames = [[10, 0]]
+    for first in range(10):
+        for second in range(11 - first):
+            frames.append([first, second])
+    return frames
+
+
+def legal_last_frames():
+    """
+    Every legal last frame including fill rolls
+    """
+    frames = []
+    for first in range(11):
+        standing = 10 - first if first < 10 else 10
+        for second in range(standing + 1):
+            if first + second < 10:
+                frames.append([first, second])
+                continue
+
+            # strike or spare earns a fill roll
+            reset = 10 - second if first == 10 and second < 10 else 10
+            for fill in range(reset + 1):
+                frames.append([first, second, fill])
+    return frames
+
+
+def whole_list_score_sheet(scores):
+    """
+    Scores whole list of rolls at once, the way scoresheets were built
+    before incremental scoring and kept here as reference
+    """
+    frame_results, frame_scores = [], []
+
+    # calculate frame results and frame scores
+    for roll, score in enumerate(scores):
+        frame = roll // 2
+
+        # add in fill scores for last frame strike or spare
+        if roll > 18 and (scores[18] == 10 or sum(scores[18:20]) == 10):
+            frame_scores[9] += score
+            if score == 10:
+                frame_results[9] += "-X"
+            else:
+                frame_results[9] += "-" + str(score)
+            continue
+
+        # check if frame's first roll
+        if roll % 2 != 1:
+            frame_score = score
+            if score == 10:
+                frame_results.append("X")
+                frame_score += whole_list_extra("X", roll, scores)
+            else:
+                frame_results.append(str(score))
+            frame_scores.append(frame_score)
+            continue
+
+        # assume frame's second roll and set frame final score
+        frame_score = frame_scores[-1] + score
+        if score != 0 and frame_score == 10:
+            frame_results[frame] += "-S"
+            frame_score += whole_list_extra("S", roll, scores)
+        elif frame_score < 10:
+            frame_results[frame] += "-" + str(score)
+        frame_scores[-1] = frame_score
+
+    return {
+        "frame_results": frame_results,
+        "frame_scores": frame_scores,
+        "total": sum(frame_scores)
+    }
+
+
+def whole_list_extra(roll_type, roll_num, scores):
+    """
+    Extra points for a strike or spare from whole list of rolls
+    """
+    if roll_type == "S":
+        if roll_num + 1 < len(scores) - 1:
+            return scores[roll_num + 1]
+        return 0
+
+    second_roll, third_roll = 0, 0
+    if roll_num + 2 < len(scores) - 1:
+        second_roll = scores[roll_num + 2]
+    if roll_num + 3 < len(scores) - 1 \
+            and (second_roll < 10 or roll_num + 3 == 19):
+        third_roll = scores[roll_num + 3]
+    elif roll_num + 4 < len(scores) - 1:
+        third_roll = scores[roll_num + 4]
+    return second_roll + third_roll
+
+
+class TestRules(TestCase):
+
+    def setUp(self):
+        """
+        Setup a raw two player game document
+        """
+        self.game = {
+            "active": True,
+            "players": [
+                {"player_id": 1, "name": "Calvin Johnson", "active": True,
+                 "raw_scores": []},
+                {"player_id": 2, "name": "Michael Jordan", "active": True,
+                 "raw_scores": []}
+            ]
+        }
+
+    def test_roll_order(self):
+        """
+        Tests rolls go to players in turn with strike padding
+        """
+        assert apply_roll(self.game, 10) == (0, [10, 0])
+        assert apply_roll(self.game, 3) == (1, [3])
+        assert apply_roll(self.game, 4) == (1, [4])
+        assert self.game["players"][0]["raw_scores"] == [10, 0]
+        assert self.game["players"][1]["raw_scores"] == [3, 4]
+
+    def test_spare_of_ten_not_padded(self):
+        """
+        Tests a 10 on the second roll of a frame, after a 0, is a spare and
+        not padded like a strike, so turn passes to the next player
+        """
+        assert apply_roll(self.game, 0) == (0, [0])
+        assert apply_roll(self.game, 10) == (0, [10])
+        assert apply_roll(self.game, 5) == (1, [5])
+        assert self.game["players"][0]["raw_scores"] == [0, 10]
+
+    def test_invalid_rolls(self):
+        """
+        Tests rolls breaking the rules are refused
+        """
+        self.assertRaises(InvalidRoll, apply_roll, self.game, 11)
+        apply_roll(self.game, 7)
+        self.assertRaises(InvalidRoll, apply_roll, self.game, 4)
+
+        self.game["active"] = False
+        self.assertRaises(InvalidRoll, apply_roll, self.game, 1)
+
+    def test_last_frame(self):
+        """
+        Tests fill rolls in last frame and game ending
+        """
+        # both players bowl to the last frame
+        for _ in range(18):
+            apply_roll(self.game, 10)
+        assert self.game["current_frame"] == 10
+
+        # spare earns a fill roll, open frame ends player's game
+        for score in (5, 5):
+            apply_roll(self.game, score)
+        assert self.game["current_roll"] == 3
+        apply_roll(self.game, 10)
+        assert not self.game["players"][0]["active"]
+        assert self.game["current_player"] == 2
+
+        # strike then second roll leaves pins for fill
+        apply_roll(self.game, 10)
+        apply_roll(self.game, 6)
+        self.assertRaises(InvalidRoll, apply_roll, self.game, 5)
+        apply_roll(self.game, 4)
+        assert not self.game["active"]
+        assert Player.calc_score_sheet(
+            self.game["players"][1]["raw_scores"])["total"] == 286
+
+    def test_deactivate_player(self):
+        """
+        Tests inactivating players moves turn on
+        """
+        apply_roll(self.game, 3)
+
+        # other player leaving keeps turn
+        deactivate(self.game, 2)
+        assert self.game["current_player"] == 1
+        assert self.game["current_roll"] == 2
+
+        # player up leaving ends game when nobody left
+        deactivate(self.game, 1)
+        assert not self.game["active"]
+        self.assertRaises(RuleError, deactivate, self.game, 1)
+
+    def test_backfill_turn(self):
+        """
+        Tests working out turn from scores of games without one
+        """
+        self.game["players"][0]["raw_scores"] = [10, 0, 3]
+        self.game["players"][1]["raw_scores"] = [10, 0]
+        turn = Turn.backfill(self.game)
+        assert (turn.player, turn.frame, turn.roll) == (1, 2, 2)
+
+        self.game["players"][0]["raw_scores"] = [10, 0, 3, 4]
+        turn = Turn.backfill(self.game)
+        assert (turn.player, turn.frame, turn.roll) == (2, 2, 1)
+
 if __name__ == '__main__':
     main()
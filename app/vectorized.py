@@ -0,0 +1,97 @@
+"""
+Vectorized scoring of many games at once
+
+Scores a 2-D array of rolls, one game per row in the raw_scores layout
+(strikes before the last frame padded with a 0), with NumPy array
+operations instead of a ScoreState per player.  Frame scores and totals are
+the same as calc_score_sheet gives, including bonus rolls only counting
+once another roll has followed them.
+
+NumPy is optional, only batch scoring needs it.
+"""
+from itertools import chain
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from rules import FRAMES
+
+
+# most rolls a player can have in the raw_scores layout
+ROLLS = (FRAMES - 1) * 2 + 3
+
+# marks rolls not bowled yet at the end of a row
+MISSING = -1
+
+
+def require_numpy():
+    """
+    Raises a RuntimeError if NumPy is not installed
+    """
+    if numpy is None:
+        raise RuntimeError("Batch scoring needs NumPy, pip install numpy")
+
+
+def roll_array(games):
+    """
+    :param games: list of each player's raw scores
+    :return: int8 array with a row per player, rows padded with MISSING
+    """
+    require_numpy()
+    padding = [[MISSING] * count for count in range(ROLLS + 1)]
+    rolls = chain.from_iterable(scores + padding[ROLLS - len(scores)]
+                                for scores in games)
+    return numpy.fromiter(rolls, numpy.int8, len(games) * ROLLS) \
+        .reshape(len(games), ROLLS)
+
+
+def score_batch(rolls):
+    """
+    Scores every row of an array of rolls
+
+    :param rolls: 2-D array, a row of raw scores per player padded with
+        MISSING, at most ROLLS columns
+    :return: int16 array of frame scores per row, 0 for frames not started,
+        int32 array of totals, int array of frames started
+    """
+    require_numpy()
+    rolls = numpy.asarray(rolls)
+    if rolls.ndim != 2 or rolls.shape[1] > ROLLS:
+        raise ValueError("Rolls must be a 2-D array of at most " +
+                         str(ROLLS) + " columns")
+    if rolls.shape[1] < ROLLS:
+        rolls = numpy.pad(rolls, ((0, 0), (0, ROLLS - rolls.shape[1])),
+                          'constant', constant_values=MISSING)
+
+    bowled = (rolls != MISSING).sum(axis=1)
+    pins = numpy.where(rolls == MISSING, 0, rolls).astype(numpy.int16)
+
+    # a roll only counts as a bonus once another roll has followed it
+    followed = numpy.arange(ROLLS) < (bowled - 1)[:, numpy.newaxis]
+    bonus = numpy.where(followed, pins, 0)
+
+    # pins of each frame, last frame adds its fill roll after a mark
+    first, second = pins[:, 0:18:2], pins[:, 1:18:2]
+    scores = numpy.zeros((len(rolls), FRAMES), numpy.int16)
+    scores[:, :-1] = first + second
+    fill = (pins[:, 18] == 10) | (pins[:, 18] + pins[:, 19] == 10)
+    scores[:, -1] = pins[:, 18] + pins[:, 19] + numpy.where(
+        fill, pins[:, 20], 0)
+
+    # strikes take the next two rolls, skipping padding after another
+    # strike unless it falls in the last frame
+    following = bonus[:, 2:20:2]
+    after = numpy.where(pins[:, 2:18:2] == 10, bonus[:, 4:20:2],
+                        bonus[:, 3:18:2])
+    after = numpy.hstack((after, bonus[:, 19:20]))
+    strike = first == 10
+    scores[:, :-1] += numpy.where(strike, following + after, 0)
+
+    # spares take the next roll, a 0 then 10 is a spare too
+    spare = ~strike & (second != 0) & (first + second == 10)
+    scores[:, :-1] += numpy.where(spare, following, 0)
+
+    frames = numpy.minimum((bowled + 1) // 2, FRAMES)
+    return scores, scores.sum(axis=1, dtype=numpy.int32), frames
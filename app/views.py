@@ -0,0 +1,90 @@
+"""
+Read-only views of raw game documents
+
+Reads wrap documents as pymongo returns them instead of building Game and
+Player objects, skipping mongoengine's field conversion.  Views have the
+attributes routes read from Game and Player, with the same defaults for
+fields a document is missing.  Writes still build Game objects so new
+games are validated.
+"""
+from datastore import Player
+from packing import unpack_scores
+
+
+# fields left out of a full game read, turn pointer and bonuses waiting
+# on later rolls are only needed by writes
+GAME_FIELDS = {'players.score_state.pending': 0, 'current_player': 0,
+               'current_frame': 0, 'current_roll': 0}
+
+# fields read for game listings
+LISTING_FIELDS = {'active': 1, 'players.name': 1, 'players.total': 1}
+
+
+class GameView(object):
+    """
+    Game read from a raw document
+    """
+    __slots__ = ('id', 'active', 'date_started', 'revision', 'players')
+
+    def __init__(self, document):
+        """
+        :param document: raw game document, possibly projected
+        """
+        self.id = document['_id']
+        self.active = document.get('active', True)
+        self.date_started = document.get('date_started')
+        self.revision = document.get('revision', 0)
+        self.players = [PlayerView(player)
+                        for player in document.get('players', ())]
+
+
+class PlayerView(object):
+    """
+    Player read from a raw player document, rolls are only unpacked if
+    their scoresheet has to be calculated
+    """
+    __slots__ = ('player_id', 'name', 'active', 'frame_results',
+                 'frame_scores', 'total', 'stored', 'rolls', 'sheet')
+
+    def __init__(self, document):
+        """
+        :param document: raw player document, possibly projected
+        """
+        self.player_id = document.get('player_id')
+        self.name = document.get('name')
+        self.active = document.get('active', True)
+        self.frame_results = document.get('frame_results', [])
+        self.frame_scores = document.get('frame_scores', [])
+        self.stored = bool(document.get('score_state'))
+        self.rolls = document.get('raw_scores')
+        self.sheet = None
+
+        # players saved before scoresheets were stored are scored from
+        # their rolls, if read
+        self.total = document.get('total')
+        if self.total is None:
+            self.total = self.score_sheet()["total"] if self.rolls else 0
+
+    @property
+    def raw_scores(self):
+        """
+        :return: list of scores, strikes padded with a 0
+        """
+        return unpack_scores(self.rolls)
+
+    def score_sheet(self):
+        """
+        Player's stored scoresheet, calculated if not stored yet
+
+        :return: scoresheet map
+        """
+        if not self.stored:
+            # calculated once and kept for the life of the view
+            if self.sheet is None:
+                self.sheet = Player.calc_score_sheet(self.raw_scores)
+            return self.sheet
+        return {
+            "frame_results": self.frame_results,
+            "frame_scores": self.frame_scores,
+            "total": self.total
+        }
@@ -23,7 +23,7 @@ end
 supervisor_service "bowling-tracker" do
     action :enable
     directory "/home/mark/bowling-tracker"
-    command "python app/api.py"
+    command "gunicorn -c app/gunicorn_conf.py api:app"
     stdout_logfile "/home/mark/bowling-tracker/.logs"
     stdout_logfile_maxbytes "50MB"
     redirect_stderr true